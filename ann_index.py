@@ -0,0 +1,155 @@
+"""组织相似度检索的近似最近邻（IVF-flat）后端
+
+用球面 k-means 把归一化后的嵌入矩阵划分成 n_lists 个倒排列表，
+查询时只扫描离查询向量最近的 n_probe 个列表。精确扫描依然保留，
+作为召回率的基准。
+
+离线构建（写到快照目录，和 embedding_snapshot.py 的文件放在一起）:
+    python ann_index.py --snapshot-dir snapshots
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+from embedding_index import top_k_indices
+
+# 分块计算距离，避免 n × n_lists 的临时矩阵过大
+ASSIGN_CHUNK_ROWS = 8192
+
+
+def default_list_count(rows):
+    return max(1, min(int(4 * np.sqrt(rows)), rows))
+
+
+def _assign(matrix, centroids):
+    """返回每一行最近的质心编号"""
+    assignments = np.empty(len(matrix), dtype=np.int32)
+    for start in range(0, len(matrix), ASSIGN_CHUNK_ROWS):
+        block = matrix[start:start + ASSIGN_CHUNK_ROWS]
+        assignments[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+
+def spherical_kmeans(matrix, n_lists, n_iter=10, sample_size=None, seed=0):
+    """在归一化向量上做 k-means，质心也保持单位长度"""
+    rng = np.random.default_rng(seed)
+    sample_size = sample_size or min(len(matrix), 32 * n_lists)
+    sample = matrix[rng.choice(len(matrix), sample_size, replace=False)]
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+
+    for _ in range(n_iter):
+        assignments = _assign(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        norms = np.linalg.norm(sums, axis=1)
+        empty = norms == 0
+        # 空列表重新随机取一个样本点作为质心
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        norms[empty] = np.linalg.norm(sums[empty], axis=1)
+        centroids = (sums / norms[:, None]).astype(np.float32)
+    return centroids
+
+
+class IVFFlatIndex:
+    """倒排列表用 CSR 形式保存：order 按列表排好的行号，offsets 是每个列表的起点"""
+
+    def __init__(self, centroids, order, offsets, rows, snapshot=None):
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+        self.rows = rows
+        # 离线构建时对应的快照（版本头的 created_at），快照重写后行号会变，旧列表不能再用
+        self.snapshot = snapshot
+        # 构建之后改写过的行（更新的组织、复用墓碑行的新组织），不一定在正确的列表里，检索时总是打分
+        self.changed = np.empty(0, dtype=np.int64)
+
+    @classmethod
+    def build(cls, matrix, valid, n_lists=None, n_iter=10, seed=0):
+        valid_rows = np.flatnonzero(valid)
+        vectors = np.asarray(matrix[valid_rows], dtype=np.float32)
+        n_lists = min(n_lists or default_list_count(len(vectors)), max(len(vectors), 1))
+        if len(vectors) == 0:
+            centroids = np.zeros((1, matrix.shape[1]), dtype=np.float32)
+            return cls(centroids, np.empty(0, np.int64), np.zeros(2, np.int64), len(matrix))
+
+        centroids = spherical_kmeans(vectors, n_lists, n_iter=n_iter, seed=seed)
+        assignments = _assign(vectors, centroids)
+        sort = np.argsort(assignments, kind="stable")
+        order = valid_rows[sort]
+        offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=n_lists), out=offsets[1:])
+        return cls(centroids, order, offsets, len(matrix))
+
+    def mark_changed(self, rows):
+        """记录构建之后改写过的行；整体替换数组，正在检索的线程继续使用旧数组"""
+        self.changed = np.union1d(self.changed, np.asarray(rows, dtype=np.int64))
+
+    def pending(self, size):
+        """不在列表里、每次检索都要额外打分的行数"""
+        return len(self.changed) + max(0, size - self.rows)
+
+    def candidates(self, query, n_probe):
+        """查询向量最近的 n_probe 个列表里的所有行"""
+        n_probe = min(n_probe, len(self.centroids))
+        probes = top_k_indices(self.centroids @ query, n_probe)
+        return np.concatenate([self.order[self.offsets[p]:self.offsets[p + 1]] for p in probes])
+
+    def search(self, matrix, valid, query, k, n_probe):
+        """返回 (行号数组, 得分数组)，按得分降序；构建之后改写或追加的行全部参与打分"""
+        rows = self.candidates(query, n_probe)
+        changed = self.changed
+        if len(changed) or len(valid) > self.rows:
+            rows = np.unique(np.concatenate([rows, changed, np.arange(self.rows, len(valid))]))
+            rows = rows[rows < len(valid)]
+        rows = rows[valid[rows]]
+        scores = matrix[rows] @ query
+        top = top_k_indices(scores, k)
+        return rows[top], scores[top]
+
+    def save(self, path):
+        np.savez(path, centroids=self.centroids, order=self.order,
+                 offsets=self.offsets, rows=np.int64(self.rows), snapshot=np.str_(self.snapshot or ""))
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        snapshot = str(data["snapshot"]) if "snapshot" in data.files else ""
+        return cls(data["centroids"], data["order"], data["offsets"], int(data["rows"]), snapshot=snapshot or None)
+
+
+def main():
+    from dotenv import load_dotenv
+    from embedding_snapshot import snapshot_prefix
+    from embedding_index import EMBEDDING_FIELDS
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="为嵌入快照离线构建 IVF-flat 索引")
+    parser.add_argument("--snapshot-dir", default=os.getenv("EMBEDDING_SNAPSHOT_DIR", "snapshots"))
+    parser.add_argument("--collection", action="append",
+                        help="集合名，可重复；默认非营利和营利两个集合")
+    parser.add_argument("--lists", type=int, default=None, help="倒排列表数量，默认 4*sqrt(N)")
+    parser.add_argument("--iterations", type=int, default=10)
+    args = parser.parse_args()
+
+    collections = args.collection or [
+        os.getenv("MONGODB_COLLECTION_NONPROFIT"),
+        os.getenv("MONGODB_COLLECTION_FORPROFIT")
+    ]
+    for name in collections:
+        for field in EMBEDDING_FIELDS:
+            prefix = snapshot_prefix(args.snapshot_dir, name, field)
+            with open(prefix + ".json") as f:
+                header = json.load(f)
+            # 快照矩阵末尾的空行不参与构建
+            matrix = np.load(prefix + ".npy", mmap_mode="r")[:header["rows"]]
+            valid = np.load(prefix + ".ids.npy")["valid"]
+            ivf = IVFFlatIndex.build(matrix, valid, n_lists=args.lists, n_iter=args.iterations)
+            ivf.snapshot = header["created_at"]
+            ivf.save(prefix + ".ivf.npz")
+            print(f"已写入 {prefix}.ivf.npz: {len(ivf.centroids)} 个列表, {ivf.rows} 行")
+
+
+if __name__ == "__main__":
+    main()
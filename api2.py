@@ -1,20 +1,38 @@
+import asyncio
+import functools
+import json
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
+from starlette.background import BackgroundTask
 from fastapi.middleware.cors import CORSMiddleware
 from typing import Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
 from pydantic import BaseModel, ConfigDict
 from pymongo import MongoClient
-from scipy.spatial.distance import cosine
-import numpy as np
+import orjson
 from bson.objectid import ObjectId
 import openai
 import os
+import threading
 from dotenv import load_dotenv
+from embedding_index import EMBEDDING_FIELDS, SEARCH_MODES, get_collection_index
+from index_sync import start_index_sync
+from lexical_index import reciprocal_rank_fusion, tokenize
+from metadata_index import validate_filter
+from organization_cards import RequestDocuments, card_cache_info, get_card_cache, sanitize_float, sanitize_organization_data
+from match_evaluation import EVAL_CONCURRENCY, EVALUATION_MODES, iter_evaluations
+from llm_cache import cached_chat_completion, get_llm_cache
+from embedding_cache import cached_embedding, get_embedding_cache
+from verdict_cache import get_verdict_cache
+from job_queue import InMemoryJobStore, JobManager, MongoJobStore, QueueFullError, SUCCEEDED, FAILED
 
 # 加载环境变量
 load_dotenv()
 
 # 创建FastAPI应用
-app = FastAPI()
+# 响应统一用 orjson 序列化
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # CORS设置
 allowed_origins = [
@@ -23,6 +41,38 @@ allowed_origins = [
     "http://localhost:8501"                         # 本地开发时的Streamlit地址
 ]
 
+# 阻塞调用（openai 0.28 和 PyMongo 都是同步的）放到有界线程池中执行，不占用事件循环。
+# 完整版流程的候选评估另有自己的线程池（EVAL_CONCURRENCY），A/B 端点一个请求占两个线程
+blocking_executor = ThreadPoolExecutor(max_workers=int(os.getenv("API_BLOCKING_WORKERS", "32")),
+                                       thread_name_prefix="api-blocking")
+# 同时进行的匹配请求上限；超出的请求排队，等待超过 MATCH_QUEUE_TIMEOUT 秒返回 503
+MAX_INFLIGHT_MATCHES = int(os.getenv("MAX_INFLIGHT_MATCHES", "16"))
+MATCH_QUEUE_TIMEOUT = float(os.getenv("MATCH_QUEUE_TIMEOUT", "30"))
+match_slots = asyncio.Semaphore(MAX_INFLIGHT_MATCHES)
+
+async def run_blocking(func, *args):
+    """在 blocking_executor 中运行同步函数并等待结果"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(blocking_executor, functools.partial(func, *args))
+
+async def acquire_match_slot():
+    try:
+        await asyncio.wait_for(match_slots.acquire(), MATCH_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail="同时进行的匹配请求过多，请稍后重试",
+                            headers={"Retry-After": "30"})
+
+def limit_inflight(endpoint):
+    """匹配端点装饰器：占用一个 match_slots 名额直到响应返回"""
+    @functools.wraps(endpoint)
+    async def wrapper(*args, **kwargs):
+        await acquire_match_slot()
+        try:
+            return await endpoint(*args, **kwargs)
+        finally:
+            match_slots.release()
+    return wrapper
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=allowed_origins,
@@ -62,307 +112,530 @@ try:
 except Exception as e:
     print(f"Database connection error: {e}")
 
-@app.post("/test/complete-matching-process")
-async def complete_matching_process(request: Dict):
-    """整合的匹配流程API"""
+def card_cache(collection):
+    return get_card_cache(collection.name, int(os.getenv("CARD_CACHE_MAX_ITEMS", "50000")))
+
+def build_match_result(entry, similarity, extras=None):
+    """把组织卡片 (organization, card) 整理成匹配结果"""
+    organization, card = entry
+    result = {
+        "similarity_score": similarity,
+        "organization": organization,
+        "card": card
+    }
+    if extras:
+        result.update(extras)
+    return result
+
+def match_card(match):
+    """响应中的组织数据：优先使用预先整理好的卡片"""
+    if match["card"] is not None:
+        return match["card"]
+    return sanitize_organization_data(match["organization"])
+
+def hydrate_matches(collection, ranked, documents=None):
+    """按排名顺序回填胜出组织，卡片缓存中没有的组织用一次 $in 查询读取展示字段
+
+    documents 是同一请求内共享的 RequestDocuments，并发流程都入选的组织只读取一次。
+    """
+    org_ids = [org_id for org_id, *_ in ranked]
+    if documents is None:
+        entries = card_cache(collection).fetch(collection, org_ids) if org_ids else {}
+    else:
+        entries = documents.fetch(collection, org_ids, card_cache(collection))
+    return [build_match_result(entries[org_id], *scores) for org_id, *scores in ranked if org_id in entries]
+
+SCORING_MODES = ("single", "hybrid")
+
+# off: 只用向量检索；rrf: 向量排名与 BM25 排名做倒数排名融合；
+# candidates: 先用 BM25 选出候选组织，只对候选做向量打分
+LEXICAL_MODES = ("off", "rrf", "candidates")
+
+def request_option(request, key, env_var, default, choices):
+    """请求中的 key，没有时读取环境变量 env_var；取值不在 choices 中时抛出 ValueError"""
+    value = request.get(key, os.getenv(env_var, default))
+    if value not in choices:
+        raise ValueError(f"{key} 不支持 {value!r}，可选: {', '.join(choices)}")
+    return value
+
+def field_weights(request):
+    """多字段检索的权重：请求里的 field_weights，否则用环境变量 HYBRID_FIELD_WEIGHTS（JSON）"""
+    weights = request.get("field_weights") or json.loads(os.getenv(
+        "HYBRID_FIELD_WEIGHTS", '{"tag_embedding": 0.5, "description_embedding": 0.5}'))
+    if not isinstance(weights, dict):
+        raise ValueError("field_weights 必须是对象")
+    unknown = [field for field in weights if field not in EMBEDDING_FIELDS]
+    if unknown:
+        raise ValueError(f"不支持的嵌入字段: {', '.join(map(str, unknown))}，可用字段: {', '.join(EMBEDDING_FIELDS)}")
     try:
-        print("\n=== 开始匹配流程 ===")
-        
-        # 1. 验证输入
-        print("\n1. 验证输入字段")
-        required_fields = [
-            "Name", 
-            "Type", 
-            "Description",
-            "Mission",
-            "Industries",
-            "Specialities",
-            "Organization looking 1",
-            "Organization looking 2"
-        ]
-        if not all(field in request for field in required_fields):
-            print("错误：缺少必要字段")
-            raise HTTPException(status_code=400, detail="缺少必要字段")
-        print("输入验证成功")
-
-        # 2. 生成理想组织描述
-        print("\n2. 生成理想组织描述")
-        openai.api_key = os.getenv("OPENAI_API_KEY")
-        print("正在调用OpenAI生成理想组织描述...")
-        org_response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": os.getenv("PROMPT_GEN_ORG_SYSTEM").format(
-                    org_type_looking_for=request["Organization looking 1"])},
-                {"role": "user", "content": os.getenv("PROMPT_GEN_ORG_USER").format(
-                    org_type_looking_for=request["Organization looking 1"],
-                    partnership_description=request["Organization looking 2"]
-                )}
-            ]
-        )
-        
-        ideal_org_description = org_response.choices[0].message['content'].strip()
-        print(f"生成的理想组织描述: {ideal_org_description[:100]}...")
-
-        # 新增: 2.5 基于Mission过滤组织
-        print("\n2.5 基于Mission过滤组织")
-        filter_response = openai.ChatCompletion.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": os.getenv("PROMPT_FILTER_SYSTEM")},
-                {"role": "user", "content": os.getenv("PROMPT_FILTER_USER").format(
-                    organization_mission=request["Mission"],
-                    generated_organizations=ideal_org_description
-                )}
-            ]
-        )
+        weights = {field: float(weight) for field, weight in weights.items()}
+    except (TypeError, ValueError):
+        raise ValueError("field_weights 的权重必须是数字")
+    if any(weight < 0 for weight in weights.values()) or not any(weight > 0 for weight in weights.values()):
+        raise ValueError("field_weights 的权重不能为负，且至少一个大于0")
+    return weights
+
+def search_matches(request, collection, field, query_vectors, k, documents=None, query_tokens=()):
+    """按请求的 scoring 做单字段或多字段加权检索
+
+    返回 (匹配结果, 参与排序的组织数, 写入 step5_matches 的检索信息)。
+    hybrid 模式下每个结果带 field_scores（各字段的余弦相似度）。
+    请求里的 filters（MongoDB风格的元数据过滤表达式）在打分之前生效。
+    lexical 为 rrf / candidates 时用 query_tokens 查询 Tags / Specialities 的 BM25 索引，
+    rrf 模式下每个结果带 rank_fusion（融合得分和两边的名次）。
+    """
+    index = get_collection_index(collection)
+    scoring = request_option(request, "scoring", "SCORING_MODE", "single", SCORING_MODES)
+    lexical = request_option(request, "lexical", "LEXICAL_MODE", "off", LEXICAL_MODES)
+    filters = request.get("filters")
+    row_filter = index.filter_mask(collection, filters) if filters else None
+    search_info = {"filters": filters} if filters else {}
+
+    if scoring == "hybrid":
+        weights = field_weights(request)
+        fields = [name for name, weight in weights.items() if weight > 0]
+        search_info.update({"search_mode": "exact", "scoring": scoring, "field_weights": weights})
+
+        def vector_search(row_filter, k, exact=False):
+            # 多字段检索总是精确扫描
+            return [(org_id, score, {"field_scores": sub_scores}) for org_id, score, sub_scores
+                    in index.search_hybrid(query_vectors, weights, k, row_filter=row_filter)]
+    else:
+        fields = [field]
+        search_mode = request_option(request, "search_mode", "SEARCH_MODE", "exact", SEARCH_MODES)
+        search_info["search_mode"] = search_mode
+
+        def vector_search(row_filter, k, exact=False):
+            return [(org_id, score, {}) for org_id, score in index.search(
+                field, query_vectors[field], k, mode="exact" if exact else search_mode, row_filter=row_filter)]
+
+    if lexical != "off":
+        search_info["lexical"] = lexical
+    if lexical == "candidates":
+        candidates = index.search_lexical(collection, query_tokens, int(os.getenv("LEXICAL_CANDIDATES", "1000")), row_filter)
+        search_info["lexical_candidates"] = len(candidates)
+        # 没有任何词命中时退回到全量向量检索
+        if candidates:
+            row_filter = index.row_mask([org_id for org_id, _ in candidates])
+    total_matches = index.count_any(fields, row_filter)
+
+    ranked = vector_search(row_filter, k)
+    if lexical == "rrf":
+        lexical_ranked = index.search_lexical(collection, query_tokens, k, row_filter)
+        search_info["lexical_matches"] = len(lexical_ranked)
+        fused = reciprocal_rank_fusion([[org_id for org_id, *_ in ranked], [org_id for org_id, _ in lexical_ranked]])[:k]
+        vector_scores = {org_id: (score, extras) for org_id, score, extras in ranked}
+        bm25_scores = dict(lexical_ranked)
+        # 只被 BM25 选中的组织补算向量相似度
+        lexical_only = [org_id for org_id, _, _ in fused if org_id not in vector_scores]
+        if lexical_only:
+            rescored = vector_search(index.row_mask(lexical_only), len(lexical_only), exact=True)
+            vector_scores.update({org_id: (score, extras) for org_id, score, extras in rescored})
+        ranked = []
+        for org_id, rrf_score, (vector_rank, lexical_rank) in fused:
+            score, extras = vector_scores.get(org_id, (0.0, {}))
+            ranked.append((org_id, score, {**extras, "rank_fusion": {
+                "rrf_score": rrf_score,
+                "vector_rank": vector_rank,
+                "lexical_rank": lexical_rank,
+                "bm25_score": bm25_scores.get(org_id)
+            }}))
+
+    return hydrate_matches(collection, ranked, documents), total_matches, search_info
+
+def sanitize_match_extras(match):
+    """hybrid / rrf 模式附加在匹配结果上的得分信息"""
+    extras = {}
+    if "field_scores" in match:
+        extras["field_scores"] = {field: None if score is None else float(score)
+                                  for field, score in match["field_scores"].items()}
+    if "rank_fusion" in match:
+        extras["rank_fusion"] = {key: None if value is None else (int(value) if key.endswith("_rank") else float(value))
+                                 for key, value in match["rank_fusion"].items()}
+    return extras
+
+@app.on_event("startup")
+def warm_embedding_indexes():
+    """启动时预加载两个集合的嵌入索引"""
+    for collection in (nonprofit_collection, forprofit_collection):
+        try:
+            index = get_collection_index(collection)
+            if os.getenv("SEARCH_MODE", "exact") == "ann":
+                # 在后台构建 IVF 索引，建好之前 ANN 请求使用精确扫描
+                for field in EMBEDDING_FIELDS:
+                    index.ann_index(field)
+            # 匹配结果卡片和索引一起预先生成，请求中只需按 _id 取用
+            if os.getenv("CARD_CACHE_PRELOAD", "1") != "0":
+                cards = card_cache(collection).load(collection, index.document_ids())
+                print(f"集合 {collection.name} 预生成 {len(cards)} 张组织卡片")
+        except Exception as e:
+            print(f"预加载集合索引失败: {e}")
+
+index_synchronizers = []
+
+@app.on_event("startup")
+def start_embedding_index_sync():
+    """把集合的增删改增量同步到常驻索引"""
+    if os.getenv("INDEX_SYNC_ENABLED", "1") == "0":
+        return
+    collections = [nonprofit_collection, forprofit_collection]
+    try:
+        if os.getenv("SHARED_INDEX_PREFIX"):
+            # 共享内存索引由 shared_index.py 发布进程同步，worker 中的映射是只读的；
+            # 发布进程还没运行、各自加载的索引在改用共享内存之前自己同步
+            collections = [collection for collection in collections
+                           if get_collection_index(collection).shared is None]
+        index_synchronizers.extend(start_index_sync(
+            collections,
+            poll_interval=float(os.getenv("INDEX_SYNC_POLL_SECONDS", "60"))
+        ))
+    except Exception as e:
+        print(f"启动索引同步失败: {e}")
+
+@app.on_event("shutdown")
+def stop_embedding_index_sync():
+    for synchronizer in index_synchronizers:
+        synchronizer.stop()
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """各级缓存的命中/未命中计数"""
+    return {"llm": get_llm_cache().info(), "embedding": get_embedding_cache().info(),
+            "verdict": get_verdict_cache().info(), "cards": card_cache_info()}
+
+REQUIRED_FIELDS = [
+    "Name", 
+    "Type", 
+    "Description",
+    "Mission",
+    "Industries",
+    "Specialities",
+    "Organization looking 1",
+    "Organization looking 2"
+]
 
-        filtered_org_description = filter_response.choices[0].message['content'].strip()
-        print(f"过滤后的组织描述: {filtered_org_description[:100]}...")
-
-        # 3. 生成标签
-        print("\n3. 生成标签")
-        print("正在调用OpenAI生成标签...")
-        tags_response = openai.ChatCompletion.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": os.getenv("PROMPT_TAGS_SYSTEM").format(
-                    total_tags=30, steps=6, tags_per_step=5)},
-                {"role": "user", "content": os.getenv("PROMPT_TAGS_USER").format(
-                    total_tags=30, description=filtered_org_description)}
-            ]
-        )
-        
-        tags = tags_response.choices[0].message['content'].strip()
-        tag_list = [tag.strip() for tag in tags.split(",") if tag.strip()][:30]
-        tags_string = ", ".join(tag_list)
-        print(f"生成的标签: {tags_string}")
-
-        # 5. 生成标签嵌入向量
-        print("\n5. 生成标签嵌入向量")
-        print("正在调用OpenAI生成嵌入向量...")
-        embedding_response = openai.Embedding.create(
-            model="text-embedding-ada-002",
-            input=tags_string
-        )
-        
-        tag_embedding = embedding_response["data"][0]["embedding"]
-        print(f"嵌入向量维度: {len(tag_embedding)}")
-
-        # 6. 查找匹配
-        print("\n6. 查找匹配")
-        matches = []
-        collection = nonprofit_collection if request["Organization looking 1"].strip().lower() in ["non profit", "nonprofit"] else forprofit_collection
-        print(f"使用集合: {collection.name}")
-        
-        print("正在查询数据库中的匹配项...")
-        query_count = 0
-        for org in collection.find({"tag_embedding": {"$exists": True}}):
-            query_count += 1
-            if org.get("tag_embedding"):
-                try:
-                    # 直接使用 np.frombuffer 处理二进制数据，不需要其他转换
-                    org_embedding = np.frombuffer(org["tag_embedding"], dtype=np.float32)
-                    # 直接计算余弦相似度，不需要预处理向量
-                    similarity = float(1 - cosine(tag_embedding, org_embedding))
-                    
-                    match_result = {
-                        "similarity_score": similarity,
-                        "organization": {
-                            "_id": str(org["_id"]),
-                            "Name": org.get("Name", ""),
-                            "Description": org.get("Description", ""),
-                            "Industries": org.get("Industries", []),
-                            "Specialities": org.get("Specialities", []),
-                            "Staff_Count": org.get("Staff_Count", ""),
-                            "Assets": org.get("Assets", ""),
-                            "Mission": org.get("Mission", ""),
-                            "Narrative": org.get("Narrative", ""),
-                            "Tags": org.get("Tags", []),
-                            "Linkedin_followers": org.get("Linkedin_followers", ""),
-                            "Popularity": org.get("Popularity", ""),
-                            "Partnership": org.get("Partnership", ""),
-                            "Event": org.get("Event", "")
-                        }
-                    }
-                    matches.append(match_result)
-                except Exception as e:
-                    print(f"处理组织 {org.get('_id')} 时出错: {str(e)}")
-                    print(f"错误类型: {type(e)}")
-                    print(f"组织tag_embedding类型: {type(org.get('tag_embedding'))}")
-                    if isinstance(org.get("tag_embedding"), bytes):
-                        print(f"组织tag_embedding长度: {len(org.get('tag_embedding'))}")
-                    continue
-
-        print(f"共处理 {query_count} 个组织，找到 {len(matches)} 个匹配项")
-
-        # 7. 排序和评估匹配项
-        print("\n7. 排序和评估匹配项")
-        matches.sort(key=lambda x: x["similarity_score"], reverse=True)
-        top_100_matches = matches[:100]
-        first_thirty = top_100_matches[:30]  # 改为30个
-        remaining_matches = top_100_matches[30:]  # 从第31个开始的剩余匹配
-        print(f"前100个匹配项中，选择前30个进行评估")
-
-        # 评估前30个匹配
-        print("\n8. 评估匹配项")
-        evaluated_matches = []  # 存储评估为 true 的匹配项
-        rejected_matches = []   # 存储评估为 false 的匹配项
-        for idx, match in enumerate(first_thirty):
-            print(f"评估第 {idx+1}/30 个匹配项...")
-            
-            # 准备资源信息
-            match_resources = ""
-            if request["Organization looking 1"].lower() == "nonprofit":
-                match_resources = f"Partnership History: {match['organization'].get('Partnership', '')}, Event Experience: {match['organization'].get('Event', '')}"
-            else:
-                match_resources = f"Assets: {match['organization'].get('Assets', '')}, Contribution Capacity: {match['organization'].get('Contribution', '')}"
-
-            # 评估匹配
-            evaluation_prompt = os.getenv("MATCH_EVALUATION_PROMPT").format(
-                # 用户组织信息
-                user_description=request["Description"],
-                user_mission=request["Mission"],
-                user_industries=request["Industries"],
-                user_specialities=request["Specialities"],
-                
-                # 匹配组织信息
-                match_description=match["organization"]["Description"],
-                match_mission=match["organization"]["Mission"],
-                match_industries=match["organization"]["Industries"],
-                match_specialties=match["organization"]["Specialities"],
-                
-                # 资源信息
-                match_resources=match_resources,
-                match_partnership=match["organization"].get("Partnership", ""),
-                match_event=match["organization"].get("Event", ""),
-                match_contribution=match["organization"].get("Contribution", ""),
-                match_assets=match["organization"].get("Assets", "")
-            )
-
-            eval_response = openai.ChatCompletion.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": os.getenv("MATCH_EVALUATION_SYSTEM_PROMPT")},
-                    {"role": "user", "content": evaluation_prompt}
-                ],
-                temperature=0.3
-            )
-
-            is_match = eval_response.choices[0].message['content'].strip().lower() == 'true'
-            if is_match:
-                match["evaluation"] = {
-                    "is_match": True, 
-                    "status": "accepted"
+def validate_matching_request(request):
+    """1. 验证输入字段"""
+    print("\n1. 验证输入字段")
+    if not all(field in request for field in REQUIRED_FIELDS):
+        print("错误：缺少必要字段")
+        raise HTTPException(status_code=400, detail="缺少必要字段")
+    # 检索和评估的选项在调用 OpenAI 之前检查，不为注定失败的请求付费
+    try:
+        request_option(request, "scoring", "SCORING_MODE", "single", SCORING_MODES)
+        request_option(request, "lexical", "LEXICAL_MODE", "off", LEXICAL_MODES)
+        request_option(request, "search_mode", "SEARCH_MODE", "exact", SEARCH_MODES)
+        request_option(request, "evaluation_mode", "EVALUATION_MODE", "concurrent", EVALUATION_MODES)
+        if request.get("field_weights"):
+            field_weights(request)
+        if request.get("filters"):
+            validate_filter(request["filters"])
+    except ValueError as e:
+        print(f"错误：{e}")
+        raise HTTPException(status_code=400, detail=str(e))
+    print("输入验证成功")
+
+def select_collection(request):
+    """根据要找的组织类型选择集合"""
+    if request["Organization looking 1"].strip().lower() in ["non profit", "nonprofit"]:
+        return nonprofit_collection
+    return forprofit_collection
+
+def build_input_summary(request):
+    """响应中的 step1_input_organization"""
+    return {
+        "name": str(request["Name"]),
+        "type": str(request["Type"]),
+        "description": str(request["Description"]),
+        "mission": str(request["Mission"]),
+        "industries": request["Industries"],
+        "specialities": request["Specialities"],
+        "looking_for": str(request["Organization looking 1"]),
+        "partnership_description": str(request["Organization looking 2"])
+    }
+
+def iter_complex_pipeline(request, collection, documents=None):
+    """完整匹配流程（步骤2-10），请求需已通过验证
+
+    每完成一步产出一个事件 {"event": "step", "step": ..., "data": ...}，
+    每个候选评估完成时产出 {"event": "evaluation", ...}，
+    最后产出 {"event": "result", "data": 完整响应}。
+    """
+    yield {"event": "step", "step": "step1_input_organization", "data": build_input_summary(request)}
+
+    # 2. 生成理想组织描述
+    print("\n2. 生成理想组织描述")
+    openai.api_key = os.getenv("OPENAI_API_KEY")
+    print("正在调用OpenAI生成理想组织描述...")
+    ideal_org_description = cached_chat_completion(
+        model="gpt-3.5-turbo",
+        messages=[
+            {"role": "system", "content": os.getenv("PROMPT_GEN_ORG_SYSTEM").format(
+                org_type_looking_for=request["Organization looking 1"])},
+            {"role": "user", "content": os.getenv("PROMPT_GEN_ORG_USER").format(
+                org_type_looking_for=request["Organization looking 1"],
+                partnership_description=request["Organization looking 2"]
+            )}
+        ]
+    ).strip()
+    print(f"生成的理想组织描述: {ideal_org_description[:100]}...")
+    yield {"event": "step", "step": "step2_ideal_organization", "data": {"description": ideal_org_description}}
+
+    # 新增: 2.5 基于Mission过滤组织
+    print("\n2.5 基于Mission过滤组织")
+    filtered_org_description = cached_chat_completion(
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": os.getenv("PROMPT_FILTER_SYSTEM")},
+            {"role": "user", "content": os.getenv("PROMPT_FILTER_USER").format(
+                organization_mission=request["Mission"],
+                generated_organizations=ideal_org_description
+            )}
+        ]
+    ).strip()
+    print(f"过滤后的组织描述: {filtered_org_description[:100]}...")
+
+    # 3. 生成标签
+    print("\n3. 生成标签")
+    print("正在调用OpenAI生成标签...")
+    tags = cached_chat_completion(
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": os.getenv("PROMPT_TAGS_SYSTEM").format(
+                total_tags=30, steps=6, tags_per_step=5)},
+            {"role": "user", "content": os.getenv("PROMPT_TAGS_USER").format(
+                total_tags=30, description=filtered_org_description)}
+        ]
+    ).strip()
+    tag_list = [tag.strip() for tag in tags.split(",") if tag.strip()][:30]
+    tags_string = ", ".join(tag_list)
+    print(f"生成的标签: {tags_string}")
+    yield {"event": "step", "step": "step3_generated_tags", "data": {"tags": tag_list, "tags_string": tags_string}}
+
+    # 5. 生成标签嵌入向量
+    print("\n5. 生成标签嵌入向量")
+    print("正在调用OpenAI生成嵌入向量...")
+    tag_embedding = cached_embedding("text-embedding-ada-002", tags_string)
+    print(f"嵌入向量维度: {len(tag_embedding)}")
+    yield {"event": "step", "step": "step4_embedding", "data": {"dimension": int(len(tag_embedding))}}
+
+    # 6. 查找匹配
+    print("\n6. 查找匹配")
+    print(f"使用集合: {collection.name}")
+
+    print("正在从常驻索引中检索匹配项...")
+    query_vectors = {"tag_embedding": tag_embedding}
+    if request_option(request, "scoring", "SCORING_MODE", "single", SCORING_MODES) == "hybrid":
+        query_vectors["description_embedding"] = cached_embedding(
+            "text-embedding-ada-002", request["Organization looking 2"])
+    matches, total_matches, search_info = search_matches(
+        request, collection, "tag_embedding", query_vectors, 100, documents, query_tokens=tokenize(tag_list))
+
+    print(f"共处理 {total_matches} 个组织，取前 {len(matches)} 个匹配项")
+
+    # 7. 排序和评估匹配项
+    print("\n7. 排序和评估匹配项")
+    top_100_matches = matches[:100]
+    first_thirty = top_100_matches[:30]  # 改为30个
+    remaining_matches = top_100_matches[30:]  # 从第31个开始的剩余匹配
+    print(f"前100个匹配项中，选择前30个进行评估")
+    yield {"event": "step", "step": "step5_candidates", "data": {
+        "total_matches_found": int(total_matches),
+        **search_info,
+        "candidates": [
+            {
+                "similarity_score": sanitize_float(match["similarity_score"]),
+                "organization": match_card(match),
+                **sanitize_match_extras(match)
+            }
+            for match in first_thirty
+        ]
+    }}
+
+    # 评估前30个匹配
+    print("\n8. 评估匹配项")
+    evaluation_mode = request_option(request, "evaluation_mode", "EVALUATION_MODE", "concurrent", EVALUATION_MODES)
+    print(f"评估前 {len(first_thirty)} 个匹配项（模式 {evaluation_mode}，并发数 {EVAL_CONCURRENCY}）...")
+    evaluated_matches = []  # 存储评估为 true 的匹配项
+    rejected_matches = []   # 存储评估为 false 的匹配项
+    failed_evaluations = 0  # 评估请求失败（按不匹配处理）的数量
+    cached_evaluations = 0  # 直接使用缓存结果的数量
+    evaluations = [None] * len(first_thirty)
+    for idx, evaluation in iter_evaluations(request, first_thirty, mode=evaluation_mode):
+        evaluations[idx] = evaluation
+        print(f"匹配项 {idx+1} 评估为{'匹配' if evaluation['is_match'] else '不匹配'}")
+        yield {"event": "evaluation", "data": {
+            "index": idx,
+            "organization_id": str(first_thirty[idx]["organization"]["_id"]),
+            "name": str(first_thirty[idx]["organization"].get("Name", "")),
+            "status": evaluation["status"],
+            "cached": bool(evaluation.get("cached", False))
+        }}
+
+    for match, evaluation in zip(first_thirty, evaluations):
+        match["evaluation"] = {"is_match": evaluation["is_match"], "status": evaluation["status"]}
+        if evaluation["is_match"]:
+            evaluated_matches.append(match)
+        else:
+            rejected_matches.append(match)
+        if "error" in evaluation:
+            failed_evaluations += 1
+        if evaluation.get("cached"):
+            cached_evaluations += 1
+
+    # 选择最终的20个匹配
+    print("\n9. 选择最终匹配")
+    final_matches = []
+    supplementary_matches = []
+
+    # 首先添加评估为true的匹配，但不超过20个
+    if len(evaluated_matches) >= 20:
+        final_matches = evaluated_matches[:20]  # 如果accepted超过20个，只取前20个
+        print("从已接受的匹配中选择前20个")
+    else:
+        # 如果accepted不够20个，需要补充
+        final_matches = evaluated_matches.copy()
+        remaining_needed = 20 - len(final_matches)
+        print(f"需要从剩余匹配项中补充 {remaining_needed} 个")
+        for match in remaining_matches[:remaining_needed]:
+            match["evaluation"] = {"is_match": None, "status": "supplementary"}
+            supplementary_matches.append(match)
+        final_matches.extend(supplementary_matches)
+
+    print("\n10. 构建响应")
+    # 在返回响应前修改
+    sanitized_matches = []
+    for match in final_matches:
+        sanitized_match = {
+            "similarity_score": sanitize_float(match["similarity_score"]),
+            "evaluation_status": match["evaluation"]["status"],
+            "organization": match_card(match)
+        }
+        sanitized_match.update(sanitize_match_extras(match))
+        sanitized_matches.append(sanitized_match)
+
+    response = {
+        "status": "success",
+        "process_steps": {
+            "step1_input_organization": build_input_summary(request),
+            "step2_ideal_organization": {
+                "description": str(ideal_org_description)
+            },
+            "step3_generated_tags": {
+                "tags": tag_list,
+                "tags_string": str(tags_string)
+            },
+            "step4_embedding": {
+                "dimension": int(len(tag_embedding))
+            },
+            "step5_matches": {
+                "total_matches_found": int(total_matches),
+                **search_info,
+                "evaluation_summary": {
+                    "evaluation_mode": evaluation_mode,
+                    "total_evaluated": int(len(first_thirty)),
+                    "accepted": int(len(evaluated_matches)),
+                    "rejected": int(len(rejected_matches)),
+                    "failed": int(failed_evaluations),
+                    "cached": int(cached_evaluations),
+                    "supplementary": int(len(supplementary_matches)),
+                    "final_output": 20
                 }
-                evaluated_matches.append(match)
-                print(f"匹配项 {idx+1} 评估为匹配")
-            else:
-                match["evaluation"] = {
-                    "is_match": False, 
-                    "status": "rejected"
+            }
+        },
+        "matching_results": sanitized_matches
+    }
+
+    yield {"event": "result", "data": response}
+
+def run_complex_pipeline(request, collection, documents=None):
+    """完整匹配流程，只返回最终响应"""
+    for event in iter_complex_pipeline(request, collection, documents):
+        if event["event"] == "result":
+            return event["data"]
+
+def run_simple_pipeline(request, collection, documents=None):
+    """简化匹配流程（步骤2-5），请求需已通过验证"""
+    # 2. 直接为 looking for 2 生成嵌入向量
+    print("\n2. 生成嵌入向量")
+    openai.api_key = os.getenv("OPENAI_API_KEY")
+    description_embedding = cached_embedding("text-embedding-ada-002", request["Organization looking 2"])
+
+    # 3. 查找匹配
+    print("\n3. 查找匹配")
+    print(f"使用集合: {collection.name}")
+
+    print("正在从常驻索引中检索匹配项...")
+    # 简化版没有生成标签，hybrid 模式下用同一个查询向量匹配两个字段
+    matches, total_matches, search_info = search_matches(
+        request, collection, "description_embedding",
+        {"description_embedding": description_embedding, "tag_embedding": description_embedding}, 20, documents,
+        query_tokens=tokenize(request["Organization looking 2"]))
+
+    print(f"共处理 {total_matches} 个组织，取前 {len(matches)} 个匹配项")
+
+    # 4. 索引已按相似度排序，直接取前20个
+    print("\n4. 排序并选择前20个匹配项")
+    top_twenty = matches[:20]
+
+    # 5. 使用与完整流程相同的数据清理函数
+    # 清理匹配结果
+    sanitized_matches = []
+    for match in top_twenty:
+        sanitized_match = {
+            "similarity_score": sanitize_float(match["similarity_score"]),
+            "evaluation_status": "simple_match",
+            "organization": match_card(match)
+        }
+        sanitized_match.update(sanitize_match_extras(match))
+        sanitized_matches.append(sanitized_match)
+
+    # 构建新的响应结构，与完整版保持一致
+    response = {
+        "status": "success",
+        "process_steps": {
+            "step1_input_organization": build_input_summary(request),
+            "step2_ideal_organization": {
+                "description": None  # 简化版不生成理想组织
+            },
+            "step3_generated_tags": {
+                "tags": [],          # 简化版不生成标签
+                "tags_string": ""
+            },
+            "step4_embedding": {
+                "dimension": int(len(description_embedding))
+            },
+            "step5_matches": {       # 改为与完整版相同的键名
+                "total_matches_found": int(total_matches),
+                **search_info,
+                "evaluation_summary": {
+                    "total_evaluated": 20,  # 设为20因为我们直接返回前20个
+                    "accepted": 20,         # 简化版将所有返回的匹配视为已接受
+                    "rejected": 0,
+                    "supplementary": 0,
+                    "final_output": 20
                 }
-                rejected_matches.append(match)
-                print(f"匹配项 {idx+1} 评估为不匹配")
-
-        # 选择最终的20个匹配
-        print("\n9. 选择最终匹配")
-        final_matches = []
-        supplementary_matches = []
-
-        # 首先添加评估为true的匹配，但不超过20个
-        if len(evaluated_matches) >= 20:
-            final_matches = evaluated_matches[:20]  # 如果accepted超过20个，只取前20个
-            print("从已接受的匹配中选择前20个")
-        else:
-            # 如果accepted不够20个，需要补充
-            final_matches = evaluated_matches.copy()
-            remaining_needed = 20 - len(final_matches)
-            print(f"需要从剩余匹配项中补充 {remaining_needed} 个")
-            for match in remaining_matches[:remaining_needed]:
-                match["evaluation"] = {"is_match": None, "status": "supplementary"}
-                supplementary_matches.append(match)
-            final_matches.extend(supplementary_matches)
-
-        print("\n10. 构建响应")
-        def sanitize_float(value):
-            """确保浮点数是JSON兼容的"""
-            if isinstance(value, (int, float)):
-                if np.isnan(value) or np.isinf(value):
-                    return 0.0
-                return float(value)
-            return 0.0
-
-        def sanitize_organization_data(org_data):
-            """清理组织数据确保JSON兼容"""
-            return {
-                "id": str(org_data["_id"]),
-                "name": str(org_data.get("Name", "")),
-                "description": str(org_data.get("Description", "")),
-                "mission": str(org_data.get("Mission", "")),
-                "industries": org_data.get("Industries", []),
-                "specialities": org_data.get("Specialities", []),
-                "staff_count": int(org_data.get("Staff_Count", 0)),
-                "assets": sanitize_float(org_data.get("Assets", 0.0)),
-                "narrative": str(org_data.get("Narrative", "")),
-                "tags": org_data.get("Tags", []),
-                "linkedin_followers": int(org_data.get("Linkedin_followers", 0)),
-                "popularity": str(org_data.get("Popularity", "")),
-                "contribution": str(org_data.get("Contribution", "")),
-                "partnership": str(org_data.get("Partnership", "")),
-                "event": str(org_data.get("Event", ""))
             }
+        },
+        "matching_results": sanitized_matches
+    }
 
-        # 在返回响应前修改
-        sanitized_matches = []
-        for match in final_matches:
-            sanitized_match = {
-                "similarity_score": sanitize_float(match["similarity_score"]),
-                "evaluation_status": match["evaluation"]["status"],
-                "organization": sanitize_organization_data(match["organization"])
-            }
-            sanitized_matches.append(sanitized_match)
+    return response
 
-        response = {
-            "status": "success",
-            "process_steps": {
-                "step1_input_organization": {
-                    "name": str(request["Name"]),
-                    "type": str(request["Type"]),
-                    "description": str(request["Description"]),
-                    "mission": str(request["Mission"]),
-                    "industries": request["Industries"],
-                    "specialities": request["Specialities"],
-                    "looking_for": str(request["Organization looking 1"]),
-                    "partnership_description": str(request["Organization looking 2"])
-                },
-                "step2_ideal_organization": {
-                    "description": str(ideal_org_description)
-                },
-                "step3_generated_tags": {
-                    "tags": tag_list,
-                    "tags_string": str(tags_string)
-                },
-                "step4_embedding": {
-                    "dimension": int(len(tag_embedding))
-                },
-                "step5_matches": {
-                    "total_matches_found": int(len(matches)),
-                    "evaluation_summary": {
-                        "total_evaluated": int(len(first_thirty)),
-                        "accepted": int(len(evaluated_matches)),
-                        "rejected": int(len(rejected_matches)),
-                        "supplementary": int(len(supplementary_matches)),
-                        "final_output": 20
-                    }
-                }
-            },
-            "matching_results": sanitized_matches
-        }
-        
+@app.post("/test/complete-matching-process")
+@limit_inflight
+async def complete_matching_process(request: Dict):
+    """整合的匹配流程API"""
+    try:
+        print("\n=== 开始匹配流程 ===")
+        validate_matching_request(request)
+        response = await run_blocking(run_complex_pipeline, request, select_collection(request))
         print("\n=== 匹配流程完成 ===")
-        return response
+        # 响应里已经都是JSON兼容的类型，直接序列化，跳过 jsonable_encoder 的逐层转换
+        return ORJSONResponse(response)
 
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"\n错误: {str(e)}")
         print(f"错误类型: {type(e)}")
@@ -377,171 +650,231 @@ async def complete_matching_process(request: Dict):
             }
         )
 
+MATCHING_ALGORITHMS = ("complex", "simple", "ab")
+
+def run_matching_job(algorithm, request, on_event):
+    """后台任务：按 algorithm 运行匹配流程，on_event 接收完整版流程的每个事件"""
+    collection = select_collection(request)
+    if algorithm == "simple":
+        return run_simple_pipeline(request, collection)
+
+    documents = RequestDocuments()
+    simple = None
+    if algorithm == "ab":
+        # 与 A/B 端点一样两个流程并发运行，共用常驻索引和组织文档缓存
+        get_collection_index(collection)
+        simple = blocking_executor.submit(run_simple_pipeline, request, collection, documents)
+    response = None
+    for event in iter_complex_pipeline(request, collection, documents):
+        on_event(event)
+        if event["event"] == "result":
+            response = event["data"]
+    if simple is None:
+        return response
+    return {
+        "status": "success",
+        "complex": response,
+        "simple": simple.result()
+    }
+
+job_manager = None
+job_manager_lock = threading.Lock()
+
+def get_job_manager():
+    """任务存储默认在内存中；多个 uvicorn worker 时设置 JOB_STORE=mongo 共享任务状态
+
+    在 blocking_executor 的线程中调用，第一次创建时加锁，避免并发提交各自创建一个管理器。
+    """
+    global job_manager
+    if job_manager is None:
+        with job_manager_lock:
+            if job_manager is None:
+                if os.getenv("JOB_STORE", "memory") == "mongo":
+                    store = MongoJobStore(db[os.getenv("JOB_COLLECTION", "MatchingJobs")])
+                else:
+                    store = InMemoryJobStore()
+                job_manager = JobManager(
+                    run_matching_job,
+                    store,
+                    max_workers=int(os.getenv("JOB_WORKERS", "4")),
+                    max_queue=int(os.getenv("JOB_MAX_QUEUE", "20")),
+                    result_ttl=float(os.getenv("JOB_RESULT_TTL", "3600"))
+                )
+    return job_manager
+
+def job_status(job):
+    return {
+        "job_id": job["_id"],
+        "algorithm": job["algorithm"],
+        "status": job["status"],
+        "progress": job["progress"],
+        "error": job["error"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+        "expires_at": job["expires_at"]
+    }
+
+@app.on_event("shutdown")
+def stop_job_workers():
+    if job_manager is not None:
+        job_manager.shutdown()
+
+@app.post("/jobs/matching", status_code=202)
+async def submit_matching_job(request: Dict, algorithm: str = "complex"):
+    """提交匹配任务，立即返回任务ID；之后轮询 /jobs/{job_id} 并从 /jobs/{job_id}/result 取结果"""
+    if algorithm not in MATCHING_ALGORITHMS:
+        raise HTTPException(status_code=400, detail=f"algorithm 必须是 {', '.join(MATCHING_ALGORITHMS)} 之一")
+    validate_matching_request(request)
+    try:
+        job_id = await run_blocking(lambda: get_job_manager().submit(algorithm, request))
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
+    return {
+        "job_id": job_id,
+        "status": "queued",
+        "status_url": f"/jobs/{job_id}",
+        "result_url": f"/jobs/{job_id}/result"
+    }
+
+@app.get("/jobs/stats")
+async def matching_job_stats():
+    """队列深度和工作线程利用率"""
+    return await run_blocking(lambda: get_job_manager().stats())
+
+@app.get("/jobs/{job_id}")
+async def get_matching_job(job_id: str):
+    job = await run_blocking(lambda: get_job_manager().get(job_id))
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在或已过期")
+    return job_status(job)
+
+@app.get("/jobs/{job_id}/result")
+async def get_matching_job_result(job_id: str):
+    """任务完成时返回与同步端点相同的响应；未完成时返回 202 和当前进度"""
+    job = await run_blocking(lambda: get_job_manager().get(job_id))
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在或已过期")
+    if job["status"] == SUCCEEDED:
+        return ORJSONResponse(job["result"])
+    if job["status"] == FAILED:
+        raise HTTPException(
+            status_code=500,
+            detail={
+                "error": job["error"],
+                "step": "matching_job",
+                "message": "匹配过程出错"
+            }
+        )
+    return ORJSONResponse(status_code=202, content=jsonable_encoder(job_status(job)))
+
+@app.post("/test/complete-matching-process-stream")
+async def complete_matching_process_stream(request: Dict):
+    """流式版完整匹配流程：每完成一步就以 NDJSON 返回一行
+
+    依次返回 step1-step4、按相似度排好的前30个候选（step5_candidates）、
+    每个候选的评估结果（evaluation），最后一行是与非流式端点相同的完整响应（result）。
+    """
+    validate_matching_request(request)
+    collection = select_collection(request)
+    # 名额一直占用到流结束；客户端在流开始前断开时由 background 释放
+    await acquire_match_slot()
+    released = False
+
+    def release_slot():
+        nonlocal released
+        if not released:
+            released = True
+            match_slots.release()
+
+    async def stream():
+        print("\n=== 开始流式匹配流程 ===")
+        events = iter_complex_pipeline(request, collection)
+        try:
+            # 每一步在线程池中推进，事件循环只负责发送
+            while True:
+                event = await run_blocking(next, events, None)
+                if event is None:
+                    break
+                yield orjson.dumps(event, default=str) + b"\n"
+            print("\n=== 流式匹配流程完成 ===")
+        except Exception as e:
+            print(f"\n错误: {str(e)}")
+            yield orjson.dumps({
+                "event": "error",
+                "data": {
+                    "error": str(e),
+                    "step": "complete_matching_process_stream",
+                    "message": "匹配过程出错"
+                }
+            }) + b"\n"
+        finally:
+            release_slot()
+
+    # 关闭反向代理的缓冲，保证每一行都能及时送到客户端
+    return StreamingResponse(stream(), media_type="application/x-ndjson",
+                             headers={"X-Accel-Buffering": "no"}, background=BackgroundTask(release_slot))
+
 @app.post("/test/complete-matching-process-simple")
+@limit_inflight
 async def complete_matching_process_simple(request: Dict):
     """简化版匹配流程API - 保持与完整版相同的返回结构"""
     try:
         print("\n=== 开始简化匹配流程 ===")
-        
-        # 1. 验证输入
-        print("\n1. 验证输入字段")
-        required_fields = [
-            "Name", 
-            "Type", 
-            "Description",
-            "Mission",
-            "Industries",
-            "Specialities",
-            "Organization looking 1",
-            "Organization looking 2"
-        ]
-        if not all(field in request for field in required_fields):
-            raise HTTPException(status_code=400, detail="缺少必要字段")
-        print("输入验证成功")
-
-        # 2. 直接为 looking for 2 生成嵌入向量
-        print("\n2. 生成嵌入向量")
-        openai.api_key = os.getenv("OPENAI_API_KEY")
-        embedding_response = openai.Embedding.create(
-            model="text-embedding-ada-002",
-            input=request["Organization looking 2"]
-        )
-        
-        description_embedding = embedding_response["data"][0]["embedding"]
-
-        # 3. 查找匹配
-        print("\n3. 查找匹配")
-        matches = []
-        collection = nonprofit_collection if request["Organization looking 1"].strip().lower() in ["non profit", "nonprofit"] else forprofit_collection
-        print(f"使用集合: {collection.name}")
-        
-        print("正在查询数据库中的匹配项...")
-        query_count = 0
-        for org in collection.find({"description_embedding": {"$exists": True}}):
-            query_count += 1
-            if org.get("description_embedding"):
-                try:
-                    org_embedding = np.frombuffer(org["description_embedding"], dtype=np.float32)
-                    similarity = float(1 - cosine(description_embedding, org_embedding))
-                    
-                    match_result = {
-                        "similarity_score": similarity,
-                        "organization": {
-                            "_id": str(org["_id"]),
-                            "Name": org.get("Name", ""),
-                            "Description": org.get("Description", ""),
-                            "Industries": org.get("Industries", []),
-                            "Specialities": org.get("Specialities", []),
-                            "Staff_Count": org.get("Staff_Count", ""),
-                            "Assets": org.get("Assets", ""),
-                            "Mission": org.get("Mission", ""),
-                            "Narrative": org.get("Narrative", ""),
-                            "Tags": org.get("Tags", []),
-                            "Linkedin_followers": org.get("Linkedin_followers", ""),
-                            "Popularity": org.get("Popularity", ""),
-                            "Partnership": org.get("Partnership", ""),
-                            "Event": org.get("Event", "")
-                        }
-                    }
-                    matches.append(match_result)
-                except Exception as e:
-                    print(f"处理组织 {org.get('_id')} 时出错: {str(e)}")
-                    continue
-
-        print(f"共处理 {query_count} 个组织，找到 {len(matches)} 个匹配项")
-
-        # 4. 按相似度排序并返回前20个
-        print("\n4. 排序并选择前20个匹配项")
-        matches.sort(key=lambda x: x["similarity_score"], reverse=True)
-        top_twenty = matches[:20]
-
-        # 5. 使用与完整流程相同的数据清理函数
-        def sanitize_float(value):
-            """确保浮点数是JSON兼容的"""
-            if isinstance(value, (int, float)):
-                if np.isnan(value) or np.isinf(value):
-                    return 0.0
-                return float(value)
-            return 0.0
-
-        def sanitize_organization_data(org_data):
-            """清理组织数据确保JSON兼容"""
-            return {
-                "id": str(org_data["_id"]),
-                "name": str(org_data.get("Name", "")),
-                "description": str(org_data.get("Description", "")),
-                "mission": str(org_data.get("Mission", "")),
-                "industries": org_data.get("Industries", []),
-                "specialities": org_data.get("Specialities", []),
-                "staff_count": int(org_data.get("Staff_Count", 0)),
-                "assets": sanitize_float(org_data.get("Assets", 0.0)),
-                "narrative": str(org_data.get("Narrative", "")),
-                "tags": org_data.get("Tags", []),
-                "linkedin_followers": int(org_data.get("Linkedin_followers", 0)),
-                "popularity": str(org_data.get("Popularity", "")),
-                "contribution": str(org_data.get("Contribution", "")),
-                "partnership": str(org_data.get("Partnership", "")),
-                "event": str(org_data.get("Event", ""))
-            }
+        validate_matching_request(request)
+        response = await run_blocking(run_simple_pipeline, request, select_collection(request))
+        print("\n=== 简化匹配流程完成 ===")
+        return ORJSONResponse(response)
 
-        # 清理匹配结果
-        sanitized_matches = []
-        for match in top_twenty:
-            sanitized_match = {
-                "similarity_score": sanitize_float(match["similarity_score"]),
-                "evaluation_status": "simple_match",
-                "organization": sanitize_organization_data(match["organization"])
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"\n错误: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail={
+                "error": str(e),
+                "step": "complete_matching_process_simple",
+                "message": "匹配过程出错"
             }
-            sanitized_matches.append(sanitized_match)
+        )
 
-        # 构建新的响应结构，与完整版保持一致
-        response = {
+@app.post("/test/complete-matching-process-ab")
+@limit_inflight
+async def complete_matching_process_ab(request: Dict):
+    """A/B测试用：在一个请求里并发运行完整版和简化版流程
+
+    两个流程共用输入验证、集合选择、常驻索引，以及请求内的组织文档缓存
+    （两边都入选的组织只从数据库读取一次）。返回结构中 complex / simple
+    分别与两个单独端点的响应相同。
+    """
+    try:
+        print("\n=== 开始A/B匹配流程 ===")
+        validate_matching_request(request)
+        collection = select_collection(request)
+        await run_blocking(get_collection_index, collection)
+        documents = RequestDocuments()
+
+        complex_response, simple_response = await asyncio.gather(
+            run_blocking(run_complex_pipeline, request, collection, documents),
+            run_blocking(run_simple_pipeline, request, collection, documents)
+        )
+        print("\n=== A/B匹配流程完成 ===")
+        return ORJSONResponse({
             "status": "success",
-            "process_steps": {
-                "step1_input_organization": {
-                    "name": str(request["Name"]),
-                    "type": str(request["Type"]),
-                    "description": str(request["Description"]),
-                    "mission": str(request["Mission"]),
-                    "industries": request["Industries"],
-                    "specialities": request["Specialities"],
-                    "looking_for": str(request["Organization looking 1"]),
-                    "partnership_description": str(request["Organization looking 2"])
-                },
-                "step2_ideal_organization": {
-                    "description": None  # 简化版不生成理想组织
-                },
-                "step3_generated_tags": {
-                    "tags": [],          # 简化版不生成标签
-                    "tags_string": ""
-                },
-                "step4_embedding": {
-                    "dimension": int(len(description_embedding))
-                },
-                "step5_matches": {       # 改为与完整版相同的键名
-                    "total_matches_found": int(len(matches)),
-                    "evaluation_summary": {
-                        "total_evaluated": 20,  # 设为20因为我们直接返回前20个
-                        "accepted": 20,         # 简化版将所有返回的匹配视为已接受
-                        "rejected": 0,
-                        "supplementary": 0,
-                        "final_output": 20
-                    }
-                }
-            },
-            "matching_results": sanitized_matches
-        }
-        
-        print("\n=== 简化匹配流程完成 ===")
-        return response
+            "complex": complex_response,
+            "simple": simple_response
+        })
 
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"\n错误: {str(e)}")
         raise HTTPException(
             status_code=500,
             detail={
                 "error": str(e),
-                "step": "complete_matching_process_simple",
+                "step": "complete_matching_process_ab",
                 "message": "匹配过程出错"
             }
         )
@@ -0,0 +1,109 @@
+"""内存LRU + 磁盘(SQLite)两级缓存
+
+内存中保留最近使用的 max_memory_items 条，磁盘上最多保留 max_disk_items 条，
+超过 ttl 秒的条目视为过期。LLM结果缓存、嵌入缓存和评估结果缓存共用这个实现。
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class PersistentLRUCache:
+    """键为字符串、值为 bytes 的两级缓存"""
+
+    def __init__(self, name, path, max_memory_items=1000, max_disk_items=100000, ttl=None):
+        self.name = name
+        self.path = path
+        self.max_memory_items = max_memory_items
+        self.max_disk_items = max_disk_items
+        self.ttl = ttl
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes_since_trim = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+        self._db.commit()
+
+    def _expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def get(self, key):
+        """返回缓存的值，没有或已过期时返回 None"""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, created = entry
+                if not self._expired(created):
+                    self._memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return value
+                del self._memory[key]
+
+            row = self._db.execute("SELECT value, created FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None or self._expired(row[1]):
+                self.stats["misses"] += 1
+                return None
+            value, created = bytes(row[0]), row[1]
+            self._db.execute("UPDATE cache SET accessed = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+            self._remember(key, value, created)
+            self.stats["disk_hits"] += 1
+            return value
+
+    def set(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+            self._db.execute(
+                "INSERT OR REPLACE INTO cache (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, value, now, now))
+            self.stats["writes"] += 1
+            self._writes_since_trim += 1
+            # 每写入一批再清理一次磁盘，避免每次写入都做一次计数
+            if self._writes_since_trim >= 100:
+                self._trim_disk()
+            self._db.commit()
+
+    def _remember(self, key, value, created):
+        self._memory[key] = (value, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def _trim_disk(self):
+        """删除过期条目，以及超出 max_disk_items 的最久未使用条目（调用方需持有锁）"""
+        self._writes_since_trim = 0
+        if self.ttl is not None:
+            deleted = self._db.execute("DELETE FROM cache WHERE created < ?", (time.time() - self.ttl,))
+            self.stats["evictions"] += deleted.rowcount
+        count = self._db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        if count > self.max_disk_items:
+            deleted = self._db.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed LIMIT ?)",
+                (count - self.max_disk_items,))
+            self.stats["evictions"] += deleted.rowcount
+
+    def info(self):
+        """命中/未命中计数和当前大小"""
+        with self._lock:
+            disk_items = self._db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+            hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+            lookups = hits + self.stats["misses"]
+            return {
+                **self.stats,
+                "hits": hits,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+                "memory_items": len(self._memory),
+                "disk_items": disk_items
+            }
@@ -0,0 +1,59 @@
+"""查询端 OpenAI 嵌入向量的缓存
+
+文本先做空白归一化，按 (模型名, 文本) 的哈希作键；
+向量以 float32 原始字节存入磁盘，重启后仍然有效。
+"""
+import hashlib
+import os
+import threading
+
+import numpy as np
+import openai
+
+from cache_store import PersistentLRUCache
+
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "1") != "0"
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def normalize_text(text):
+    """合并连续空白并去掉首尾空白"""
+    return " ".join(str(text).split())
+
+
+def get_embedding_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = PersistentLRUCache(
+                "embedding",
+                os.getenv("EMBEDDING_CACHE_PATH", os.path.join("cache", "embedding_cache.sqlite3")),
+                max_memory_items=int(os.getenv("EMBEDDING_CACHE_MEMORY_ITEMS", "2000")),
+                max_disk_items=int(os.getenv("EMBEDDING_CACHE_MAX_ITEMS", "100000"))
+            )
+    return _cache
+
+
+def embedding_cache_key(model, text):
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+def cached_embedding(model, text):
+    """带缓存的 Embedding.create，返回 float32 向量"""
+    text = normalize_text(text)
+    if not EMBEDDING_CACHE_ENABLED:
+        response = openai.Embedding.create(model=model, input=text)
+        return np.asarray(response["data"][0]["embedding"], dtype=np.float32)
+
+    cache = get_embedding_cache()
+    key = embedding_cache_key(model, text)
+    cached = cache.get(key)
+    if cached is not None:
+        return np.frombuffer(cached, dtype=np.float32)
+
+    response = openai.Embedding.create(model=model, input=text)
+    vector = np.asarray(response["data"][0]["embedding"], dtype=np.float32)
+    cache.set(key, vector.tobytes())
+    return vector
@@ -0,0 +1,642 @@
+"""组织嵌入向量的常驻内存索引
+
+每个集合加载一次 tag_embedding / description_embedding，
+存为连续的 float32 矩阵（行已做 L2 归一化）和与之对齐的 _id 数组。
+打分只需要一次矩阵-向量乘法加 np.argpartition 取 top-k。
+"""
+import os
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+from pymongo.errors import PyMongoError
+
+# 参与检索的嵌入字段
+EMBEDDING_FIELDS = ("tag_embedding", "description_embedding")
+
+# embedding_ingest.py 写入的归一化向量字段后缀，例如 tag_embedding_normalized
+NORMALIZED_SUFFIX = "_normalized"
+
+# 过滤后剩下的行少于这个比例时，只对剩下的行打分（再高时按行拷贝比整体乘法更慢）
+FILTERED_SCAN_RATIO = 0.15
+
+# exact: 全量精确扫描（作为召回基准）；ann: IVF-flat 近似检索
+SEARCH_MODES = ("exact", "ann")
+
+
+def embedding_projection(fields=EMBEDDING_FIELDS):
+    """扫描阶段的投影：只读取 _id 和嵌入字段，不传输描述、使命等大段文本"""
+    projection = {field: 1 for field in fields}
+    projection.update({normalized_field(field): 1 for field in fields})
+    return projection
+
+
+def normalize_vector(vector):
+    """把查询向量转成归一化的 float32 数组"""
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    if norm == 0 or not np.isfinite(norm):
+        return vector
+    return vector / norm
+
+
+def top_k_indices(scores, k):
+    """返回得分最高的 k 个下标（按得分降序）"""
+    if k <= 0 or len(scores) == 0:
+        return np.empty(0, dtype=np.int64)
+    if k < len(scores):
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    order = np.argsort(-scores[candidates], kind="stable")
+    return candidates[order]
+
+
+def normalized_field(field):
+    """embedding_ingest.py 写入的归一化向量字段名"""
+    return f"{field}{NORMALIZED_SUFFIX}"
+
+
+def parse_embedding(blob, dim=None):
+    """把二进制blob解码成 float32 向量，长度、维度或数值不合法时抛出 ValueError"""
+    if len(blob) % 4:
+        raise ValueError(f"长度 {len(blob)} 字节不是 float32 的整数倍")
+    vector = np.frombuffer(blob, dtype=np.float32)
+    if dim is not None and len(vector) != dim:
+        raise ValueError(f"维度 {len(vector)} 与 {dim} 不一致")
+    norm = np.linalg.norm(vector)
+    if not np.isfinite(norm):
+        raise ValueError("包含 NaN 或 Inf")
+    if norm == 0:
+        raise ValueError("零向量")
+    return vector
+
+
+def top_k_masked(matrix, query, mask, k):
+    """只在 mask 为 True 的行中取得分最高的 k 行，返回 (行号, 得分)
+
+    过滤后剩下的行较少时只对这些行做乘法，过滤越严格越快；
+    否则整体乘完再屏蔽，避免大范围的花式索引拷贝。
+    """
+    return top_k_weighted([(matrix, query)], mask, k)
+
+
+def top_k_weighted(terms, mask, k):
+    """terms 是 [(矩阵, 已乘权重的查询向量)]，按各项得分之和取 top-k，其余同 top_k_masked"""
+    selected = np.flatnonzero(mask)
+    if len(selected) < len(mask) * FILTERED_SCAN_RATIO:
+        scores = sum(matrix[selected] @ query for matrix, query in terms)
+        top = top_k_indices(scores, k)
+        return selected[top], scores[top]
+    scores = sum(matrix[:len(mask)] @ query for matrix, query in terms)
+    scores[~mask] = -np.inf
+    top = top_k_indices(scores, k)
+    return top, scores[top]
+
+
+def stack_matrices(matrices, capacity):
+    """把各字段矩阵按列拼接成一个 (capacity, Σdim) 数组
+
+    返回 (拼接矩阵, 各字段在其上的列视图, 各字段的列范围)。
+    """
+    layout = {}
+    offset = 0
+    for field, matrix in matrices.items():
+        layout[field] = (offset, offset + matrix.shape[1])
+        offset += matrix.shape[1]
+    stacked = np.zeros((capacity, offset), dtype=np.float32)
+    views = {}
+    for field, (start, end) in layout.items():
+        rows = min(capacity, len(matrices[field]))
+        stacked[:rows, start:end] = matrices[field][:rows]
+        views[field] = stacked[:, start:end]
+    return stacked, views, layout
+
+
+def apply_row_filter(mask, row_filter):
+    """mask &= row_filter；掩码算出之后新增的行不通过过滤"""
+    rows = min(len(mask), len(row_filter))
+    mask[:rows] &= row_filter[:rows]
+    mask[rows:] = False
+
+
+def decode_embedding(blob, dim=None):
+    """把二进制blob解码成归一化的 float32 向量，为空时返回 None"""
+    if not blob:
+        return None
+    vector = parse_embedding(blob, dim)
+    return vector / np.linalg.norm(vector)
+
+
+def document_embedding(org, field, dim=None):
+    """文档中字段的归一化向量，有 <字段>_normalized 时直接使用"""
+    stored = org.get(normalized_field(field))
+    if stored:
+        return parse_embedding(stored, dim)
+    return decode_embedding(org.get(field), dim)
+
+
+class CollectionIndex:
+    """单个集合的嵌入矩阵
+
+    所有字段共用同一套行号：ids[i] 对应每个字段矩阵的第 i 行，
+    某个字段缺失或格式错误时 valid[field][i] 为 False，这一行的向量为0。
+    从数据库加载和共享内存映射的索引只有一个按列拼接的矩阵，各字段矩阵是它的列视图；
+    快照映射的索引每个字段是独立的文件。
+    删除的行只做墓碑标记（ids 置为 None、valid 全部清零），
+    之后插入的组织会复用这些空行，矩阵不需要整体重建。
+    """
+
+    def __init__(self, name, ids, matrices, valid, row_of=None, free_rows=None, size=None):
+        self.name = name
+        self.ids = ids
+        self.matrices = matrices
+        self.valid = valid
+        # 已使用的行数；快照在末尾预留了空行，之后的插入先用空行，不需要扩容
+        self.size = len(ids) if size is None else size
+        self.generation = 0
+        # 共享内存索引传入只读的 row_of，不在每个 worker 里遍历 ids 建字典
+        if row_of is None:
+            row_of = {org_id: row for row, org_id in enumerate(ids[:self.size]) if org_id is not None}
+        if free_rows is None:
+            free_rows = [row for row, org_id in enumerate(ids[:self.size]) if org_id is None]
+        self._row_of = row_of
+        self._free_rows = free_rows
+        self._lock = threading.Lock()
+        # 每个字段的 IVF-flat 近似索引，在后台线程中构建，建好之前 ANN 模式使用精确扫描
+        self.ann = {}
+        # 正在后台构建 IVF 的字段 -> 构建期间改写过的行
+        self._ann_building = {}
+        # 各字段按列拼接的矩阵（matrices 是它的列视图），快照映射的索引为 None
+        self._stacked = None
+        self._stacked_layout = None
+        # 与行对齐的附属索引：元数据过滤用的列式数组和 BM25 倒排索引
+        self.metadata = None
+        self.lexical = None
+        # 从共享内存映射的只读索引（shared_index.SharedAttachment），由发布进程负责更新
+        self.shared = None
+        # 开始从数据库读取之前的集群时间和本机 UTC 时间（快照为写快照时），
+        # 增量同步从这里开始，读取期间的写入不会丢失
+        self.load_operation_time = None
+        self.loaded_at = None
+        # {_id: 最后一次变更后的 generation}，发布到共享内存时才开启，worker 据此只更新变了的组织
+        self.change_log = None
+        self._aligned_lock = threading.Lock()
+        self._ann_lock = threading.Lock()
+
+    @classmethod
+    def from_collection(cls, collection, fields=EMBEDDING_FIELDS):
+        """从MongoDB集合一次性读取所有嵌入向量
+
+        已经用 embedding_ingest.py 写入 <字段>_normalized 的文档直接读取归一化向量，
+        其余文档再读取原始字段。格式错误的向量只汇总计数，详情用
+        python embedding_ingest.py --check 查看。
+        """
+        ids = []
+        row_of = {}
+        vectors = {field: {} for field in fields}
+        dims = {field: None for field in fields}
+        malformed = 0
+
+        for field in fields:
+            stored = normalized_field(field)
+            sources = (
+                (stored, {stored: {"$exists": True}}),
+                (field, {stored: {"$exists": False}, field: {"$exists": True}})
+            )
+            for source, query in sources:
+                for org in collection.find(query, {source: 1}):
+                    blob = org.get(source)
+                    if not blob:
+                        continue
+                    try:
+                        vector = parse_embedding(blob, dims[field])
+                    except ValueError:
+                        malformed += 1
+                        continue
+                    dims[field] = len(vector)
+                    if org["_id"] not in row_of:
+                        row_of[org["_id"]] = len(ids)
+                        ids.append(org["_id"])
+                    vectors[field][org["_id"]] = (vector, source == field)
+
+        if malformed:
+            print(f"集合 {collection.name} 有 {malformed} 个嵌入向量格式错误，已忽略")
+
+        # 直接写入拼接矩阵，各字段矩阵是它的列视图，不另存一份
+        stacked, matrices, layout = stack_matrices(
+            {field: np.zeros((0, dims[field] or 0), dtype=np.float32) for field in fields}, len(ids))
+        valid = {}
+        for field in fields:
+            matrix = matrices[field]
+            mask = np.zeros(len(ids), dtype=bool)
+            raw = np.zeros(len(ids), dtype=bool)
+            for org_id, (vector, is_raw) in vectors[field].items():
+                row = row_of[org_id]
+                matrix[row] = vector
+                mask[row] = True
+                raw[row] = is_raw
+            # 只有原始字段需要归一化
+            matrix[raw] /= np.linalg.norm(matrix[raw], axis=1)[:, None]
+            valid[field] = mask
+
+        id_array = np.empty(len(ids), dtype=object)
+        id_array[:] = ids
+        index = cls(collection.name, id_array, matrices, valid)
+        index._stacked, index._stacked_layout = stacked, layout
+        return index
+
+    def __len__(self):
+        return len(self._row_of)
+
+    def __contains__(self, org_id):
+        return org_id in self._row_of
+
+    def document_ids(self):
+        """当前索引中所有组织的 _id"""
+        with self._lock:
+            return list(self._row_of)
+
+    def count(self, field, row_filter=None):
+        """该字段有有效向量（且通过 row_filter）的组织数量"""
+        return self.count_any([field], row_filter)
+
+    def count_any(self, fields, row_filter=None):
+        """至少一个字段有有效向量（且通过 row_filter）的组织数量"""
+        size = self.size
+        mask = np.zeros(size, dtype=bool)
+        for field in fields:
+            mask |= self.valid[field][:size]
+        if row_filter is not None:
+            apply_row_filter(mask, row_filter)
+        return int(mask.sum())
+
+    def dimension(self, field):
+        return int(self.matrices[field].shape[1])
+
+    def search(self, field, query_vector, k, mode="exact", n_probe=None, row_filter=None):
+        """返回 [(_id, similarity), ...]，按余弦相似度降序
+
+        mode="exact" 扫描全部行；mode="ann" 只扫描 IVF 最近的 n_probe 个列表。
+        row_filter 是按行的布尔掩码（见 filter_mask），在取 top-k 之前生效。
+        IVF 先选列表再过滤，过滤严格时候选会不足 k 个：通过过滤的行少于
+        FILTERED_SCAN_RATIO 时直接精确扫描这些行，ANN 返回不足 k 个时也改为精确扫描。
+        IVF 还没建好时同样使用精确扫描。
+        """
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"未知的检索模式: {mode}")
+        with self._lock:
+            size = self.size
+            ids = self.ids
+            matrix = self.matrices[field]
+            mask = self.valid[field][:size].copy()
+
+        if row_filter is not None:
+            apply_row_filter(mask, row_filter)
+        if not mask.any():
+            return []
+        query = normalize_vector(query_vector)
+        if matrix.shape[1] != len(query):
+            raise ValueError(f"查询向量维度 {len(query)} 与 {field} 维度 {matrix.shape[1]} 不一致")
+
+        selected = int(mask.sum())
+        k = min(k, selected)
+        if mode == "ann" and (row_filter is None or selected >= size * FILTERED_SCAN_RATIO):
+            ivf = self.ann_index(field)
+            if ivf is not None:
+                n_probe = n_probe or int(os.getenv("ANN_NPROBE", "32"))
+                rows, scores = ivf.search(matrix[:size], mask, query, k, n_probe)
+                if len(rows) >= k:
+                    return [(ids[row], float(score)) for row, score in zip(rows, scores)]
+
+        rows, scores = top_k_masked(matrix, query, mask, k)
+        return [(ids[row], float(score)) for row, score in zip(rows, scores)]
+
+    def search_hybrid(self, query_vectors, weights, k, row_filter=None):
+        """多字段加权检索，返回 [(_id, score, {field: sub_score}), ...]
+
+        score = Σ w·cos / Σ w，缺少某个字段的组织在该字段上记0分。各字段矩阵是同一个
+        拼接矩阵的列视图时，查询向量按权重拼接，一次矩阵-向量乘法算出加权得分；
+        快照映射的索引逐字段相乘再求和，不为拼接复制映射的文件。
+        只对 top-k 行再计算每个字段的子得分（缺少该字段时为 None）。
+        """
+        fields = [field for field in self.matrices if weights.get(field, 0) > 0]
+        if not fields:
+            raise ValueError("至少需要一个权重大于0的嵌入字段")
+        total_weight = sum(weights[field] for field in fields)
+
+        with self._lock:
+            stacked, layout = self._stacked, self._stacked_layout
+            matrices = {field: self.matrices[field] for field in fields}
+            size = self.size
+            ids = self.ids
+            valid = {field: self.valid[field][:size].copy() for field in fields}
+
+        mask = np.zeros(size, dtype=bool)
+        for field in fields:
+            mask |= valid[field]
+        if row_filter is not None:
+            apply_row_filter(mask, row_filter)
+        if not mask.any():
+            return []
+
+        queries = {}
+        for field in fields:
+            query = normalize_vector(query_vectors[field])
+            if matrices[field].shape[1] != len(query):
+                raise ValueError(f"查询向量维度 {len(query)} 与 {field} 维度 {matrices[field].shape[1]} 不一致")
+            queries[field] = query
+
+        k = min(k, int(mask.sum()))
+        if stacked is not None:
+            fused = np.zeros(stacked.shape[1], dtype=np.float32)
+            for field in fields:
+                start, end = layout[field]
+                fused[start:end] = queries[field] * (weights[field] / total_weight)
+            top = top_k_masked(stacked, fused, mask, k)
+        else:
+            top = top_k_weighted([(matrices[field], queries[field] * (weights[field] / total_weight))
+                                  for field in fields], mask, k)
+
+        results = []
+        for i, score in zip(*top):
+            sub_scores = {field: float(matrices[field][i] @ queries[field]) if valid[field][i] else None
+                          for field in fields}
+            results.append((ids[i], float(score), sub_scores))
+        return results
+
+    def filter_mask(self, collection, expression):
+        """把元数据过滤表达式转换成按行的布尔掩码"""
+        return self.metadata_columns(collection).mask(expression, self.size)
+
+    def metadata_columns(self, collection):
+        """与行对齐的列式元数据，第一次按元数据过滤时从数据库读取"""
+        from metadata_index import FILTER_FIELDS, MetadataColumns
+        return self._aligned_index("metadata", collection, MetadataColumns, FILTER_FIELDS)
+
+    def lexical_index(self, collection):
+        """与行对齐的 Tags / Specialities BM25 索引，第一次使用时从数据库读取"""
+        from lexical_index import LEXICAL_FIELDS, LexicalIndex
+        return self._aligned_index("lexical", collection, LexicalIndex, LEXICAL_FIELDS)
+
+    def _aligned_index(self, attribute, collection, index_class, fields):
+        """构建与行对齐的附属索引（metadata / lexical），之后随 upsert_document 增量维护"""
+        if getattr(self, attribute) is None:
+            with self._aligned_lock:
+                if getattr(self, attribute) is None:
+                    with self._lock:
+                        row_of = dict(self._row_of)
+                        capacity = len(self.ids)
+                    aligned = index_class.from_collection(collection, row_of, capacity)
+                    with self._lock:
+                        # 之后的增量更新直接写入附属索引，读取期间变动过的行在下面补上
+                        changed = {org_id: row for org_id, row in self._row_of.items() if row_of.get(org_id) != row}
+                        setattr(self, attribute, aligned)
+                    if changed:
+                        for org in collection.find({"_id": {"$in": list(changed)}}, {field: 1 for field in fields}):
+                            aligned.set_row(changed[org["_id"]], org)
+        return getattr(self, attribute)
+
+    def search_lexical(self, collection, tokens, k, row_filter=None):
+        """按 Tags / Specialities 的 BM25 得分返回 [(_id, score), ...]"""
+        with self._lock:
+            size = self.size
+            ids = self.ids
+            mask = np.zeros(size, dtype=bool)
+            for valid in self.valid.values():
+                mask |= valid[:size]
+        if row_filter is not None:
+            apply_row_filter(mask, row_filter)
+        rows, scores = self.lexical_index(collection).search(tokens, k, mask)
+        return [(ids[row], float(score)) for row, score in zip(rows, scores)]
+
+    def row_mask(self, org_ids):
+        """只有给定组织所在行为 True 的掩码"""
+        mask = np.zeros(self.size, dtype=bool)
+        rows = [self._row_of[org_id] for org_id in org_ids if org_id in self._row_of]
+        mask[rows] = True
+        return mask
+
+    def _stacked_matrix(self):
+        """所有字段按列拼接的矩阵和每个字段的列范围（调用方需持有锁）
+
+        快照映射的索引在这里转换成拼接矩阵，各字段矩阵随之换成它的列视图，不保留两份。
+        """
+        if self._stacked is None:
+            self._stacked, self.matrices, self._stacked_layout = stack_matrices(self.matrices, len(self.ids))
+        return self._stacked, self._stacked_layout
+
+    def ann_index(self, field):
+        """返回字段的 IVF 索引，还没建好时返回 None
+
+        第一次使用、或构建之后改写的行超过 max(100, N/10) 时在后台线程中（重新）构建，
+        期间请求继续使用旧索引或精确扫描，不会等待 k-means。
+        """
+        ivf = self.ann.get(field)
+        if ivf is None or ivf.pending(self.size) > max(100, len(self) // 10):
+            self._build_ann_in_background(field)
+        return ivf
+
+    def _build_ann_in_background(self, field):
+        with self._ann_lock:
+            if field in self._ann_building:
+                return
+            with self._lock:
+                matrix = self.matrices[field]
+                mask = self.valid[field][:self.size].copy()
+                changed = self._ann_building[field] = []
+        threading.Thread(target=self._build_ann, args=(field, matrix, mask, changed),
+                         name=f"ivf-{self.name}-{field}", daemon=True).start()
+
+    def _build_ann(self, field, matrix, mask, changed):
+        from ann_index import IVFFlatIndex
+        try:
+            print(f"正在后台为集合 {self.name} 的 {field} 构建 IVF 索引...")
+            ivf = IVFFlatIndex.build(matrix[:len(mask)], mask)
+            with self._lock:
+                # 构建期间改写的行可能读到了一半，之后总是重新打分
+                ivf.mark_changed(changed)
+                self.ann[field] = ivf
+            print(f"集合 {self.name} 的 {field} IVF 索引构建完成: {len(ivf.centroids)} 个列表")
+        except Exception as e:
+            print(f"构建集合 {self.name} 的 {field} IVF 索引失败: {e}")
+        finally:
+            with self._lock:
+                self._ann_building.pop(field, None)
+
+    def upsert_document(self, org):
+        """按行插入或更新单个组织的嵌入向量"""
+        vectors = {}
+        for field in self.matrices:
+            try:
+                vectors[field] = document_embedding(org, field, self.dimension(field) or None)
+            except ValueError:
+                vectors[field] = None
+
+        if all(vector is None for vector in vectors.values()):
+            self.remove(org["_id"])
+            return
+
+        with self._lock:
+            row = self._row_of.get(org["_id"])
+            if row is None:
+                row = self._allocate_row()
+                self.ids[row] = org["_id"]
+                self._row_of[org["_id"]] = row
+            for aligned in (self.metadata, self.lexical):
+                if aligned is not None:
+                    aligned.set_row(row, org)
+            for field, vector in vectors.items():
+                if vector is None:
+                    self.valid[field][row] = False
+                    # 缺少的字段在多字段检索中记0分
+                    self.matrices[field][row] = 0
+                    continue
+                if self.dimension(field) == 0:
+                    # 加载时还没有任何向量的字段，现在才知道维度
+                    self.matrices[field] = np.zeros((len(self.ids), len(vector)), dtype=np.float32)
+                    if self._stacked is not None:
+                        self._stacked, self.matrices, self._stacked_layout = stack_matrices(self.matrices, len(self.ids))
+                self.matrices[field][row] = vector
+                self.valid[field][row] = True
+            # 这一行可能不在 IVF 中正确的列表里（复用的墓碑行、移动过的向量），之后总是参与打分
+            for ivf in self.ann.values():
+                ivf.mark_changed([row])
+            for changed in self._ann_building.values():
+                changed.append(row)
+            self.generation += 1
+            if self.change_log is not None:
+                self.change_log[org["_id"]] = self.generation
+
+    def remove(self, org_id):
+        """给组织对应的行打上墓碑，空行留给之后的插入复用"""
+        with self._lock:
+            row = self._row_of.pop(org_id, None)
+            if row is None:
+                return
+            self.ids[row] = None
+            for field in self.valid:
+                self.valid[field][row] = False
+            self._free_rows.append(row)
+            self.generation += 1
+            if self.change_log is not None:
+                self.change_log[org_id] = self.generation
+
+    def _allocate_row(self):
+        """优先复用墓碑行，没有空行时按1.5倍扩容（调用方需持有锁）"""
+        if self._free_rows:
+            return self._free_rows.pop()
+        if self.size == len(self.ids):
+            capacity = max(16, int(len(self.ids) * 1.5))
+            ids = np.empty(capacity, dtype=object)
+            ids[:self.size] = self.ids[:self.size]
+            self.ids = ids
+            if self._stacked is not None:
+                self._stacked, self.matrices, self._stacked_layout = stack_matrices(self.matrices, capacity)
+            for field, matrix in self.matrices.items():
+                if len(matrix) < capacity:
+                    grown = np.zeros((capacity, matrix.shape[1]), dtype=np.float32)
+                    grown[:self.size] = matrix[:self.size]
+                    self.matrices[field] = grown
+                mask = np.zeros(capacity, dtype=bool)
+                mask[:self.size] = self.valid[field][:self.size]
+                self.valid[field] = mask
+        row = self.size
+        self.size += 1
+        return row
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+# 正在后台映射共享内存的集合，以及各自加载的索引下一次尝试映射的时间
+_refreshing = set()
+_attach_retry_at = {}
+
+
+def _load_index(collection):
+    """优先映射发布进程的共享内存或磁盘快照，都不可用时从数据库读取"""
+    prefix = os.getenv("SHARED_INDEX_PREFIX")
+    if prefix:
+        from shared_index import attach_index
+        try:
+            index = attach_index(collection.name, prefix, float(os.getenv("SHARED_INDEX_CHECK_SECONDS", "5")))
+            if index is not None:
+                print(f"已映射集合 {collection.name} 的共享内存索引（第 {index.shared.generation} 代）")
+                return index
+            print(f"集合 {collection.name} 的共享内存索引尚未发布，改为各自加载")
+        except Exception as e:
+            print(f"映射集合 {collection.name} 的共享内存索引失败: {e}")
+    snapshot_dir = os.getenv("EMBEDDING_SNAPSHOT_DIR")
+    if snapshot_dir:
+        from embedding_snapshot import load_snapshot
+        try:
+            index = load_snapshot(collection, snapshot_dir)
+            if index is not None:
+                print(f"已从快照映射集合 {collection.name} 的嵌入索引")
+                return index
+        except Exception as e:
+            print(f"读取集合 {collection.name} 的快照失败: {e}")
+    print(f"正在从数据库加载集合 {collection.name} 的嵌入索引...")
+    return CollectionIndex.from_collection(collection)
+
+
+def cluster_operation_time(collection):
+    """副本集当前的操作时间（change stream 的起点）；单机 mongod 没有，返回 None"""
+    try:
+        return collection.database.command("ping").get("operationTime")
+    except PyMongoError:
+        return None
+
+
+def get_collection_index(collection):
+    """获取集合的常驻索引，第一次使用时从数据库加载"""
+    index = _indexes.get(collection.name)
+    if index is None:
+        with _indexes_lock:
+            index = _indexes.get(collection.name)
+            if index is None:
+                operation_time, loaded_at = cluster_operation_time(collection), datetime.utcnow()
+                index = _load_index(collection)
+                if index.loaded_at is None:
+                    # 快照自带写快照时的同步起点，其余情况从这次读取开始
+                    index.load_operation_time, index.loaded_at = operation_time, loaded_at
+                _indexes[collection.name] = index
+                print(f"集合 {collection.name} 索引加载完成，共 {len(index.ids)} 个组织")
+    prefix = os.getenv("SHARED_INDEX_PREFIX")
+    if index.shared is not None:
+        if index.shared.stale():
+            _refresh_in_background(collection, index, prefix)
+    elif prefix:
+        # worker 比发布进程先启动时先用自己加载（并自己同步）的索引，定期再尝试映射
+        now = time.monotonic()
+        if now >= _attach_retry_at.get(collection.name, 0):
+            _attach_retry_at[collection.name] = now + float(os.getenv("SHARED_INDEX_CHECK_SECONDS", "5"))
+            _refresh_in_background(collection, index, prefix)
+    return index
+
+
+def _refresh_in_background(collection, index, prefix):
+    """在后台线程中映射新代数，换好之前请求继续使用当前索引"""
+    with _indexes_lock:
+        if collection.name in _refreshing:
+            return
+        _refreshing.add(collection.name)
+    threading.Thread(target=_refresh_shared, args=(collection, index, prefix),
+                     name=f"shared-index-{collection.name}", daemon=True).start()
+
+
+def _refresh_shared(collection, index, prefix):
+    from shared_index import refresh_index
+    try:
+        refreshed = refresh_index(index, collection, prefix, float(os.getenv("SHARED_INDEX_CHECK_SECONDS", "5")))
+        if refreshed is not None:
+            with _indexes_lock:
+                if _indexes.get(collection.name) is index:
+                    # 旧索引在进行中的请求结束后释放
+                    _indexes[collection.name] = refreshed
+    except Exception as e:
+        print(f"映射集合 {collection.name} 的共享内存索引失败: {e}")
+    finally:
+        with _indexes_lock:
+            _refreshing.discard(collection.name)
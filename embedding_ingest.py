@@ -0,0 +1,133 @@
+"""检查组织嵌入向量，并写入归一化后的副本
+
+对每个嵌入字段，校验原始blob（字节长度、维度、NaN/Inf、零向量），
+把 L2 归一化后的 float32 向量写入 <字段>_normalized，
+并在 embedding_meta.<字段> 中记录维度、数据类型和模型名。
+常驻索引优先读取归一化字段，加载时不再需要逐个计算范数。
+
+格式错误的文档会逐条列出，已有的归一化副本会被删除。
+
+用法:
+    python embedding_ingest.py                   # 只处理还没有归一化副本的文档
+    python embedding_ingest.py --all             # 原始向量更新过时重新生成全部副本
+    python embedding_ingest.py --check --report malformed.jsonl
+"""
+import argparse
+import json
+import os
+from datetime import datetime
+
+import numpy as np
+from bson.binary import Binary
+from pymongo import UpdateOne
+
+from embedding_index import EMBEDDING_FIELDS, normalized_field, parse_embedding
+
+DEFAULT_MODEL = "text-embedding-ada-002"
+
+
+def ingest_collection(collection, model=DEFAULT_MODEL, dim=None, rewrite=False,
+                      check_only=False, batch_size=500):
+    """处理一个集合，返回 (统计, 格式错误列表)"""
+    stats = {"scanned": 0, "written": 0, "malformed": 0}
+    malformed = []
+
+    for field in EMBEDDING_FIELDS:
+        stored = normalized_field(field)
+        query = {field: {"$exists": True}}
+        if not rewrite and not check_only:
+            query[stored] = {"$exists": False}
+        expected_dim = dim
+        if expected_dim is None and not rewrite:
+            # 增量运行时沿用已写入副本的维度，避免只看到格式错误的向量
+            meta_field = f"embedding_meta.{field}.dim"
+            existing = collection.find_one({meta_field: {"$exists": True}}, {meta_field: 1})
+            if existing:
+                expected_dim = existing["embedding_meta"][field]["dim"]
+        operations = []
+
+        for org in collection.find(query, {field: 1}):
+            stats["scanned"] += 1
+            blob = org.get(field)
+            try:
+                if not blob:
+                    raise ValueError("空向量")
+                vector = parse_embedding(blob, expected_dim)
+            except ValueError as e:
+                stats["malformed"] += 1
+                malformed.append({"collection": collection.name, "_id": str(org["_id"]),
+                                  "field": field, "error": str(e)})
+                operations.append(UpdateOne({"_id": org["_id"]},
+                                            {"$unset": {stored: "", f"embedding_meta.{field}": ""}}))
+            else:
+                # 没有指定 --dim 时以第一个合法向量的维度为准，和常驻索引一致
+                expected_dim = len(vector)
+                normalized = (vector / np.linalg.norm(vector)).astype(np.float32)
+                if not check_only:
+                    stats["written"] += 1
+                operations.append(UpdateOne({"_id": org["_id"]}, {"$set": {
+                    stored: Binary(normalized.tobytes()),
+                    f"embedding_meta.{field}": {
+                        "dim": len(vector),
+                        "dtype": "float32",
+                        "model": model,
+                        "normalized": True,
+                        "updated_at": datetime.utcnow()
+                    }
+                }}))
+
+            if len(operations) >= batch_size:
+                _flush(collection, operations, check_only)
+        _flush(collection, operations, check_only)
+
+    return stats, malformed
+
+
+def _flush(collection, operations, check_only):
+    if operations and not check_only:
+        collection.bulk_write(operations, ordered=False)
+    operations.clear()
+
+
+def main():
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="校验组织嵌入向量并写入归一化副本")
+    parser.add_argument("--collection", action="append",
+                        help="集合名，可重复；默认处理非营利和营利两个集合")
+    parser.add_argument("--model", default=DEFAULT_MODEL, help="生成这些向量的嵌入模型")
+    parser.add_argument("--dim", type=int, help="期望的向量维度；默认取第一个合法向量的维度")
+    parser.add_argument("--all", action="store_true", help="重新生成所有文档的归一化副本")
+    parser.add_argument("--check", action="store_true", help="只检查并报告格式错误，不写数据库")
+    parser.add_argument("--batch-size", type=int, default=500, help="每次 bulk_write 的文档数")
+    parser.add_argument("--report", help="把格式错误的文档写成 JSON Lines 文件")
+    args = parser.parse_args()
+
+    client = MongoClient(os.getenv("MONGODB_URI"))
+    db = client[os.getenv("MONGODB_DB_NAME")]
+    collections = args.collection or [
+        os.getenv("MONGODB_COLLECTION_NONPROFIT"),
+        os.getenv("MONGODB_COLLECTION_FORPROFIT")
+    ]
+
+    all_malformed = []
+    for name in collections:
+        stats, malformed = ingest_collection(db[name], model=args.model, dim=args.dim, rewrite=args.all,
+                                             check_only=args.check, batch_size=args.batch_size)
+        for entry in malformed:
+            print(f"{entry['collection']} {entry['_id']} {entry['field']}: {entry['error']}")
+        print(f"集合 {name}: 扫描 {stats['scanned']} 个向量，写入 {stats['written']} 个，"
+              f"格式错误 {stats['malformed']} 个")
+        all_malformed.extend(malformed)
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            for entry in all_malformed:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+"""为新增组织批量生成嵌入向量
+
+找出缺少 tag_embedding / description_embedding，或 embedding_meta 中记录的模型
+与当前模型不一致的文档，把文本按批合并成多输入的 Embedding.create 请求，
+结果连同归一化副本（见 embedding_ingest.py）一起用 bulk_write 写回。
+
+每个字段按 _id 顺序处理。所有已完成批次之前的最大 _id 会写入检查点文件，
+中断后重新运行会从检查点继续。--provider fake 使用本地确定性的假向量，
+配合本地 mongod 可以在不调用 OpenAI 的情况下测试整条流程。
+
+用法:
+    python embedding_pipeline.py --concurrency 4 --batch-size 256
+    MONGODB_URI=mongodb://localhost:27017 python embedding_pipeline.py --provider fake
+"""
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+
+import numpy as np
+import openai
+from bson.binary import Binary
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, UpdateOne
+
+from embedding_cache import normalize_text
+from embedding_index import normalized_field
+from embedding_ingest import DEFAULT_MODEL
+
+# 每个嵌入字段由哪个文本字段生成
+EMBEDDING_SOURCES = {
+    "tag_embedding": "Tags",
+    "description_embedding": "Description"
+}
+
+# 单条输入的字符上限，超出部分截断（模型上限约 8191 token）
+MAX_INPUT_CHARS = 20000
+
+
+class OpenAIEmbeddingProvider:
+    """一次请求发送多条输入"""
+
+    def __init__(self, model, max_retries=5):
+        self.model = model
+        self.max_retries = max_retries
+        openai.api_key = os.getenv("OPENAI_API_KEY")
+
+    def embed(self, texts):
+        """返回 (float32 矩阵, 消耗的 token 数)"""
+        for attempt in range(self.max_retries):
+            try:
+                response = openai.Embedding.create(model=self.model, input=texts)
+                break
+            except Exception as e:
+                if attempt == self.max_retries - 1:
+                    raise
+                delay = 2 ** attempt
+                print(f"嵌入请求失败，{delay} 秒后重试: {e}")
+                time.sleep(delay)
+        data = sorted(response["data"], key=lambda item: item["index"])
+        vectors = np.asarray([item["embedding"] for item in data], dtype=np.float32)
+        return vectors, response.get("usage", {}).get("total_tokens", 0)
+
+
+class FakeEmbeddingProvider:
+    """本地测试用：由文本哈希生成确定性的向量，可以模拟请求延迟"""
+
+    def __init__(self, model, dim=1536, latency=0.0):
+        self.model = model
+        self.dim = dim
+        self.latency = latency
+
+    def embed(self, texts):
+        if self.latency:
+            time.sleep(self.latency)
+        vectors = np.empty((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            seed = int.from_bytes(hashlib.sha256(f"{self.model}\0{text}".encode("utf-8")).digest()[:8], "little")
+            vectors[i] = np.random.default_rng(seed).standard_normal(self.dim)
+        return vectors, sum(len(text) // 4 for text in texts)
+
+
+def source_text(org, source):
+    value = org.get(source)
+    if isinstance(value, list):
+        value = ", ".join(str(item) for item in value)
+    return normalize_text(value)[:MAX_INPUT_CHARS] if value else ""
+
+
+def pending_query(field, model, force=False):
+    """需要生成嵌入的文档：没有该字段，或记录的模型与当前模型不一致
+
+    没有 embedding_meta 的旧向量视为当前模型生成的，先运行 embedding_ingest.py 补上元数据。
+    """
+    source = EMBEDDING_SOURCES[field]
+    query = {source: {"$nin": [None, "", []]}}
+    if not force:
+        query["$or"] = [
+            {field: {"$exists": False}},
+            {f"embedding_meta.{field}.model": {"$exists": True, "$ne": model}}
+        ]
+    return query
+
+
+class Checkpoint:
+    """每个 (集合, 字段) 已处理到的 _id，写在 JSON 文件里"""
+
+    def __init__(self, path):
+        self.path = path
+        self.state = {}
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.state = json.load(f)
+
+    def get(self, collection_name, field):
+        value = self.state.get(collection_name, {}).get(field)
+        if value and value.get("type") == "objectid":
+            return ObjectId(value["id"])
+        return value["id"] if value else None
+
+    def set(self, collection_name, field, org_id):
+        value = {"type": "objectid" if isinstance(org_id, ObjectId) else "str", "id": str(org_id)}
+        self.state.setdefault(collection_name, {})[field] = value
+        if self.path:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.state, f)
+            os.replace(tmp_path, self.path)
+
+    def clear(self, collection_name, field):
+        if self.state.get(collection_name, {}).pop(field, None) is not None and self.path:
+            with open(self.path, "w", encoding="utf-8") as f:
+                json.dump(self.state, f)
+
+
+class EmbeddingPipeline:
+    def __init__(self, provider, model, checkpoint, batch_size=256, concurrency=4):
+        self.provider = provider
+        self.model = model
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.stats = {"documents": 0, "batches": 0, "failed_batches": 0, "tokens": 0}
+        self._lock = threading.Lock()
+
+    def run(self, collection, field, force=False, restart=False):
+        """处理一个集合的一个字段；所有批次成功时清除检查点"""
+        if restart:
+            self.checkpoint.clear(collection.name, field)
+        query = pending_query(field, self.model, force)
+        resume_after = self.checkpoint.get(collection.name, field)
+        if resume_after is not None:
+            query["_id"] = {"$gt": resume_after}
+            print(f"集合 {collection.name} 的 {field} 从 {resume_after} 之后继续")
+
+        source = EMBEDDING_SOURCES[field]
+        cursor = collection.find(query, {source: 1}).sort("_id", ASCENDING)
+        started = time.monotonic()
+        with self._lock:
+            before = dict(self.stats)
+        # 批次按顺序编号，只有之前的批次全部完成时才推进检查点；
+        # 失败批次之后的文档在下次运行时会重新处理
+        in_flight = {}
+        last_ids = {}
+        done = set()
+        watermark = 0
+        failed = False
+
+        def collect():
+            nonlocal watermark, failed
+            failed |= self._collect(in_flight, done)
+            advanced = watermark
+            while advanced + 1 in done:
+                advanced += 1
+            if advanced != watermark:
+                watermark = advanced
+                self.checkpoint.set(collection.name, field, last_ids[watermark])
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for number, batch in enumerate(self._batches(cursor, source), start=1):
+                # 最多 2×concurrency 个批次在途，防止游标读得比请求快时积压内存
+                while len(in_flight) >= 2 * self.concurrency:
+                    collect()
+                last_ids[number] = batch[-1][0]
+                in_flight[executor.submit(self._process, collection, field, batch)] = number
+            while in_flight:
+                collect()
+
+        if not failed:
+            self.checkpoint.clear(collection.name, field)
+        self.report(f"{collection.name}.{field}", started, before)
+        return not failed
+
+    def _batches(self, cursor, source):
+        batch = []
+        for org in cursor:
+            text = source_text(org, source)
+            if text:
+                batch.append((org["_id"], text))
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _collect(self, in_flight, done):
+        """等待至少一个批次完成，返回是否有批次失败"""
+        finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        failed = False
+        for future in finished:
+            number = in_flight.pop(future)
+            try:
+                future.result()
+                done.add(number)
+            except Exception as e:
+                print(f"第 {number} 批失败: {e}")
+                failed = True
+                with self._lock:
+                    self.stats["failed_batches"] += 1
+        return failed
+
+    def _process(self, collection, field, batch):
+        vectors, tokens = self.provider.embed([text for _, text in batch])
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        normalized = vectors / np.where(norms > 0, norms, 1)
+        now = datetime.utcnow()
+        operations = [
+            UpdateOne({"_id": org_id}, {"$set": {
+                field: Binary(vector.tobytes()),
+                normalized_field(field): Binary(unit.astype(np.float32).tobytes()),
+                f"embedding_meta.{field}": {
+                    "dim": len(vector),
+                    "dtype": "float32",
+                    "model": self.model,
+                    "normalized": True,
+                    "updated_at": now
+                },
+                # 让轮询模式的索引同步发现这些文档
+                "updated_at": now
+            }})
+            for (org_id, _), vector, unit in zip(batch, vectors, normalized)
+        ]
+        collection.bulk_write(operations, ordered=False)
+        with self._lock:
+            self.stats["documents"] += len(batch)
+            self.stats["batches"] += 1
+            self.stats["tokens"] += tokens
+
+    def report(self, label, started, before=None):
+        """打印 before 之后的处理量和吞吐量"""
+        elapsed = max(time.monotonic() - started, 1e-9)
+        with self._lock:
+            stats = {key: value - (before or {}).get(key, 0) for key, value in self.stats.items()}
+        print(f"{label}: {stats['documents']} 个文档，{stats['batches']} 批（失败 {stats['failed_batches']} 批），"
+              f"{stats['tokens']} tokens，耗时 {elapsed:.1f} 秒，"
+              f"{stats['documents'] / elapsed:.1f} 文档/秒，{stats['tokens'] / elapsed:.0f} tokens/秒")
+
+
+def main():
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="为缺少嵌入向量的组织批量生成嵌入")
+    parser.add_argument("--collection", action="append",
+                        help="集合名，可重复；默认处理非营利和营利两个集合")
+    parser.add_argument("--field", action="append", choices=list(EMBEDDING_SOURCES),
+                        help="嵌入字段，可重复；默认两个字段都处理")
+    parser.add_argument("--model", default=DEFAULT_MODEL, help="嵌入模型")
+    parser.add_argument("--provider", choices=("openai", "fake"), default="openai",
+                        help="fake 使用本地假向量，不调用 OpenAI")
+    parser.add_argument("--fake-dim", type=int, default=1536, help="假向量的维度")
+    parser.add_argument("--fake-latency", type=float, default=0.0, help="每个假请求的延迟（秒）")
+    parser.add_argument("--batch-size", type=int, default=256, help="每个请求的输入条数")
+    parser.add_argument("--concurrency", type=int, default=4, help="同时进行的请求数")
+    parser.add_argument("--checkpoint", default=os.path.join("cache", "embedding_pipeline.json"),
+                        help="检查点文件")
+    parser.add_argument("--restart", action="store_true", help="忽略检查点，从头开始")
+    parser.add_argument("--force", action="store_true", help="重新生成所有文档的嵌入")
+    args = parser.parse_args()
+
+    if args.provider == "fake":
+        provider = FakeEmbeddingProvider(args.model, dim=args.fake_dim, latency=args.fake_latency)
+    else:
+        provider = OpenAIEmbeddingProvider(args.model)
+    pipeline = EmbeddingPipeline(provider, args.model, Checkpoint(args.checkpoint),
+                                 batch_size=args.batch_size, concurrency=args.concurrency)
+
+    client = MongoClient(os.getenv("MONGODB_URI"))
+    db = client[os.getenv("MONGODB_DB_NAME")]
+    collections = args.collection or [
+        os.getenv("MONGODB_COLLECTION_NONPROFIT"),
+        os.getenv("MONGODB_COLLECTION_FORPROFIT")
+    ]
+    started = time.monotonic()
+    for name in collections:
+        for field in args.field or EMBEDDING_SOURCES:
+            pipeline.run(db[name], field, force=args.force, restart=args.restart)
+    pipeline.report("总计", started)
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
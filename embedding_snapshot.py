@@ -0,0 +1,236 @@
+"""嵌入索引的磁盘快照
+
+每个集合、每个嵌入字段写一组文件：
+    <集合>.<字段>.npy       归一化后的 float32 矩阵（标准 .npy 格式），末尾留有全0的空行
+    <集合>.<字段>.ids.npy   与矩阵逐行对齐的 _id / valid 旁路文件
+    <集合>.<字段>.json      版本头：格式版本、行数、维度、数据偏移、数据库指纹，
+                            以及开始读取之前的集群时间和本机时间
+
+API worker 启动时用 np.load(mmap_mode="c") 映射矩阵，冷启动只需要毫秒级，
+多个 worker 共享同一份 page cache。快照的指纹和数据库不一致、或者写快照时的
+集群时间已经不在 oplog 里时视为过期，调用方应退回到从MongoDB读取。
+增量同步从版本头记录的时间开始，写快照之后、worker 启动之前的写入也会应用。
+
+用法:
+    python embedding_snapshot.py --output snapshots
+"""
+import argparse
+import json
+import os
+import re
+from datetime import datetime
+
+import numpy as np
+from bson.objectid import ObjectId
+from bson.timestamp import Timestamp
+from pymongo.errors import PyMongoError
+
+from ann_index import IVFFlatIndex
+from embedding_index import EMBEDDING_FIELDS, CollectionIndex, cluster_operation_time
+
+SNAPSHOT_FORMAT_VERSION = 2
+
+# 矩阵末尾预留的空行（行数的比例，至少 SNAPSHOT_SPARE_MIN 行）：增量同步插入的组织写进空行，
+# copy-on-write 映射只复制被写的页；没有空行时第一次插入就要把整个矩阵复制到私有内存
+SNAPSHOT_SPARE_RATIO = 0.1
+SNAPSHOT_SPARE_MIN = 1024
+
+
+def snapshot_prefix(snapshot_dir, collection_name, field):
+    slug = re.sub(r"[^0-9A-Za-z]+", "_", collection_name).strip("_")
+    return os.path.join(snapshot_dir, f"{slug}.{field}")
+
+
+def collection_fingerprint(collection, updated_field="updated_at"):
+    """用于判断快照是否过期的数据库指纹"""
+    query = {"$or": [{field: {"$exists": True}} for field in EMBEDDING_FIELDS]}
+    newest = list(collection.find(query, {"_id": 1}).sort("_id", -1).limit(1))
+    latest_update = list(collection.find({updated_field: {"$exists": True}}, {updated_field: 1})
+                         .sort(updated_field, -1).limit(1))
+    return {
+        "count": collection.count_documents(query),
+        "max_id": str(newest[0]["_id"]) if newest else None,
+        "max_updated_at": str(latest_update[0][updated_field]) if latest_update else None
+    }
+
+
+def oplog_start_time(collection):
+    """oplog 中最早一条记录的时间；单机 mongod 没有 oplog，或没有权限读取时返回 None"""
+    try:
+        oldest = list(collection.database.client.local["oplog.rs"].find({}, {"ts": 1}).sort("$natural", 1).limit(1))
+    except PyMongoError:
+        return None
+    return oldest[0]["ts"] if oldest else None
+
+
+def _encode_ids(ids, valid):
+    """把 _id 编码成定长字节，ObjectId 用12字节原始值"""
+    if all(isinstance(org_id, ObjectId) for org_id in ids):
+        id_type, id_dtype = "objectid", "S12"
+        encoded = [org_id.binary for org_id in ids]
+    else:
+        id_type, id_dtype = "str", "U64"
+        encoded = [str(org_id) for org_id in ids]
+    sidecar = np.zeros(len(ids), dtype=[("id", id_dtype), ("valid", "?")])
+    sidecar["id"] = encoded
+    sidecar["valid"] = valid
+    return id_type, sidecar
+
+
+def _decode_ids(id_type, raw_ids):
+    ids = np.empty(len(raw_ids), dtype=object)
+    if id_type == "objectid":
+        # numpy 读出 S12 时会去掉末尾的 \x00，需要补齐
+        ids[:] = [ObjectId(bytes(raw).ljust(12, b"\x00")) for raw in raw_ids]
+    else:
+        ids[:] = [str(raw) for raw in raw_ids]
+    return ids
+
+
+def write_snapshot(collection, snapshot_dir):
+    """把集合的嵌入索引写成快照，返回写出的字段列表"""
+    os.makedirs(snapshot_dir, exist_ok=True)
+    # 先取指纹和同步起点再读数据：读取期间的写入会让快照被判定为过期，或由增量同步补上
+    fingerprint = collection_fingerprint(collection)
+    operation_time, loaded_at = cluster_operation_time(collection), datetime.utcnow()
+    index = CollectionIndex.from_collection(collection)
+    ids = index.ids[:index.size]
+    created_at = datetime.now().isoformat()
+    capacity = index.size + max(SNAPSHOT_SPARE_MIN, int(index.size * SNAPSHOT_SPARE_RATIO))
+
+    for field in index.matrices:
+        prefix = snapshot_prefix(snapshot_dir, collection.name, field)
+        matrix = np.zeros((capacity, index.dimension(field)), dtype=np.float32)
+        matrix[:index.size] = index.matrices[field][:index.size]
+        id_type, sidecar = _encode_ids(ids, index.valid[field][:index.size])
+
+        # 旧快照的 IVF 列表按旧行号建立，先删掉，由 ann_index.py 针对新快照重建
+        if os.path.exists(prefix + ".ivf.npz"):
+            os.remove(prefix + ".ivf.npz")
+        # 先写数据文件，最后写版本头；版本头存在才说明这组快照完整
+        np.save(prefix + ".tmp.npy", matrix)
+        np.save(prefix + ".ids.tmp.npy", sidecar)
+        os.replace(prefix + ".tmp.npy", prefix + ".npy")
+        os.replace(prefix + ".ids.tmp.npy", prefix + ".ids.npy")
+
+        header = {
+            "format_version": SNAPSHOT_FORMAT_VERSION,
+            "collection": collection.name,
+            "field": field,
+            "rows": int(index.size),
+            "capacity": int(capacity),
+            "dim": int(matrix.shape[1]),
+            "dtype": "float32",
+            "normalized": True,
+            "data_offset": int(np.load(prefix + ".npy", mmap_mode="r").offset),
+            "id_type": id_type,
+            "fingerprint": fingerprint,
+            "operation_time": [operation_time.time, operation_time.inc] if operation_time else None,
+            "loaded_at": loaded_at.isoformat(),
+            "created_at": created_at
+        }
+        with open(prefix + ".tmp.json", "w") as f:
+            json.dump(header, f, indent=2)
+        os.replace(prefix + ".tmp.json", prefix + ".json")
+        print(f"已写入快照 {prefix}: {header['rows']} 行（预留至 {capacity} 行）, 维度 {header['dim']}")
+
+    return list(index.matrices)
+
+
+def load_snapshot(collection, snapshot_dir, check_freshness=True):
+    """映射集合的快照；快照缺失、损坏或过期时返回 None"""
+    headers = {}
+    for field in EMBEDDING_FIELDS:
+        prefix = snapshot_prefix(snapshot_dir, collection.name, field)
+        if not os.path.exists(prefix + ".json"):
+            print(f"快照 {prefix} 不存在")
+            return None
+        with open(prefix + ".json") as f:
+            headers[field] = json.load(f)
+        if headers[field].get("format_version") != SNAPSHOT_FORMAT_VERSION:
+            print(f"快照 {prefix} 版本不兼容: {headers[field].get('format_version')}")
+            return None
+
+    fingerprints = {json.dumps(header["fingerprint"], sort_keys=True) for header in headers.values()}
+    if len(fingerprints) != 1:
+        print(f"集合 {collection.name} 的各字段快照不是同一次写出的")
+        return None
+    header = headers[EMBEDDING_FIELDS[0]]
+    operation_time = Timestamp(*header["operation_time"]) if header["operation_time"] else None
+    if check_freshness:
+        current = collection_fingerprint(collection)
+        if header["fingerprint"] != current:
+            print(f"集合 {collection.name} 的快照已过期，改为从数据库读取")
+            return None
+        oplog_start = oplog_start_time(collection)
+        if operation_time is not None and oplog_start is not None and oplog_start > operation_time:
+            # change stream 无法从写快照时开始，之间的原地更新会丢失
+            print(f"集合 {collection.name} 的快照早于 oplog 的保留范围，改为从数据库读取")
+            return None
+
+    matrices = {}
+    valid = {}
+    raw_ids = None
+    for field, header in headers.items():
+        prefix = snapshot_prefix(snapshot_dir, collection.name, field)
+        # copy-on-write 映射：增量同步改写行时只复制被改的页
+        matrix = np.load(prefix + ".npy", mmap_mode="c")
+        sidecar = np.load(prefix + ".ids.npy")
+        capacity = header.get("capacity", header["rows"])
+        if matrix.shape != (capacity, header["dim"]) or len(sidecar) != header["rows"]:
+            print(f"快照 {prefix} 与版本头不一致")
+            return None
+        if raw_ids is None:
+            raw_ids = sidecar["id"]
+        elif not np.array_equal(raw_ids, sidecar["id"]):
+            print(f"集合 {collection.name} 的各字段快照行顺序不一致")
+            return None
+        matrices[field] = matrix
+        valid[field] = np.zeros(len(matrix), dtype=bool)
+        valid[field][:len(sidecar)] = sidecar["valid"]
+
+    # 所有字段的行数一致（各字段的行顺序已经检查过），空行的 _id 为 None
+    rows = header["rows"]
+    ids = np.empty(len(matrix), dtype=object)
+    ids[:rows] = _decode_ids(header["id_type"], raw_ids)
+    index = CollectionIndex(collection.name, ids, matrices, valid, size=rows)
+    index.load_operation_time = operation_time
+    index.loaded_at = datetime.fromisoformat(header["loaded_at"])
+
+    # ann_index.py 离线构建的 IVF 索引（可选），只用为这一次快照构建的
+    for field, header in headers.items():
+        ivf_path = snapshot_prefix(snapshot_dir, collection.name, field) + ".ivf.npz"
+        if os.path.exists(ivf_path):
+            ivf = IVFFlatIndex.load(ivf_path)
+            if ivf.snapshot == header["created_at"] and ivf.rows == header["rows"]:
+                index.ann[field] = ivf
+            else:
+                print(f"{ivf_path} 不是为当前快照构建的，忽略")
+    return index
+
+
+def main():
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="把组织嵌入向量写成磁盘快照")
+    parser.add_argument("--output", default=os.getenv("EMBEDDING_SNAPSHOT_DIR", "snapshots"),
+                        help="快照目录")
+    parser.add_argument("--collection", action="append",
+                        help="集合名，可重复；默认写非营利和营利两个集合")
+    args = parser.parse_args()
+
+    client = MongoClient(os.getenv("MONGODB_URI"))
+    db = client[os.getenv("MONGODB_DB_NAME")]
+    collections = args.collection or [
+        os.getenv("MONGODB_COLLECTION_NONPROFIT"),
+        os.getenv("MONGODB_COLLECTION_FORPROFIT")
+    ]
+    for name in collections:
+        write_snapshot(db[name], args.output)
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+"""把MongoDB中的增删改同步到常驻嵌入索引
+
+优先使用 change stream 逐条应用变更，从索引开始加载之前的集群时间打开，
+加载期间的写入也会收到；单机 mongod（例如本地测试环境）不支持 change stream 时，
+退回到定期对比 _id / updated_at 的轮询模式。
+"""
+import threading
+from datetime import datetime, timedelta, timezone
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from embedding_index import EMBEDDING_FIELDS, cluster_operation_time, embedding_projection, get_collection_index
+from lexical_index import LEXICAL_FIELDS
+from metadata_index import FILTER_FIELDS
+from organization_cards import get_card_cache
+
+# 不是副本集 / 服务端版本过旧，不支持 change stream，只能轮询
+CHANGE_STREAM_UNSUPPORTED_CODES = {40573, 40324}
+# ChangeStreamFatalError / ChangeStreamHistoryLost：resume token 对应的 oplog 已被覆盖
+CHANGE_STREAM_HISTORY_LOST_CODES = {280, 286}
+# 按 updated_at 补读时往前多留的时间，容忍写入方和本机的时钟偏差
+UPDATED_AT_MARGIN = timedelta(minutes=5)
+
+
+def sync_projection():
+    """增量同步读取的字段：嵌入向量，加上元数据过滤和 BM25 索引用的字段"""
+    projection = embedding_projection()
+    projection.update({field: 1 for field in FILTER_FIELDS + LEXICAL_FIELDS})
+    return projection
+
+
+class IndexSynchronizer:
+    """在后台线程中把单个集合的变更应用到它的索引上"""
+
+    def __init__(self, collection, poll_interval=60.0, updated_field="updated_at"):
+        self.collection = collection
+        self.poll_interval = poll_interval
+        self.updated_field = updated_field
+        self.mode = None
+        self._resume_token = None
+        # 没有 resume token 时 change stream 的起点（集群时间）
+        self._start_at = None
+        # 这个时间之前的写入都已经应用到索引（本机 UTC 时间），轮询第一次按它补读
+        self._synced_at = None
+        self._versions = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        index = get_collection_index(self.collection)
+        self._start_at, self._synced_at = index.load_operation_time, index.loaded_at
+        self._thread = threading.Thread(
+            target=self._run, name=f"index-sync-{self.collection.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set() and self._index() is not None:
+            try:
+                if self.mode != "poll":
+                    self.mode = "change_stream"
+                    self._watch()
+                else:
+                    self.poll_once()
+                    self._stop.wait(self.poll_interval)
+            except OperationFailure as e:
+                if e.code in CHANGE_STREAM_UNSUPPORTED_CODES:
+                    # 单机 mongod 不支持 change stream，改为轮询
+                    print(f"集合 {self.collection.name} 无法使用change stream，改为每 {self.poll_interval} 秒轮询: {e}")
+                    self.mode = "poll"
+                elif e.code in CHANGE_STREAM_HISTORY_LOST_CODES:
+                    print(f"集合 {self.collection.name} 的change stream无法续接，按 updated_at 补读后重新打开: {e}")
+                    self._resync()
+                else:
+                    print(f"集合 {self.collection.name} 的change stream出错，稍后重新打开: {e}")
+                    self._stop.wait(5)
+            except PyMongoError as e:
+                print(f"集合 {self.collection.name} 索引同步出错，稍后重试: {e}")
+                self._stop.wait(5)
+
+    def _watch(self):
+        """消费 change stream；断线后从上次的 resume token 继续，第一次从索引加载前的集群时间开始"""
+        # updateLookup 返回的完整文档只保留 _id 和嵌入字段
+        projection = {"operationType": 1, "documentKey": 1, "fullDocument._id": 1}
+        projection.update({f"fullDocument.{field}": 1 for field in sync_projection()})
+        with self.collection.watch(
+                [{"$project": projection}],
+                full_document="updateLookup",
+                resume_after=self._resume_token,
+                start_at_operation_time=None if self._resume_token else self._start_at,
+                max_await_time_ms=1000) as stream:
+            while not self._stop.is_set() and stream.alive:
+                caught_up = datetime.utcnow()
+                change = stream.try_next()
+                if change is not None:
+                    self.apply_change(change)
+                self._resume_token = stream.resume_token
+                if change is None:
+                    self._synced_at = caught_up
+
+    def _resync(self):
+        """resume token 失效：记下当前集群时间，补读之后变更过的文档，再从这个时间重新打开"""
+        self._resume_token = None
+        self._start_at = cluster_operation_time(self.collection)
+        self._versions = None
+        self.poll_once()
+
+    def _index(self):
+        """同步的目标索引；worker 改用共享内存索引后（只读，由发布进程同步）返回 None 并停止同步"""
+        index = get_collection_index(self.collection)
+        if index.shared is None:
+            return index
+        if not self._stop.is_set():
+            print(f"集合 {self.collection.name} 已改用共享内存索引，停止本地同步")
+            self._stop.set()
+        return None
+
+    def apply_change(self, change):
+        """把单条 change event 应用到索引"""
+        index = self._index()
+        if index is None:
+            return
+        cards = get_card_cache(self.collection.name)
+        operation = change["operationType"]
+        if operation in ("insert", "update", "replace", "delete"):
+            # 展示字段不在同步读取的字段里，只删除卡片，下次用到时重新读取
+            cards.invalidate(change["documentKey"]["_id"])
+        if operation in ("insert", "update", "replace"):
+            org = change.get("fullDocument")
+            if org is None:
+                # 更新之后文档又被删掉了，updateLookup 拿不到文档
+                index.remove(change["documentKey"]["_id"])
+            else:
+                index.upsert_document(org)
+        elif operation == "delete":
+            index.remove(change["documentKey"]["_id"])
+        elif operation in ("drop", "rename", "invalidate"):
+            print(f"集合 {self.collection.name} 收到 {operation} 事件，停止同步")
+            cards.clear()
+            self._stop.set()
+
+    def poll_once(self):
+        """对比 _id / updated_at，只读取新增或更新过的文档
+
+        第一次轮询没有上一轮的版本可比，除了索引里没有的 _id，
+        还补读 updated_at 晚于 _synced_at（索引开始加载的时间）的文档。
+        """
+        index = self._index()
+        if index is None:
+            return
+        query = {"$or": [{field: {"$exists": True}} for field in EMBEDDING_FIELDS]}
+        versions = {
+            org["_id"]: org.get(self.updated_field)
+            for org in self.collection.find(query, {"_id": 1, self.updated_field: 1})
+        }
+
+        if self._versions is None:
+            changed = [org_id for org_id, version in versions.items()
+                       if org_id not in index or _updated_since(version, self._synced_at)]
+        else:
+            changed = [org_id for org_id, version in versions.items()
+                       if org_id not in self._versions or self._versions[org_id] != version]
+        removed = [org_id for org_id in index.document_ids() if org_id not in versions]
+
+        cards = get_card_cache(self.collection.name)
+        if changed:
+            for org in self.collection.find({"_id": {"$in": changed}}, sync_projection()):
+                index.upsert_document(org)
+                cards.invalidate(org["_id"])
+        for org_id in removed:
+            index.remove(org_id)
+            cards.invalidate(org_id)
+
+        self._versions = versions
+        self._synced_at = None
+        if changed or removed:
+            print(f"集合 {self.collection.name} 同步: 更新 {len(changed)} 个，删除 {len(removed)} 个")
+
+
+def _updated_since(version, since):
+    """updated_at 是否不早于 since - UPDATED_AT_MARGIN；不是时间类型时无法判断，返回 False"""
+    if since is None or not isinstance(version, datetime):
+        return False
+    if version.tzinfo is not None:
+        version = version.astimezone(timezone.utc).replace(tzinfo=None)
+    return version >= since - UPDATED_AT_MARGIN
+
+
+def start_index_sync(collections, poll_interval=60.0):
+    """为每个集合启动一个同步线程"""
+    synchronizers = []
+    for collection in collections:
+        synchronizer = IndexSynchronizer(collection, poll_interval=poll_interval)
+        synchronizer.start()
+        synchronizers.append(synchronizer)
+    return synchronizers
@@ -0,0 +1,193 @@
+"""匹配任务的异步执行：提交 / 轮询 / 取结果
+
+任务由有界线程池执行；已经在排队、还没开始运行的任务达到 max_queue 时直接拒绝（削峰），
+而不是让请求无限堆积。最多同时运行 max_workers 个任务，运行中的任务不占排队名额。任务状态默认存在内存中，多进程部署时可以改存MongoDB。
+"""
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING
+
+# 任务状态
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+
+class QueueFullError(Exception):
+    """排队任务已满"""
+
+
+class InMemoryJobStore:
+    """单进程内的任务存储"""
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def create(self, job):
+        with self._lock:
+            self._jobs[job["_id"]] = job
+
+    def update(self, job_id, fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(fields)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job["expires_at"] < datetime.utcnow():
+                return None
+            return dict(job)
+
+    def purge_expired(self):
+        now = datetime.utcnow()
+        with self._lock:
+            for job_id in [job_id for job_id, job in self._jobs.items() if job["expires_at"] < now]:
+                del self._jobs[job_id]
+
+
+class MongoJobStore:
+    """存在MongoDB中的任务，多个 uvicorn worker 可以互相查询；过期由TTL索引清理"""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.collection.create_index([("expires_at", ASCENDING)], expireAfterSeconds=0)
+
+    def create(self, job):
+        self.collection.insert_one(job)
+
+    def update(self, job_id, fields):
+        self.collection.update_one({"_id": job_id}, {"$set": fields})
+
+    def get(self, job_id):
+        # TTL索引每分钟才清理一次，这里再按时间过滤一遍
+        return self.collection.find_one({"_id": job_id, "expires_at": {"$gte": datetime.utcnow()}})
+
+    def purge_expired(self):
+        pass
+
+
+class JobManager:
+    """用有界线程池执行任务，并统计队列深度和线程利用率"""
+
+    def __init__(self, runner, store, max_workers=4, max_queue=20, result_ttl=3600):
+        self.runner = runner
+        self.store = store
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.result_ttl = result_ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="matching-job")
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._busy_seconds = 0.0
+        self._started = time.monotonic()
+        self._totals = {"submitted": 0, "rejected": 0, SUCCEEDED: 0, FAILED: 0}
+
+    def submit(self, algorithm, request):
+        """提交任务，返回任务ID；队列已满时抛出 QueueFullError"""
+        with self._lock:
+            if self._queued >= self.max_queue:
+                self._totals["rejected"] += 1
+                raise QueueFullError(f"排队任务已达上限 {self.max_queue}")
+            self._queued += 1
+            self._totals["submitted"] += 1
+
+        self.store.purge_expired()
+        now = datetime.utcnow()
+        job = {
+            "_id": uuid.uuid4().hex,
+            "algorithm": algorithm,
+            "status": QUEUED,
+            "progress": {"current_step": None, "completed_steps": [], "evaluations_done": 0},
+            "result": None,
+            "error": None,
+            "created_at": now,
+            "started_at": None,
+            "finished_at": None,
+            "expires_at": now + timedelta(seconds=self.result_ttl)
+        }
+        try:
+            self.store.create(job)
+            self._executor.submit(self._run, job["_id"], algorithm, request)
+        except Exception:
+            with self._lock:
+                self._queued -= 1
+            raise
+        return job["_id"]
+
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+    def _run(self, job_id, algorithm, request):
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+        started = time.monotonic()
+        progress = {"current_step": None, "completed_steps": [], "evaluations_done": 0}
+
+        def on_event(event):
+            """流水线每产出一个事件就更新一次进度"""
+            if event["event"] == "step":
+                progress["completed_steps"].append(event["step"])
+                progress["current_step"] = event["step"]
+            elif event["event"] == "evaluation":
+                progress["evaluations_done"] += 1
+            self.store.update(job_id, {"progress": progress})
+
+        status, fields = FAILED, {"error": "任务被中断"}
+        try:
+            # 状态写入也放在 try 里：存储出错时任务记为失败，而不是一直停在 queued
+            self.store.update(job_id, {"status": RUNNING, "started_at": datetime.utcnow()})
+            result = self.runner(algorithm, request, on_event)
+            status, fields = SUCCEEDED, {"result": result}
+        except Exception as e:
+            print(f"任务 {job_id} 失败: {str(e)}")
+            status, fields = FAILED, {"error": str(e)}
+        finally:
+            status = self._finish(job_id, status, fields)
+            with self._lock:
+                self._running -= 1
+                self._busy_seconds += time.monotonic() - started
+                self._totals[status] += 1
+
+    def _finish(self, job_id, status, fields):
+        """写入最终状态，返回实际记录的状态；结果写不进去时改记为失败"""
+        finished = datetime.utcnow()
+        final = {"finished_at": finished, "expires_at": finished + timedelta(seconds=self.result_ttl)}
+        try:
+            self.store.update(job_id, {**fields, **final, "status": status})
+            return status
+        except Exception as e:
+            print(f"任务 {job_id} 状态写入失败: {str(e)}")
+        if status == FAILED:
+            return FAILED
+        try:
+            self.store.update(job_id, {**final, "status": FAILED, "error": "任务结果写入失败"})
+        except Exception as e:
+            print(f"任务 {job_id} 状态写入失败: {str(e)}")
+        return FAILED
+
+    def stats(self):
+        """队列深度、运行中任务数和线程利用率"""
+        with self._lock:
+            elapsed = max(time.monotonic() - self._started, 1e-9)
+            return {
+                "workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "queue_depth": self._queued,
+                "running": self._running,
+                "utilization": round(self._running / self.max_workers, 4),
+                "average_utilization": round(self._busy_seconds / (elapsed * self.max_workers), 4),
+                "totals": dict(self._totals)
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,173 @@
+"""组织 Tags / Specialities 的 BM25 倒排索引
+
+生成的标签列表只被转成一个嵌入向量，和组织标签的精确重合信息就丢掉了。
+这里按词建立倒排列表（CSR：indptr + 行号数组 + 词频数组），与嵌入矩阵逐行对齐，
+可以和向量检索的排名做倒数排名融合（RRF），也可以先用它挑出候选行再做向量打分。
+
+增量更新的行先放在 pending 中并把它在倒排列表里的旧条目标记为过期，
+积累到一定数量后再整体重建倒排列表。
+"""
+import math
+import re
+import threading
+from collections import Counter
+
+import numpy as np
+
+from embedding_index import top_k_indices
+
+LEXICAL_FIELDS = ("Tags", "Specialities")
+
+# 词元化后丢弃的常见英文虚词
+STOP_WORDS = frozenset((
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "in", "is", "it", "of",
+    "on", "or", "that", "the", "to", "with", "we", "our", "who", "which", "this"
+))
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(value):
+    """列表或字符串转换成小写词元"""
+    if isinstance(value, (list, tuple)):
+        value = " ".join(str(item) for item in value)
+    if not value:
+        return []
+    return [token for token in TOKEN_PATTERN.findall(str(value).lower()) if token not in STOP_WORDS]
+
+
+def document_tokens(org):
+    tokens = []
+    for field in LEXICAL_FIELDS:
+        tokens.extend(tokenize(org.get(field)))
+    return tokens
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """rankings 是若干个按相关性排好序的 _id 列表，返回 [(_id, rrf_score, [各列表中的名次])]"""
+    scores = {}
+    ranks = {}
+    for list_index, ranking in enumerate(rankings):
+        for rank, org_id in enumerate(ranking, start=1):
+            scores[org_id] = scores.get(org_id, 0.0) + 1.0 / (k + rank)
+            ranks.setdefault(org_id, [None] * len(rankings))[list_index] = rank
+    fused = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    return [(org_id, score, ranks[org_id]) for org_id, score in fused]
+
+
+class LexicalIndex:
+    """行号与 CollectionIndex 一致的 BM25 索引"""
+
+    def __init__(self, capacity, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.vocabulary = {}
+        self.forward = {}
+        self.doc_lengths = np.zeros(capacity, dtype=np.float32)
+        self.df = np.zeros(0, dtype=np.int32)
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.post_rows = np.empty(0, dtype=np.int32)
+        self.post_tf = np.empty(0, dtype=np.float32)
+        self.stale = np.zeros(capacity, dtype=bool)
+        self.pending = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_collection(cls, collection, row_of, capacity):
+        """一次查询读取所有组织的 Tags / Specialities，按 row_of 对齐到索引行"""
+        index = cls(capacity)
+        for org in collection.find({"_id": {"$in": list(row_of)}} if len(row_of) < 1000 else {},
+                                   {field: 1 for field in LEXICAL_FIELDS}):
+            row = row_of.get(org["_id"])
+            if row is not None:
+                index.forward[row] = index._encode(document_tokens(org))
+        index._compile()
+        return index
+
+    def _encode(self, tokens):
+        """词元 -> (词编号数组, 词频数组)"""
+        counts = Counter(tokens)
+        terms = np.fromiter((self.vocabulary.setdefault(token, len(self.vocabulary)) for token in counts),
+                            dtype=np.int32, count=len(counts))
+        return terms, np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+
+    def _compile(self):
+        """由正排表重建倒排列表和文档频率（调用方需持有锁或独占索引）"""
+        rows = list(self.forward)
+        lengths = [len(self.forward[row][0]) for row in rows]
+        all_terms = np.concatenate([self.forward[row][0] for row in rows]) if rows else np.empty(0, np.int32)
+        all_tf = np.concatenate([self.forward[row][1] for row in rows]) if rows else np.empty(0, np.float32)
+        all_rows = np.repeat(np.asarray(rows, dtype=np.int32), lengths)
+
+        order = np.argsort(all_terms, kind="stable")
+        counts = np.bincount(all_terms, minlength=len(self.vocabulary))
+        self.indptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self.post_rows = all_rows[order]
+        self.post_tf = all_tf[order]
+        self.df = counts.astype(np.int32)
+        for row in rows:
+            self.doc_lengths[row] = self.forward[row][1].sum()
+        self.stale[:] = False
+        self.pending = {}
+
+    def set_row(self, row, org):
+        """更新单行（索引增量同步时调用）"""
+        with self._lock:
+            if row >= len(self.doc_lengths):
+                capacity = max(row + 1, int(len(self.doc_lengths) * 1.5))
+                self.doc_lengths = np.concatenate([self.doc_lengths, np.zeros(capacity - len(self.doc_lengths), np.float32)])
+                self.stale = np.concatenate([self.stale, np.zeros(capacity - len(self.stale), bool)])
+            old = self.forward.get(row)
+            if old is not None:
+                self.df[old[0]] -= 1
+            terms, tfs = self._encode(document_tokens(org))
+            if len(self.vocabulary) > len(self.df):
+                self.df = np.concatenate([self.df, np.zeros(len(self.vocabulary) - len(self.df), np.int32)])
+            self.df[terms] += 1
+            self.forward[row] = (terms, tfs)
+            self.doc_lengths[row] = tfs.sum()
+            self.stale[row] = True
+            self.pending[row] = (terms, tfs)
+            if len(self.pending) > max(1000, len(self.forward) // 10):
+                self._compile()
+
+    def search(self, tokens, k, mask):
+        """返回 BM25 得分最高的 k 行 (行号数组, 得分数组)，只考虑 mask 为 True 的行"""
+        with self._lock:
+            size = len(mask)
+            term_ids = {self.vocabulary[token] for token in set(tokens) if token in self.vocabulary}
+            if not term_ids:
+                return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+            documents = max(len(self.forward), 1)
+            lengths = self.doc_lengths[:size]
+            average_length = max(float(lengths[mask].mean()) if mask.any() else 0.0, 1.0)
+            scores = np.zeros(size, dtype=np.float32)
+
+            for term in term_ids:
+                idf = math.log(1 + (documents - self.df[term] + 0.5) / (self.df[term] + 0.5))
+                if term + 1 >= len(self.indptr):
+                    # 重建倒排列表之后才出现的词，只在 pending 中
+                    continue
+                start, end = self.indptr[term], self.indptr[term + 1]
+                rows = self.post_rows[start:end]
+                tf = self.post_tf[start:end]
+                keep = rows < size
+                rows, tf = rows[keep], tf[keep]
+                keep = ~self.stale[rows]
+                rows, tf = rows[keep], tf[keep]
+                norm = self.k1 * (1 - self.b + self.b * lengths[rows] / average_length)
+                scores[rows] += idf * tf * (self.k1 + 1) / (tf + norm)
+
+            # 倒排列表重建之前更新过的行
+            for row, (terms, tfs) in self.pending.items():
+                if row >= size:
+                    continue
+                for term, tf in zip(terms, tfs):
+                    if term in term_ids:
+                        idf = math.log(1 + (documents - self.df[term] + 0.5) / (self.df[term] + 0.5))
+                        norm = self.k1 * (1 - self.b + self.b * lengths[row] / average_length)
+                        scores[row] += idf * tf * (self.k1 + 1) / (tf + norm)
+
+        candidates = np.flatnonzero((scores > 0) & mask)
+        top = top_k_indices(scores[candidates], min(k, len(candidates)))
+        return candidates[top], scores[candidates[top]]
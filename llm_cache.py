@@ -0,0 +1,66 @@
+"""ChatCompletion 结果的内容寻址缓存
+
+键是 (模型, messages, 参数, 提示词版本) 的哈希。提示词版本由所有名字里带 PROMPT
+的环境变量计算，修改任何一个模板都会让旧条目失效。
+"""
+import hashlib
+import json
+import os
+import threading
+
+import openai
+
+from cache_store import PersistentLRUCache
+
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") != "0"
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def prompt_version():
+    """所有提示词模板的哈希"""
+    templates = {name: value for name, value in os.environ.items() if "PROMPT" in name}
+    return hashlib.sha256(json.dumps(templates, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def get_llm_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = PersistentLRUCache(
+                "llm",
+                os.getenv("LLM_CACHE_PATH", os.path.join("cache", "llm_cache.sqlite3")),
+                max_memory_items=int(os.getenv("LLM_CACHE_MEMORY_ITEMS", "1000")),
+                max_disk_items=int(os.getenv("LLM_CACHE_MAX_ITEMS", "50000")),
+                ttl=float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+            )
+    return _cache
+
+
+def completion_cache_key(model, messages, params):
+    payload = {
+        "model": model,
+        "messages": messages,
+        "params": params,
+        "prompt_version": prompt_version()
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def cached_chat_completion(model, messages, **params):
+    """带缓存的 ChatCompletion，返回回复文本"""
+    if not LLM_CACHE_ENABLED:
+        response = openai.ChatCompletion.create(model=model, messages=messages, **params)
+        return response.choices[0].message['content']
+
+    cache = get_llm_cache()
+    key = completion_cache_key(model, messages, params)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached.decode("utf-8")
+
+    response = openai.ChatCompletion.create(model=model, messages=messages, **params)
+    content = response.choices[0].message['content']
+    cache.set(key, content.encode("utf-8"))
+    return content
@@ -0,0 +1,246 @@
+"""用LLM评估候选组织是否与用户组织匹配
+
+concurrent: 每个候选单独调用一次LLM，并发执行
+batch:      用户信息只发送一次，候选列表一次性发给LLM，返回JSON数组；
+            缺失或格式不对的候选再退回到单独评估
+"""
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import openai
+
+from verdict_cache import get_verdict, set_verdict
+
+# 同时进行的评估请求数和单次请求超时（秒）
+EVAL_CONCURRENCY = int(os.getenv("EVAL_CONCURRENCY", "10"))
+EVAL_TIMEOUT = float(os.getenv("EVAL_TIMEOUT", "30"))
+# 批量模式下每次调用包含的候选数
+EVAL_BATCH_SIZE = int(os.getenv("EVAL_BATCH_SIZE", "30"))
+
+EVALUATION_MODES = ("concurrent", "batch")
+
+DEFAULT_BATCH_SYSTEM_PROMPT = (
+    "You evaluate whether candidate organizations are good partnership matches for a user organization. "
+    "Judge mission alignment, resource complementarity and strategic compatibility. "
+    "Respond with JSON only."
+)
+
+DEFAULT_BATCH_PROMPT = """User organization:
+Description: {user_description}
+Mission: {user_mission}
+Industries: {user_industries}
+Specialities: {user_specialities}
+
+Candidate organizations (one JSON object per line):
+{candidates}
+
+For every candidate, decide whether it is a good partnership match for the user organization.
+Return a JSON object of the form {{"verdicts": [{{"id": "<candidate id>", "is_match": true or false}}, ...]}}
+with exactly one verdict for each candidate id."""
+
+
+def build_match_resources(request, organization):
+    """根据用户要找的组织类型准备资源信息"""
+    if request["Organization looking 1"].lower() == "nonprofit":
+        return f"Partnership History: {organization.get('Partnership', '')}, Event Experience: {organization.get('Event', '')}"
+    return f"Assets: {organization.get('Assets', '')}, Contribution Capacity: {organization.get('Contribution', '')}"
+
+
+def build_evaluation_prompt(request, organization):
+    """用 MATCH_EVALUATION_PROMPT 模板生成单个候选的评估提示"""
+    return os.getenv("MATCH_EVALUATION_PROMPT").format(
+        # 用户组织信息
+        user_description=request["Description"],
+        user_mission=request["Mission"],
+        user_industries=request["Industries"],
+        user_specialities=request["Specialities"],
+
+        # 匹配组织信息
+        match_description=organization["Description"],
+        match_mission=organization["Mission"],
+        match_industries=organization["Industries"],
+        match_specialties=organization["Specialities"],
+
+        # 资源信息
+        match_resources=build_match_resources(request, organization),
+        match_partnership=organization.get("Partnership", ""),
+        match_event=organization.get("Event", ""),
+        match_contribution=organization.get("Contribution", ""),
+        match_assets=organization.get("Assets", "")
+    )
+
+
+def evaluate_match(request, organization, timeout=EVAL_TIMEOUT):
+    """调用LLM评估单个候选，返回 True/False"""
+    eval_response = openai.ChatCompletion.create(
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": os.getenv("MATCH_EVALUATION_SYSTEM_PROMPT")},
+            {"role": "user", "content": build_evaluation_prompt(request, organization)}
+        ],
+        temperature=0.3,
+        request_timeout=timeout
+    )
+    return eval_response.choices[0].message['content'].strip().lower() == 'true'
+
+
+def _evaluate(request, match, timeout):
+    try:
+        if evaluate_match(request, match["organization"], timeout=timeout):
+            return {"is_match": True, "status": "accepted"}
+        return {"is_match": False, "status": "rejected"}
+    except Exception as e:
+        # 单个评估失败按不匹配处理，不影响整个请求
+        print(f"评估组织 {match['organization'].get('_id')} 失败: {str(e)}")
+        return {"is_match": False, "status": "rejected", "error": str(e)}
+
+
+def build_batch_candidates(request, matches):
+    """把候选整理成紧凑的JSON行，字段与 MATCH_EVALUATION_PROMPT 使用的一致"""
+    lines = []
+    for idx, match in enumerate(matches):
+        organization = match["organization"]
+        lines.append(json.dumps({
+            "id": f"c{idx + 1}",
+            "description": organization["Description"],
+            "mission": organization["Mission"],
+            "industries": organization["Industries"],
+            "specialities": organization["Specialities"],
+            "resources": build_match_resources(request, organization)
+        }, ensure_ascii=False, default=str))
+    return "\n".join(lines)
+
+
+def parse_batch_verdicts(content, count):
+    """解析批量评估的JSON，返回 {候选下标: is_match}；无效条目直接丢弃"""
+    content = content.strip()
+    if content.startswith("```"):
+        content = content.strip("`")
+        content = content[content.find("\n") + 1:] if "\n" in content else ""
+    try:
+        data = json.loads(content)
+    except ValueError:
+        return {}
+    if isinstance(data, dict):
+        data = data.get("verdicts")
+    if not isinstance(data, list):
+        return {}
+
+    verdicts = {}
+    for item in data:
+        if not isinstance(item, dict) or not isinstance(item.get("is_match"), bool):
+            continue
+        candidate_id = str(item.get("id", ""))
+        if not candidate_id.startswith("c") or not candidate_id[1:].isdigit():
+            continue
+        idx = int(candidate_id[1:]) - 1
+        if 0 <= idx < count and idx not in verdicts:
+            verdicts[idx] = item["is_match"]
+    return verdicts
+
+
+def evaluate_batch(request, matches, timeout=EVAL_TIMEOUT):
+    """一次LLM调用评估一组候选，返回 {候选下标: is_match}"""
+    prompt = os.getenv("MATCH_EVALUATION_BATCH_PROMPT", DEFAULT_BATCH_PROMPT).format(
+        user_description=request["Description"],
+        user_mission=request["Mission"],
+        user_industries=request["Industries"],
+        user_specialities=request["Specialities"],
+        candidates=build_batch_candidates(request, matches)
+    )
+    eval_response = openai.ChatCompletion.create(
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": os.getenv("MATCH_EVALUATION_BATCH_SYSTEM_PROMPT", DEFAULT_BATCH_SYSTEM_PROMPT)},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0.3,
+        response_format={"type": "json_object"},
+        request_timeout=timeout
+    )
+    return parse_batch_verdicts(eval_response.choices[0].message['content'], len(matches))
+
+
+def evaluation_prompt_hash(mode="concurrent"):
+    """评估提示词模板和模型的哈希，作为评估结果缓存键的一部分"""
+    if mode == "batch":
+        templates = [os.getenv("MATCH_EVALUATION_BATCH_SYSTEM_PROMPT", DEFAULT_BATCH_SYSTEM_PROMPT),
+                     os.getenv("MATCH_EVALUATION_BATCH_PROMPT", DEFAULT_BATCH_PROMPT)]
+    else:
+        templates = [os.getenv("MATCH_EVALUATION_SYSTEM_PROMPT"), os.getenv("MATCH_EVALUATION_PROMPT")]
+    payload = json.dumps(["gpt-4o-mini", mode] + templates, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def iter_evaluations(request, matches, concurrency=EVAL_CONCURRENCY, timeout=EVAL_TIMEOUT, mode="concurrent"):
+    """评估候选，按完成顺序产出 (下标, 评估结果)
+
+    先查评估结果缓存，只有缓存中没有的候选才调用LLM。
+    """
+    if mode not in EVALUATION_MODES:
+        raise ValueError(f"未知的评估模式: {mode}")
+
+    # 批量模式中退回逐个评估的结果存在单个评估的提示词版本下，也一并查找
+    prompt_hashes = [evaluation_prompt_hash(mode)]
+    if mode == "batch":
+        prompt_hashes.append(evaluation_prompt_hash("concurrent"))
+
+    pending = []
+    for idx, match in enumerate(matches):
+        is_match = None
+        for prompt_hash in prompt_hashes:
+            is_match = get_verdict(request, match["organization"], prompt_hash)
+            if is_match is not None:
+                break
+        if is_match is None:
+            pending.append(idx)
+        else:
+            yield idx, {"is_match": is_match, "status": "accepted" if is_match else "rejected", "cached": True}
+
+    if not pending:
+        return
+    remaining = [matches[idx] for idx in pending]
+    evaluator = _iter_batch_evaluations if mode == "batch" else _iter_concurrent_evaluations
+    for offset, evaluation in evaluator(request, remaining, concurrency, timeout):
+        yield pending[offset], evaluation
+
+
+def _iter_concurrent_evaluations(request, matches, concurrency, timeout):
+    prompt_hash = evaluation_prompt_hash("concurrent")
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(matches)))) as executor:
+        futures = {executor.submit(_evaluate, request, match, timeout): idx
+                   for idx, match in enumerate(matches)}
+        for future in as_completed(futures):
+            idx = futures[future]
+            evaluation = future.result()
+            if "error" not in evaluation:
+                set_verdict(request, matches[idx]["organization"], prompt_hash, evaluation["is_match"])
+            yield idx, evaluation
+
+
+def _iter_batch_evaluations(request, matches, concurrency, timeout):
+    prompt_hash = evaluation_prompt_hash("batch")
+    pending = []
+    for start in range(0, len(matches), EVAL_BATCH_SIZE):
+        batch = matches[start:start + EVAL_BATCH_SIZE]
+        try:
+            verdicts = evaluate_batch(request, batch, timeout=timeout)
+        except Exception as e:
+            print(f"批量评估失败，改为逐个评估: {str(e)}")
+            verdicts = {}
+        for offset, match in enumerate(batch):
+            if offset in verdicts:
+                is_match = verdicts[offset]
+                set_verdict(request, match["organization"], prompt_hash, is_match)
+                yield start + offset, {"is_match": is_match, "status": "accepted" if is_match else "rejected"}
+            else:
+                pending.append(start + offset)
+
+    # 批量结果中缺失或无效的候选退回单独评估
+    if pending:
+        print(f"{len(pending)} 个候选的批量评估结果无效，改为逐个评估")
+        retry = [matches[idx] for idx in pending]
+        for offset, evaluation in _iter_concurrent_evaluations(request, retry, concurrency, timeout):
+            yield pending[offset], evaluation
@@ -0,0 +1,265 @@
+"""与嵌入矩阵逐行对齐的列式元数据，用于在打分之前过滤
+
+数值字段（Staff_Count、Assets、Linkedin_followers）存为 float64 数组，缺失为 NaN；
+Popularity 存为类别编码（-1 表示缺失）；Industries 一个组织可以有多个行业，
+存为 (编码, 行号) 两个 int32 数组组成的倒排列表。
+
+过滤条件使用MongoDB风格的表达式，例如:
+    {"Industries": {"$in": ["Education", "Health"]},
+     "Staff_Count": {"$gte": 10, "$lte": 500},
+     "Popularity": "Yes"}
+表达式先转换成布尔掩码，再交给检索在 top-k 之前使用。
+"""
+import threading
+
+import numpy as np
+
+NUMERIC_FIELDS = ("Staff_Count", "Assets", "Linkedin_followers")
+CATEGORICAL_FIELDS = ("Popularity",)
+MULTI_VALUE_FIELDS = ("Industries",)
+FILTER_FIELDS = NUMERIC_FIELDS + CATEGORICAL_FIELDS + MULTI_VALUE_FIELDS
+
+NUMERIC_OPERATORS = {
+    "$eq": np.equal,
+    "$ne": np.not_equal,
+    "$gt": np.greater,
+    "$gte": np.greater_equal,
+    "$lt": np.less,
+    "$lte": np.less_equal
+}
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _number(field, operator, value):
+    """过滤条件中的数值；不是数字时抛出 ValueError"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{field} 的 {operator} 需要数字，收到 {value!r}")
+
+
+def _numbers(field, operator, values):
+    if not isinstance(values, (list, tuple)):
+        raise ValueError(f"{field} 的 {operator} 需要数组，收到 {values!r}")
+    return [_number(field, operator, value) for value in values]
+
+
+def _category(value):
+    """类别值统一为去掉首尾空白的小写字符串"""
+    if value is None:
+        return None
+    value = str(value).strip().lower()
+    return value or None
+
+
+def _categories(value):
+    """多值字段：列表或逗号分隔的字符串"""
+    if isinstance(value, str):
+        value = value.split(",")
+    elif not isinstance(value, (list, tuple)):
+        value = [] if value is None else [value]
+    return list(dict.fromkeys(category for category in map(_category, value) if category))
+
+
+class MetadataColumns:
+    """列式元数据，行号与 CollectionIndex 的行一致"""
+
+    def __init__(self, capacity):
+        self.numeric = {field: np.full(capacity, np.nan) for field in NUMERIC_FIELDS}
+        self.categorical = {field: np.full(capacity, -1, dtype=np.int32) for field in CATEGORICAL_FIELDS}
+        # 多值字段的倒排列表；行更新时旧条目的编码置为 -1，新条目追加到末尾
+        self.postings = {field: (np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32))
+                         for field in MULTI_VALUE_FIELDS}
+        self._dead_postings = {field: 0 for field in MULTI_VALUE_FIELDS}
+        self.vocabulary = {field: {} for field in CATEGORICAL_FIELDS + MULTI_VALUE_FIELDS}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_collection(cls, collection, row_of, capacity):
+        """一次查询读取所有组织的过滤字段，按 row_of 对齐到索引行"""
+        columns = cls(capacity)
+        entries = {field: ([], []) for field in MULTI_VALUE_FIELDS}
+        for org in collection.find({"_id": {"$in": list(row_of)}} if len(row_of) < 1000 else {},
+                                   {field: 1 for field in FILTER_FIELDS}):
+            row = row_of.get(org["_id"])
+            if row is None:
+                continue
+            columns._set_scalars(row, org)
+            for field in MULTI_VALUE_FIELDS:
+                codes = [columns._code(field, category) for category in _categories(org.get(field))]
+                entries[field][0].extend(codes)
+                entries[field][1].extend([row] * len(codes))
+        for field, (codes, rows) in entries.items():
+            columns.postings[field] = (np.asarray(codes, dtype=np.int32), np.asarray(rows, dtype=np.int32))
+        return columns
+
+    def export_arrays(self, size):
+        """前 size 行的列和倒排列表（已删除的条目不导出），以及类别词表，用于发布到共享内存"""
+        with self._lock:
+            arrays = {f"numeric.{field}": column[:size] for field, column in self.numeric.items()}
+            arrays.update({f"categorical.{field}": column[:size] for field, column in self.categorical.items()})
+            for field, (codes, rows) in self.postings.items():
+                live = (codes >= 0) & (rows < size)
+                arrays[f"postings.{field}.codes"] = codes[live]
+                arrays[f"postings.{field}.rows"] = rows[live]
+            vocabulary = {field: dict(values) for field, values in self.vocabulary.items()}
+        return arrays, vocabulary
+
+    @classmethod
+    def from_arrays(cls, arrays, vocabulary):
+        """由 export_arrays 的结果（可以是共享内存上的只读视图）构建，不复制数据"""
+        columns = cls(0)
+        columns.numeric = {field: arrays[f"numeric.{field}"] for field in NUMERIC_FIELDS}
+        columns.categorical = {field: arrays[f"categorical.{field}"] for field in CATEGORICAL_FIELDS}
+        columns.postings = {field: (arrays[f"postings.{field}.codes"], arrays[f"postings.{field}.rows"])
+                            for field in MULTI_VALUE_FIELDS}
+        columns.vocabulary = {field: dict(vocabulary[field]) for field in columns.vocabulary}
+        return columns
+
+    def _code(self, field, category):
+        vocabulary = self.vocabulary[field]
+        code = vocabulary.get(category)
+        if code is None:
+            code = vocabulary[category] = len(vocabulary)
+        return code
+
+    def _set_scalars(self, row, org):
+        for field in NUMERIC_FIELDS:
+            self.numeric[field][row] = _to_float(org.get(field))
+        for field in CATEGORICAL_FIELDS:
+            category = _category(org.get(field))
+            self.categorical[field][row] = -1 if category is None else self._code(field, category)
+
+    def set_row(self, row, org):
+        """更新单行（索引增量同步时调用）"""
+        with self._lock:
+            self._ensure_capacity(row + 1)
+            self._set_scalars(row, org)
+            for field in MULTI_VALUE_FIELDS:
+                codes, rows = self.postings[field]
+                stale = (rows == row) & (codes >= 0)
+                codes[stale] = -1
+                self._dead_postings[field] += int(stale.sum())
+                new_codes = [self._code(field, category) for category in _categories(org.get(field))]
+                codes = np.concatenate([codes, np.asarray(new_codes, dtype=np.int32)])
+                rows = np.concatenate([rows, np.full(len(new_codes), row, dtype=np.int32)])
+                if self._dead_postings[field] > len(codes) // 2:
+                    live = codes >= 0
+                    codes, rows = codes[live], rows[live]
+                    self._dead_postings[field] = 0
+                self.postings[field] = (codes, rows)
+
+    def _ensure_capacity(self, capacity):
+        current = len(next(iter(self.numeric.values())))
+        if capacity <= current:
+            return
+        capacity = max(capacity, int(current * 1.5))
+        for field, column in self.numeric.items():
+            self.numeric[field] = np.concatenate([column, np.full(capacity - current, np.nan)])
+        for field, column in self.categorical.items():
+            self.categorical[field] = np.concatenate([column, np.full(capacity - current, -1, dtype=np.int32)])
+
+    def mask(self, expression, size):
+        """把过滤表达式转换成长度为 size 的布尔掩码"""
+        if not isinstance(expression, dict):
+            raise ValueError("过滤条件必须是对象")
+        mask = np.ones(size, dtype=bool)
+        for key, condition in expression.items():
+            if key in ("$and", "$or") and not isinstance(condition, (list, tuple)):
+                raise ValueError(f"{key} 需要条件数组")
+            if key == "$and":
+                for part in condition:
+                    mask &= self.mask(part, size)
+            elif key == "$or":
+                combined = np.zeros(size, dtype=bool)
+                for part in condition:
+                    combined |= self.mask(part, size)
+                mask &= combined
+            elif key in NUMERIC_FIELDS:
+                mask &= self._numeric_mask(key, condition, size)
+            elif key in CATEGORICAL_FIELDS:
+                mask &= self._categorical_mask(key, condition, size)
+            elif key in MULTI_VALUE_FIELDS:
+                mask &= self._multi_value_mask(key, condition, size)
+            else:
+                raise ValueError(f"不支持按 {key} 过滤，可用字段: {', '.join(FILTER_FIELDS)}")
+        return mask
+
+    def _numeric_mask(self, field, condition, size):
+        column = self.numeric[field][:size]
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        mask = np.ones(size, dtype=bool)
+        for operator, value in condition.items():
+            if operator in NUMERIC_OPERATORS:
+                mask &= NUMERIC_OPERATORS[operator](column, _number(field, operator, value))
+            elif operator == "$in":
+                mask &= np.isin(column, _numbers(field, operator, value))
+            elif operator == "$nin":
+                mask &= ~np.isin(column, _numbers(field, operator, value))
+            elif operator == "$exists":
+                mask &= ~np.isnan(column) if value else np.isnan(column)
+            else:
+                raise ValueError(f"{field} 不支持运算符 {operator}")
+        return mask
+
+    def _codes(self, field, values):
+        """把类别值转换成编码，词表里没有的值不会匹配任何行"""
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+        vocabulary = self.vocabulary[field]
+        return np.asarray([vocabulary[category] for category in map(_category, values) if category in vocabulary],
+                          dtype=np.int32)
+
+    def _categorical_mask(self, field, condition, size):
+        column = self.categorical[field][:size]
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        mask = np.ones(size, dtype=bool)
+        for operator, value in condition.items():
+            if operator in ("$eq", "$in"):
+                mask &= np.isin(column, self._codes(field, value))
+            elif operator in ("$ne", "$nin"):
+                mask &= ~np.isin(column, self._codes(field, value))
+            elif operator == "$exists":
+                mask &= (column >= 0) if value else (column < 0)
+            else:
+                raise ValueError(f"{field} 不支持运算符 {operator}")
+        return mask
+
+    def _rows_with(self, field, values, size):
+        """每行命中了 values 中多少个类别"""
+        codes, rows = self.postings[field]
+        hit = np.isin(codes, self._codes(field, _categories(values)))
+        return np.bincount(rows[hit], minlength=size)[:size]
+
+    def _multi_value_mask(self, field, condition, size):
+        if not isinstance(condition, dict):
+            condition = {"$in": condition}
+        mask = np.ones(size, dtype=bool)
+        for operator, value in condition.items():
+            if operator in ("$eq", "$in"):
+                mask &= self._rows_with(field, value, size) > 0
+            elif operator == "$all":
+                wanted = _categories(value)
+                mask &= self._rows_with(field, wanted, size) >= len(wanted)
+            elif operator in ("$ne", "$nin"):
+                mask &= self._rows_with(field, value, size) == 0
+            elif operator == "$exists":
+                codes, rows = self.postings[field]
+                present = np.bincount(rows[codes >= 0], minlength=size)[:size] > 0
+                mask &= present if value else ~present
+            else:
+                raise ValueError(f"{field} 不支持运算符 {operator}")
+        return mask
+
+
+def validate_filter(expression):
+    """检查过滤表达式的字段、运算符和取值（在空的列上求值），有问题时抛出 ValueError"""
+    MetadataColumns(0).mask(expression, 0)
@@ -0,0 +1,214 @@
+"""按组织 _id 缓存的匹配结果卡片
+
+每个组织只整理一次：评估流程使用的 organization 字典（原始字段名），
+以及响应中返回的、已经转换成 JSON 兼容类型的卡片（sanitize_organization_data 的结果）。
+API 启动加载索引时预先读取所有组织的展示字段，之后的请求直接复用卡片；
+索引同步收到某个组织的变更时删除它的卡片，下次用到时重新读取。
+
+卡片在多个请求之间共享，调用方不能修改。
+"""
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+
+# 匹配结果中展示的字段，回填文档时只读取这些字段
+MATCH_RESULT_FIELDS = (
+    "Name", "Description", "Industries", "Specialities", "Staff_Count", "Assets", "Mission",
+    "Narrative", "Tags", "Linkedin_followers", "Popularity", "Partnership", "Event"
+)
+MATCH_RESULT_PROJECTION = {field: 1 for field in MATCH_RESULT_FIELDS}
+
+
+def sanitize_float(value):
+    """确保浮点数是JSON兼容的"""
+    if isinstance(value, (int, float)):
+        if np.isnan(value) or np.isinf(value):
+            return 0.0
+        return float(value)
+    return 0.0
+
+
+def sanitize_organization_data(org_data):
+    """清理组织数据确保JSON兼容"""
+    return {
+        "id": str(org_data["_id"]),
+        "name": str(org_data.get("Name", "")),
+        "description": str(org_data.get("Description", "")),
+        "mission": str(org_data.get("Mission", "")),
+        "industries": org_data.get("Industries", []),
+        "specialities": org_data.get("Specialities", []),
+        "staff_count": int(org_data.get("Staff_Count", 0)),
+        "assets": sanitize_float(org_data.get("Assets", 0.0)),
+        "narrative": str(org_data.get("Narrative", "")),
+        "tags": org_data.get("Tags", []),
+        "linkedin_followers": int(org_data.get("Linkedin_followers", 0)),
+        "popularity": str(org_data.get("Popularity", "")),
+        "contribution": str(org_data.get("Contribution", "")),
+        "partnership": str(org_data.get("Partnership", "")),
+        "event": str(org_data.get("Event", ""))
+    }
+
+
+def match_organization(org):
+    """匹配结果里的 organization 字段"""
+    organization = {"_id": str(org["_id"])}
+    for field in MATCH_RESULT_FIELDS:
+        organization[field] = org.get(field, [] if field in ("Industries", "Specialities", "Tags") else "")
+    return organization
+
+
+def build_card(org):
+    """返回 (organization, card)
+
+    数据不合法（例如 Staff_Count 不是数字）时 card 为 None，
+    构建响应时再调用 sanitize_organization_data，错误和原来一样在那里抛出。
+    """
+    organization = match_organization(org)
+    try:
+        card = sanitize_organization_data(organization)
+    except (TypeError, ValueError):
+        card = None
+    return organization, card
+
+
+class OrganizationCardCache:
+    """{_id: (organization, card)}，超过 max_items 时淘汰最久没有用到的"""
+
+    def __init__(self, max_items=50000):
+        self.max_items = max_items
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0}
+        self._cards = OrderedDict()
+        self._lock = threading.Lock()
+        # 读取数据库期间被同步删除的卡片不能再用读到的旧文档写回
+        self._epoch = 0
+        self._loading = 0
+        self._invalidated = {}
+
+    def get_many(self, org_ids):
+        """返回已缓存的 {_id: (organization, card)}"""
+        found = {}
+        with self._lock:
+            for org_id in org_ids:
+                entry = self._cards.get(org_id)
+                if entry is not None:
+                    self._cards.move_to_end(org_id)
+                    found[org_id] = entry
+            self.stats["hits"] += len(found)
+            self.stats["misses"] += len(org_ids) - len(found)
+        return found
+
+    def put(self, org, since=None):
+        """生成并缓存卡片；since 是开始读取文档时的 epoch，之后被删除过的组织只返回不缓存"""
+        entry = build_card(org)
+        with self._lock:
+            if since is not None and self._invalidated.get(org["_id"], since) > since:
+                return entry
+            self._cards[org["_id"]] = entry
+            self._cards.move_to_end(org["_id"])
+            while len(self._cards) > self.max_items:
+                self._cards.popitem(last=False)
+        return entry
+
+    def invalidate(self, org_id):
+        with self._lock:
+            self._epoch += 1
+            if self._loading:
+                self._invalidated[org_id] = self._epoch
+            if self._cards.pop(org_id, None) is not None:
+                self.stats["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._cards.clear()
+
+    def load(self, collection, org_ids):
+        """一次查询读取 org_ids 的展示字段并生成卡片（最多 max_items 个）
+
+        org_ids 很多时（启动预加载）直接扫描集合，比超大的 $in 更快。
+        """
+        wanted = set(org_ids)
+        entries = {}
+        with self._lock:
+            since = self._epoch
+            self._loading += 1
+        try:
+            for org in collection.find({"_id": {"$in": list(wanted)}} if len(wanted) < 1000 else {},
+                                       MATCH_RESULT_PROJECTION):
+                if org["_id"] in wanted:
+                    entries[org["_id"]] = self.put(org, since)
+                    if len(entries) >= self.max_items:
+                        break
+        finally:
+            with self._lock:
+                self._loading -= 1
+                if not self._loading:
+                    self._invalidated.clear()
+        return entries
+
+    def fetch(self, collection, org_ids):
+        """返回 {_id: (organization, card)}，没有缓存的组织用一次 $in 查询补齐"""
+        entries = self.get_many(org_ids)
+        missing = [org_id for org_id in org_ids if org_id not in entries]
+        if missing:
+            entries.update(self.load(collection, missing))
+        return entries
+
+    def info(self):
+        with self._lock:
+            return {"items": len(self._cards), "max_items": self.max_items, **self.stats}
+
+
+class RequestDocuments:
+    """同一请求内并发流程共享的组织文档
+
+    A/B 流程在两个线程里同时回填结果。每个组织第一次被请求时登记一个 Future，
+    由登记它的线程读取；另一个线程遇到同一组织时等待这个 Future，所以两边都入选的组织只读取一次。
+    每个线程先读完自己登记的组织再等待别人的，不会互相等待。
+    """
+
+    def __init__(self):
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def fetch(self, collection, org_ids, cache):
+        """返回 {_id: (organization, card)}，数据库中已不存在的组织不在结果中"""
+        owned = []
+        futures = {}
+        with self._lock:
+            for org_id in org_ids:
+                future = self._futures.get(org_id)
+                if future is None:
+                    future = self._futures[org_id] = Future()
+                    owned.append(org_id)
+                futures[org_id] = future
+        if owned:
+            try:
+                entries = cache.fetch(collection, owned)
+            except BaseException as e:
+                for org_id in owned:
+                    futures[org_id].set_exception(e)
+                raise
+            for org_id in owned:
+                futures[org_id].set_result(entries.get(org_id))
+        entries = {org_id: future.result() for org_id, future in futures.items()}
+        return {org_id: entry for org_id, entry in entries.items() if entry is not None}
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_card_cache(collection_name, max_items=50000):
+    """每个集合一个卡片缓存"""
+    with _caches_lock:
+        cache = _caches.get(collection_name)
+        if cache is None:
+            cache = _caches[collection_name] = OrganizationCardCache(max_items)
+        return cache
+
+
+def card_cache_info():
+    with _caches_lock:
+        return {name: cache.info() for name, cache in _caches.items()}
@@ -0,0 +1,119 @@
+"""评分和问卷反馈的批量写入
+
+Streamlit 每个会话保存评分时不再各自连接数据库，而是把写操作放进进程内的队列，
+后台线程把同一时间段内所有会话的写操作合并成一次 bulk_write。
+文档的 _id 在客户端生成，插入还没写入时就可以拿它去关联后续的反馈更新；
+队列按顺序写入，同一个文档的插入总在更新之前。
+
+每批最多 max_batch 个操作，第一个操作入队后最多等待 flush_interval 秒就写入；
+队列最多积压 max_pending 个操作，满了直接拒绝。调用方通过返回的 Future
+等待自己的写操作完成（带超时），写入失败时在 Future 上拿到异常。
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from bson.objectid import ObjectId
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+
+
+class WriteQueueFullError(Exception):
+    """待写入的操作太多"""
+
+
+class RatingWriter:
+    def __init__(self, collection, max_batch=200, flush_interval=0.2, max_pending=5000):
+        self.collection = collection
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.stats = {"operations": 0, "batches": 0, "failed": 0, "rejected": 0}
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"rating-writer-{collection.name}", daemon=True)
+        self._thread.start()
+
+    def insert(self, document):
+        """插入文档，Future 的结果是文档的 _id（没有 _id 时在客户端生成）"""
+        document.setdefault("_id", ObjectId())
+        return self._submit(InsertOne(document), document["_id"])
+
+    def update(self, document_id, update):
+        """更新单个文档，Future 的结果为 True"""
+        return self._submit(UpdateOne({"_id": document_id}, update), True)
+
+    def _submit(self, operation, result):
+        future = Future()
+        try:
+            self._queue.put_nowait((operation, result, future))
+        except queue.Full:
+            with self._lock:
+                self.stats["rejected"] += 1
+            raise WriteQueueFullError("待写入的评分过多，请稍后重试")
+        return future
+
+    def _run(self):
+        while not self._stop.is_set() or not self._queue.empty():
+            try:
+                first = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _write(self, batch):
+        try:
+            # ordered=True 保证同一文档的插入先于更新
+            self.collection.bulk_write([operation for operation, _, _ in batch], ordered=True)
+        except (BulkWriteError, PyMongoError) as e:
+            print(f"批量写入评分失败，逐条重试: {e}")
+            self._write_one_by_one(batch)
+        else:
+            for _, result, future in batch:
+                future.set_result(result)
+        with self._lock:
+            self.stats["operations"] += len(batch)
+            self.stats["batches"] += 1
+
+    def _write_one_by_one(self, batch):
+        """有序批量写在第一个错误处停止，之前的操作已经写入，重试时重复插入视为成功"""
+        for operation, result, future in batch:
+            try:
+                self.collection.bulk_write([operation])
+            except BulkWriteError as e:
+                if isinstance(operation, InsertOne) and all(
+                        error.get("code") == 11000 for error in e.details.get("writeErrors", [])):
+                    future.set_result(result)
+                else:
+                    self._fail(future, e)
+            except DuplicateKeyError:
+                future.set_result(result)
+            except PyMongoError as e:
+                self._fail(future, e)
+            else:
+                future.set_result(result)
+
+    def _fail(self, future, error):
+        with self._lock:
+            self.stats["failed"] += 1
+        future.set_exception(error)
+
+    def info(self):
+        with self._lock:
+            return {"pending": self._queue.qsize(), **self.stats}
+
+    def close(self, timeout=10.0):
+        """写完队列中剩余的操作后停止"""
+        self._stop.set()
+        self._thread.join(timeout)
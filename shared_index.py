@@ -0,0 +1,500 @@
+"""多个 uvicorn worker 共用一份嵌入索引（multiprocessing.shared_memory）
+
+每个 worker 各自加载索引时，嵌入矩阵的内存占用会乘以 worker 数。这个模式下由一个
+单独的发布进程加载索引并运行增量同步，把每个集合的数据发布到共享内存：
+
+    <前缀>_<集合>            清单段：序号、代数和当前数据段的名字
+    <前缀>_<集合>_<代数>     数据段：JSON 头 + 各数组（按 64 字节对齐）
+
+数据段中的数组：两个嵌入字段按列拼接的矩阵（即 search_hybrid 使用的 stacked 矩阵，
+单字段检索用它的列切片，不需要再存一份）、每个字段的 valid 掩码、_id（按行存放一份，
+按 _id 排序再存一份用于二分查找行号），元数据过滤列，以及变更日志（每个变更过的 _id
+最后一次变更时索引的 generation）。worker 直接在共享内存上构造只读的 numpy 视图，
+_id 按行取用时才解码，不复制数据。
+
+索引有变更时，发布进程写出一个新代数的数据段，再更新清单；清单用序号做顺序锁
+（写入前后各加一，读到奇数或前后不一致就重读）。旧的数据段随即 unlink，
+已经映射它的 worker 不受影响。worker 在下一次检查时于后台线程换到新代数：
+按变更日志只删除变了的组织卡片，BM25 索引只重读这些组织，IVF 列表直接沿用。
+
+用法:
+    python shared_index.py --prefix causeconnect --refresh 30 &
+    SHARED_INDEX_PREFIX=causeconnect uvicorn api2:app --workers 4
+"""
+import argparse
+import json
+import os
+import re
+import signal
+import struct
+import threading
+import time
+import uuid
+from multiprocessing import shared_memory
+
+import numpy as np
+from bson.objectid import ObjectId
+
+from embedding_index import CollectionIndex, get_collection_index
+from lexical_index import LEXICAL_FIELDS
+from metadata_index import MetadataColumns
+
+SHARED_FORMAT_VERSION = 2
+ALIGNMENT = 64
+
+# 清单段：序号(uint64) 代数(uint64) 名字长度(uint64) 名字
+MANIFEST_SIZE = 4096
+MANIFEST_HEADER = struct.Struct("<QQQ")
+
+
+def segment_name(prefix, collection_name, generation=None):
+    slug = re.sub(r"[^0-9A-Za-z]+", "_", collection_name).strip("_")
+    name = f"{prefix}_{slug}"
+    return name if generation is None else f"{name}_{generation}"
+
+
+# 本进程发布的数据段：同一进程里连接时不能再从 resource_tracker 注销，否则 unlink 时会重复注销
+_published = set()
+
+
+def _untrack(segment):
+    """不让 resource_tracker 在本进程退出时删除这个段"""
+    from multiprocessing import resource_tracker
+    resource_tracker.unregister(segment._name, "shared_memory")
+    return segment
+
+
+class _AttachedSegment(shared_memory.SharedMemory):
+    """worker 映射的段：换代后旧索引的数组可能还被进行中的请求引用，
+    这时不能 close，等数组都释放后由 mmap 自己解除映射"""
+
+    def __del__(self):
+        try:
+            self.close()
+        except BufferError:
+            pass
+
+
+def _attach(name):
+    """连接一个已存在的段；不交给 resource_tracker 管理，否则 worker 退出时会把段删掉"""
+    try:
+        return _AttachedSegment(name=name, track=False)
+    except TypeError:
+        # Python 3.13 之前没有 track 参数
+        segment = _AttachedSegment(name=name)
+        return segment if name in _published else _untrack(segment)
+
+
+def _encode_ids(ids, id_type=None):
+    """_id 编码成定长数组；墓碑行（None）的 present 为 False"""
+    present = np.array([org_id is not None for org_id in ids], dtype=bool)
+    if id_type is None:
+        id_type = "objectid" if all(isinstance(org_id, ObjectId) for org_id in ids if org_id is not None) else "str"
+    if id_type == "objectid":
+        raw = np.zeros((len(ids), 12), dtype=np.uint8)
+        for row, org_id in enumerate(ids):
+            if org_id is not None:
+                raw[row] = np.frombuffer(org_id.binary, dtype=np.uint8)
+        return id_type, raw, present
+    return id_type, np.array([str(org_id) if org_id is not None else "" for org_id in ids], dtype="U64"), present
+
+
+def _sort_keys(id_type, raw):
+    """用于排序和二分查找的键；S12 比较时会去掉末尾的 0 字节，对定长 12 字节的 _id 仍然一一对应"""
+    return raw.view("S12").ravel() if id_type == "objectid" else raw
+
+
+def _decode_id(id_type, raw):
+    return ObjectId(raw.tobytes()) if id_type == "objectid" else str(raw)
+
+
+class SharedIds:
+    """共享内存上按行存放的 _id，取用时才解码成 ObjectId / str"""
+
+    def __init__(self, id_type, raw, present):
+        self.id_type = id_type
+        self.raw = raw
+        self.present = present
+
+    def __len__(self):
+        return len(self.present)
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [self[i] for i in range(*row.indices(len(self)))]
+        return _decode_id(self.id_type, self.raw[row]) if self.present[row] else None
+
+    def __iter__(self):
+        return (self[row] for row in range(len(self)))
+
+
+class SharedRowOf:
+    """只读的 {_id: 行号}：发布进程按 _id 排好序，查找时二分"""
+
+    def __init__(self, id_type, keys, rows):
+        self.id_type = id_type
+        self._keys = keys
+        self._rows = rows
+        self._sorted = _sort_keys(id_type, keys)
+
+    def _position(self, org_id):
+        if self.id_type == "objectid":
+            if not isinstance(org_id, ObjectId):
+                return None
+            # 与 S12 元素的取值方式一致，去掉末尾的 0 字节再比较
+            key = org_id.binary.rstrip(b"\0")
+        elif isinstance(org_id, str):
+            key = org_id
+        else:
+            return None
+        position = int(np.searchsorted(self._sorted, key))
+        if position < len(self._sorted) and self._sorted[position] == key:
+            return position
+        return None
+
+    def get(self, org_id, default=None):
+        position = self._position(org_id)
+        return default if position is None else int(self._rows[position])
+
+    def __getitem__(self, org_id):
+        position = self._position(org_id)
+        if position is None:
+            raise KeyError(org_id)
+        return int(self._rows[position])
+
+    def __contains__(self, org_id):
+        return self._position(org_id) is not None
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __iter__(self):
+        return (_decode_id(self.id_type, key) for key in self._keys)
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        return ((_decode_id(self.id_type, key), int(row)) for key, row in zip(self._keys, self._rows))
+
+
+def _write_manifest(manifest, generation, name):
+    """顺序锁：序号变成奇数 -> 写入 -> 序号变成偶数"""
+    sequence = MANIFEST_HEADER.unpack_from(manifest.buf)[0]
+    encoded = name.encode("utf-8")
+    struct.pack_into("<Q", manifest.buf, 0, sequence + 1)
+    struct.pack_into(f"<QQ{len(encoded)}s", manifest.buf, 8, generation, len(encoded), encoded)
+    struct.pack_into("<Q", manifest.buf, 0, sequence + 2)
+
+
+def read_manifest(manifest):
+    """返回 (代数, 数据段名)；发布进程还没有写入时返回 (0, None)"""
+    while True:
+        before, generation, length = MANIFEST_HEADER.unpack_from(manifest.buf)
+        if before % 2:
+            time.sleep(0.001)
+            continue
+        name = bytes(manifest.buf[MANIFEST_HEADER.size:MANIFEST_HEADER.size + length]).decode("utf-8")
+        if MANIFEST_HEADER.unpack_from(manifest.buf)[0] == before:
+            return generation, name or None
+
+
+class SharedIndexPublisher:
+    """在发布进程中把一个集合的索引写到共享内存"""
+
+    def __init__(self, collection, prefix):
+        self.collection = collection
+        self.prefix = prefix
+        # 已发布的是索引的哪一代（CollectionIndex.generation）
+        self.index_generation = None
+        # 发布进程重启后行号可能完全不同，worker 看到不同的 publisher 时不沿用旧代数的派生结构
+        self.publisher = uuid.uuid4().hex
+        self._segment = None
+        # 清单在发布进程退出后保留：worker 一直连着同一个清单，发布进程重启后它们也能发现新代数
+        name = segment_name(prefix, collection.name)
+        try:
+            self._manifest = _untrack(shared_memory.SharedMemory(name=name, create=True, size=MANIFEST_SIZE))
+        except FileExistsError:
+            # 上一次发布进程留下的清单，沿用它，代数接着往上加
+            self._manifest = _attach(name)
+        self.generation = read_manifest(self._manifest)[0]
+
+    def publish(self, index):
+        """索引有变更时写出新的数据段并切换清单，返回是否发布了新代数
+
+        清单中的代数是发布次数，每次加一，发布进程重启后也不会回退；
+        索引自己的 generation 另外记在头里。
+        """
+        metadata = index.metadata_columns(self.collection)
+        with index._lock:
+            if index.change_log is None:
+                # 第一次发布之前的变更不需要记录：还没有 worker 映射过这个发布进程的更早代数
+                index.change_log = {}
+            if index.generation == self.index_generation:
+                return False
+            size = index.size
+            stacked, layout = index._stacked_matrix()
+            index_generation = index.generation
+            generation = self.generation + 1
+            id_type, raw_ids, present = _encode_ids(index.ids[:size])
+            live = np.flatnonzero(present)
+            order = np.argsort(_sort_keys(id_type, raw_ids[live]), kind="stable")
+            changed = list(index.change_log.items())
+            _, changed_ids, _ = _encode_ids([org_id for org_id, _ in changed], id_type)
+            arrays = {
+                "stacked": stacked[:size],
+                "ids": raw_ids,
+                "present": present,
+                "ids.keys": raw_ids[live][order],
+                "ids.rows": live[order].astype(np.int64),
+                "changes.ids": changed_ids,
+                "changes.generation": np.array([changed_generation for _, changed_generation in changed], dtype=np.int64)
+            }
+            arrays.update({f"valid.{field}": valid[:size] for field, valid in index.valid.items()})
+            metadata_arrays, vocabulary = metadata.export_arrays(size)
+            arrays.update({f"metadata.{key}": array for key, array in metadata_arrays.items()})
+
+            header = {
+                "format_version": SHARED_FORMAT_VERSION,
+                "collection": self.collection.name,
+                "publisher": self.publisher,
+                "generation": generation,
+                "index_generation": index_generation,
+                "rows": size,
+                "layout": layout,
+                "id_type": id_type,
+                "vocabulary": vocabulary,
+                "arrays": {}
+            }
+            # JSON 头的长度取决于各数组的偏移，先按足够大的头预留空间
+            offset = _align(1 << 20)
+            for key, array in arrays.items():
+                header["arrays"][key] = {"offset": offset, "shape": list(array.shape), "dtype": array.dtype.str}
+                offset = _align(offset + array.nbytes)
+            encoded = json.dumps(header).encode("utf-8")
+            if len(encoded) + 8 > 1 << 20:
+                raise ValueError(f"集合 {self.collection.name} 的共享内存头超过 1MB")
+
+            name = segment_name(self.prefix, self.collection.name, generation)
+            try:
+                segment = shared_memory.SharedMemory(name=name, create=True, size=offset)
+            except FileExistsError:
+                # 清单丢失后遗留的同名段，没有 worker 能通过清单找到它
+                stale = shared_memory.SharedMemory(name=name)
+                stale.close()
+                stale.unlink()
+                segment = shared_memory.SharedMemory(name=name, create=True, size=offset)
+            _published.add(name)
+            struct.pack_into("<Q", segment.buf, 0, len(encoded))
+            segment.buf[8:8 + len(encoded)] = encoded
+            for key, array in arrays.items():
+                spec = header["arrays"][key]
+                target = np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf, offset=spec["offset"])
+                target[...] = array
+                del target
+
+        _write_manifest(self._manifest, generation, name)
+        previous, self._segment = self._segment, segment
+        self.generation, self.index_generation = generation, index_generation
+        if previous is not None:
+            # 已经映射旧段的 worker 不受 unlink 影响
+            previous.close()
+            previous.unlink()
+            _published.discard(previous.name)
+        print(f"已发布集合 {self.collection.name} 第 {generation} 代: {size} 行, {offset / 2**20:.1f} MB")
+        return True
+
+    def close(self):
+        """删除当前数据段（已映射的 worker 不受影响），清单保留"""
+        if self._segment is not None:
+            self._segment.close()
+            self._segment.unlink()
+            _published.discard(self._segment.name)
+            self._segment = None
+        self._manifest.close()
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class SharedAttachment:
+    """worker 中映射的一个数据段，以及何时再检查清单"""
+
+    def __init__(self, manifest, segment, generation, check_interval, publisher, changes):
+        self.manifest = manifest
+        self.segment = segment
+        self.generation = generation
+        self.check_interval = check_interval
+        self.publisher = publisher
+        # 变更日志：(SharedIds, 每个 _id 最后一次变更时的索引 generation)
+        self.changes = changes
+        self._next_check = time.monotonic() + check_interval
+
+    def stale(self):
+        """清单中的代数比已映射的新（最多每 check_interval 秒读一次清单）"""
+        now = time.monotonic()
+        if now < self._next_check:
+            return False
+        self._next_check = now + self.check_interval
+        return read_manifest(self.manifest)[0] != self.generation
+
+    def changed_since(self, index_generation):
+        """索引 generation 之后变更过的 _id"""
+        ids, generations = self.changes
+        return [ids[row] for row in np.flatnonzero(generations > index_generation)]
+
+
+def attach_index(collection_name, prefix, check_interval=5.0, manifest=None, attempts=20):
+    """映射发布进程写出的最新代数，返回只读的 CollectionIndex；发布进程还没有运行时返回 None"""
+    if manifest is None:
+        try:
+            manifest = _attach(segment_name(prefix, collection_name))
+        except FileNotFoundError:
+            return None
+    for _ in range(attempts):
+        generation, name = read_manifest(manifest)
+        if name is None:
+            return None
+        try:
+            segment = _attach(name)
+        except FileNotFoundError:
+            # 读清单和连接之间发布了新代数，旧段已经 unlink，重读清单
+            time.sleep(0.05)
+            continue
+        return _build_index(collection_name, manifest, segment, generation, check_interval)
+    return None
+
+
+def _build_index(collection_name, manifest, segment, generation, check_interval):
+    buffer = segment.buf
+    header_length = struct.unpack_from("<Q", buffer, 0)[0]
+    header = json.loads(bytes(buffer[8:8 + header_length]).decode("utf-8"))
+    if header.get("format_version") != SHARED_FORMAT_VERSION:
+        raise ValueError(f"共享内存索引版本不兼容: {header.get('format_version')}")
+
+    arrays = {}
+    for key, spec in header["arrays"].items():
+        array = np.ndarray(tuple(spec["shape"]), dtype=np.dtype(spec["dtype"]), buffer=buffer, offset=spec["offset"])
+        array.flags.writeable = False
+        arrays[key] = array
+
+    id_type = header["id_type"]
+    stacked = arrays["stacked"]
+    layout = {field: tuple(columns) for field, columns in header["layout"].items()}
+    matrices = {field: stacked[:, start:end] for field, (start, end) in layout.items()}
+    valid = {field: arrays[f"valid.{field}"] for field in layout}
+
+    index = CollectionIndex(collection_name, SharedIds(id_type, arrays["ids"], arrays["present"]), matrices, valid,
+                            row_of=SharedRowOf(id_type, arrays["ids.keys"], arrays["ids.rows"]), free_rows=[])
+    index.generation = header["index_generation"]
+    index._stacked = stacked
+    index._stacked_layout = layout
+    index.metadata = MetadataColumns.from_arrays(
+        {key[len("metadata."):]: array for key, array in arrays.items() if key.startswith("metadata.")},
+        header["vocabulary"])
+    changed_ids = arrays["changes.ids"]
+    changes = (SharedIds(id_type, changed_ids, np.ones(len(changed_ids), dtype=bool)), arrays["changes.generation"])
+    index.shared = SharedAttachment(manifest, segment, generation, check_interval, header["publisher"], changes)
+    return index
+
+
+def refresh_index(index, collection, prefix=None, check_interval=5.0):
+    """映射共享内存中的新代数（由 embedding_index 在后台线程中调用），没有新代数时返回 None
+
+    index 是各自加载的索引时映射 prefix 下的最新代数；已经是共享内存索引时重读它的清单。
+    """
+    from organization_cards import get_card_cache
+
+    cards = get_card_cache(index.name)
+    if index.shared is None:
+        refreshed = attach_index(index.name, prefix, check_interval)
+        if refreshed is not None:
+            # 之后由发布进程同步，卡片也改为按发布的变更日志失效
+            cards.clear()
+            print(f"集合 {index.name} 改用共享内存索引（第 {refreshed.shared.generation} 代）")
+        return refreshed
+
+    attachment = index.shared
+    refreshed = attach_index(index.name, None, attachment.check_interval, manifest=attachment.manifest)
+    if refreshed is None or refreshed.shared.generation == attachment.generation:
+        return None
+    if refreshed.shared.publisher != attachment.publisher or refreshed.generation < index.generation:
+        # 发布进程重启过，行号对不上：卡片全部作废，BM25 / IVF 之后按需重建
+        cards.clear()
+    else:
+        changed = refreshed.shared.changed_since(index.generation)
+        for org_id in changed:
+            cards.invalidate(org_id)
+        _carry_derived(index, refreshed, collection, changed)
+    print(f"集合 {index.name} 切换到共享索引第 {refreshed.shared.generation} 代")
+    return refreshed
+
+
+def _carry_derived(index, refreshed, collection, changed):
+    """沿用旧代数上已经建好的 IVF 列表和 BM25 索引（行号不变），BM25 只重读变更过的组织
+
+    IVF 构建之后新增和变更过的行总是参与打分，变更过多时由 ann_index 在后台重建。
+    """
+    rows = {org_id: refreshed._row_of.get(org_id) for org_id in changed}
+    rows = {org_id: row for org_id, row in rows.items() if row is not None}
+    refreshed.ann = dict(index.ann)
+    for ivf in refreshed.ann.values():
+        ivf.mark_changed(list(rows.values()))
+    lexical = index.lexical
+    if lexical is None:
+        return
+    # 被删除的组织 valid 已经清零，检索时不会返回，不需要改 BM25
+    if rows:
+        for org in collection.find({"_id": {"$in": list(rows)}}, {field: 1 for field in LEXICAL_FIELDS}):
+            lexical.set_row(rows[org["_id"]], org)
+    refreshed.lexical = lexical
+
+
+def main():
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+
+    from index_sync import start_index_sync
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="把嵌入索引发布到共享内存，供多个 API worker 共用")
+    parser.add_argument("--prefix", default=os.getenv("SHARED_INDEX_PREFIX", "causeconnect"),
+                        help="共享内存段名前缀，与 worker 的 SHARED_INDEX_PREFIX 一致")
+    parser.add_argument("--collection", action="append",
+                        help="集合名，可重复；默认发布非营利和营利两个集合")
+    parser.add_argument("--refresh", type=float, default=30.0, help="检查索引变更并重新发布的间隔（秒）")
+    parser.add_argument("--poll-interval", type=float, default=float(os.getenv("INDEX_SYNC_POLL_SECONDS", "60")),
+                        help="不支持 change stream 时轮询数据库的间隔（秒）")
+    args = parser.parse_args()
+    # 发布进程自己从数据库加载索引，不能去映射共享内存（.env 里可能和 worker 共用这个变量）
+    os.environ.pop("SHARED_INDEX_PREFIX", None)
+
+    client = MongoClient(os.getenv("MONGODB_URI"))
+    db = client[os.getenv("MONGODB_DB_NAME")]
+    collections = [db[name] for name in args.collection or [
+        os.getenv("MONGODB_COLLECTION_NONPROFIT"),
+        os.getenv("MONGODB_COLLECTION_FORPROFIT")
+    ]]
+
+    publishers = [SharedIndexPublisher(collection, args.prefix) for collection in collections]
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    synchronizers = start_index_sync(collections, poll_interval=args.poll_interval)
+    try:
+        while not stop.is_set():
+            for collection, publisher in zip(collections, publishers):
+                publisher.publish(get_collection_index(collection))
+            stop.wait(args.refresh)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for synchronizer in synchronizers:
+            synchronizer.stop()
+        for publisher in publishers:
+            publisher.close()
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,13 @@ import pandas as pd
 from streamlit.runtime.scriptrunner import get_script_run_ctx
 from pymongo import MongoClient
 from dotenv import load_dotenv
+import atexit
 import os
+from html import escape
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from rating_writer import RatingWriter
 
 def get_api_url():
     if os.environ.get('RENDER_INTERNAL_HOSTNAME'):
@@ -22,14 +28,76 @@ def get_api_url():
 
 API_URL = get_api_url()
 
+# 连接超时和读取超时（秒）；完整版流程要调用多次LLM，读取超时要留够
+API_CONNECT_TIMEOUT = float(os.getenv("API_CONNECT_TIMEOUT", "5"))
+API_READ_TIMEOUT = float(os.getenv("API_READ_TIMEOUT", "300"))
+API_MAX_ATTEMPTS = int(os.getenv("API_MAX_ATTEMPTS", "3"))
+# 这些状态码说明服务暂时不可用（例如Render实例正在重启），值得重试
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+# POST（匹配请求）不是幂等的：读取超时或 502/504 时服务端可能还在运行流程，
+# 重试会把LLM调用再做一遍，只在请求肯定没有被处理时重试
+NON_IDEMPOTENT_RETRY_STATUS_CODES = {429, 503}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+# 服务端 Retry-After 最多等待多少秒
+API_RETRY_AFTER_MAX = float(os.getenv("API_RETRY_AFTER_MAX", "60"))
+
+@st.cache_resource
+def get_http_session():
+    """进程内所有会话共用的HTTP会话，保持长连接"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=int(os.getenv("API_POOL_SIZE", "32")))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def retry_after_seconds(response):
+    """响应头 Retry-After 的秒数，没有或不是数字时返回 None"""
+    try:
+        return min(max(float(response.headers["Retry-After"]), 0.0), API_RETRY_AFTER_MAX)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def request_with_retry(session, method, url, **kwargs):
+    """带超时的请求，按带随机抖动的指数退避重试；响应带 Retry-After 时按它等待
+
+    GET 等幂等请求在连接失败、超时和 RETRY_STATUS_CODES 时重试；
+    POST 只在连接失败和 NON_IDEMPOTENT_RETRY_STATUS_CODES 时重试。
+    """
+    kwargs.setdefault("timeout", (API_CONNECT_TIMEOUT, API_READ_TIMEOUT))
+    if method.upper() in IDEMPOTENT_METHODS:
+        retry_errors = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+        retry_status_codes = RETRY_STATUS_CODES
+    else:
+        # ConnectTimeout 也是 ConnectionError；ReadTimeout 不重试
+        retry_errors = (requests.exceptions.ConnectionError,)
+        retry_status_codes = NON_IDEMPOTENT_RETRY_STATUS_CODES
+    for attempt in range(API_MAX_ATTEMPTS):
+        last_attempt = attempt == API_MAX_ATTEMPTS - 1
+        delay = None
+        try:
+            response = session.request(method, url, **kwargs)
+        except retry_errors as e:
+            if last_attempt:
+                raise
+            print(f"请求 {url} 失败，准备重试: {e}")
+        else:
+            if response.status_code not in retry_status_codes or last_attempt:
+                return response
+            print(f"请求 {url} 返回 {response.status_code}，准备重试")
+            delay = retry_after_seconds(response)
+        if delay is None:
+            # full jitter：在 [0, 2^attempt] 秒内随机等待，避免大量会话同时重试
+            delay = random.uniform(0, 2 ** attempt)
+        time.sleep(delay)
+
 # API调用函数
 def call_api(endpoint, data=None):
     try:
         url = f"{API_URL}/{endpoint}"
         if data:
-            response = requests.post(url, json=data)
+            response = request_with_retry(get_http_session(), "POST", url, json=data)
         else:
-            response = requests.get(url)
+            response = request_with_retry(get_http_session(), "GET", url)
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
@@ -146,18 +214,62 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-def call_matching_api(input_data, algorithm_type):
-    """调用匹配API"""
+def call_matching_api(input_data, algorithm_type, session=None):
+    """调用匹配API；在后台线程中调用时需要传入 session（线程中不能使用Streamlit缓存）"""
     api_url = f"{get_api_url()}/test/complete-matching-process"
     if algorithm_type == "simple":
         api_url += "-simple"
     
-    response = requests.post(api_url, json=input_data)
+    response = request_with_retry(session or get_http_session(), "POST", api_url, json=input_data)
     if response.status_code == 200:
         return response.json()
     else:
         raise Exception(f"API调用失败: {response.status_code}")
 
+# 每组结果由哪个算法生成
+SET_ALGORITHMS = {"A": "complex", "B": "simple"}
+
+@st.cache_resource
+def get_fetch_executor():
+    """进程内共用的线程池，后台获取匹配结果"""
+    return ThreadPoolExecutor(max_workers=int(os.getenv("API_FETCH_WORKERS", "16")))
+
+def start_fetch(input_data, set_label):
+    """在后台线程中获取一组匹配结果，Future 存在 session state 中"""
+    st.session_state.pending_results[set_label] = get_fetch_executor().submit(
+        call_matching_api, input_data, SET_ALGORITHMS[set_label], get_http_session())
+
+def collect_fetched_results():
+    """把已经完成的后台请求结果放进 session state（不等待）"""
+    for set_label, future in list(st.session_state.pending_results.items()):
+        if future.done():
+            del st.session_state.pending_results[set_label]
+            try:
+                st.session_state.results[set_label] = future.result()
+            except Exception as e:
+                # 失败的请求在需要这组结果时重新发起
+                print(f"后台获取 Set {set_label} 失败: {e}")
+
+def ensure_set_loaded(set_label, message=None):
+    """需要某组结果时调用：还在获取就等它完成，失败过就重新请求；返回是否拿到结果"""
+    if set_label in st.session_state.results:
+        return True
+    future = st.session_state.pending_results.pop(set_label, None)
+    try:
+        with st.spinner(message or f'Loading Set {set_label}...'):
+            if future is not None:
+                try:
+                    st.session_state.results[set_label] = future.result()
+                    return True
+                except Exception as e:
+                    print(f"后台获取 Set {set_label} 失败，重新请求: {e}")
+            st.session_state.results[set_label] = call_matching_api(
+                st.session_state.search_input, SET_ALGORITHMS[set_label])
+            return True
+    except Exception as e:
+        st.error(f"Error loading Set {set_label}: {str(e)}")
+        return False
+
 def display_match_card(match, index, scores_key):
     """Display a single match as a card"""
     org = match["organization"]
@@ -222,121 +334,155 @@ def display_match_card(match, index, scores_key):
             else:
                 st.markdown(f'<p class="score-low">Poor Match (Score: {score})</p>', unsafe_allow_html=True)
 
+# 每页显示的组织卡片数
+CARDS_PER_PAGE = int(os.getenv("CARDS_PER_PAGE", "5"))
+
+STATUS_COLORS = {
+    "Match": "#28a745",
+    "Unmatch": "#dc3545",
+    "Neutral": "#ffc107",
+    "Not Rated": "#6c757d"
+}
+
+def format_list(value):
+    if isinstance(value, (list, tuple)):
+        return ", ".join(str(item) for item in value)
+    return str(value or "")
+
+@st.cache_data(max_entries=5000, ttl=3600, show_spinner=False)
+def render_card_html(org_id, _org):
+    """组织卡片的HTML，按组织id缓存（_org 不参与缓存键），所有会话共用"""
+    popularity_badge = " 🔥 Popular!" if _org.get('popularity', 'No') == 'Yes' else ""
+    mission = f"<p><b>Mission:</b> <i>{escape(_org['mission'])}</i></p>" if _org.get('mission') else ""
+    return f"""
+        <div style='background-color: #f8f9fa; padding: 20px; border: 1px solid #e9ecef; border-radius: 8px; margin: 15px 0;'>
+            <h3>{escape(_org['name'])}{popularity_badge}</h3>
+            {mission}
+            <p><b>Industry:</b> {escape(format_list(_org.get('industries', '')))}</p>
+            <p><b>Specialities:</b> {escape(format_list(_org.get('specialities', '')))}</p>
+            <p><b>LinkedIn Followers: {escape(str(_org.get('linkedin_followers', 'N/A')))}</b></p>
+            <p><b>Description:</b></p>
+            <p>{escape(_org.get('description', ''))}</p>
+        </div>
+        """
+
+def status_badge_html(status, score):
+    score_display = f"({score}/10)" if score is not None else ""
+    return f"""
+        <div style='padding: 8px 15px; 
+        background-color: {STATUS_COLORS.get(status, "#6c757d")}; 
+        color: white; 
+        border-radius: 5px; 
+        text-align: center; 
+        margin-top: 10px;'>
+            {status} {score_display}
+        </div>
+        """
+
+RATING_HINT_HTML = """
+    <div style='font-size: 0.9em; margin-bottom: 10px;'>
+        <span style='color: #d32f2f; font-weight: bold;'>* Please rate this organization:</span>
+        <br>
+        <span style='color: #666;'>
+            Not Rated | 0-4: Unmatch | 5: Neutral | 6-10: Match
+        </span>
+    </div>
+"""
+
 def display_matches(results, set_label):
-    """显示匹配结果"""
-    if f"scores_set_{set_label}" not in st.session_state:
-        st.session_state[f"scores_set_{set_label}"] = {}
-
-    for idx, match in enumerate(results["matching_results"]):
-        # 如果是新页面的第一个项目，添加锚点
-        if idx == 0:
-            st.markdown(f'<div id="set_{set_label}_top"></div>', unsafe_allow_html=True)
-        
-        org = match["organization"]
+    """分页显示匹配结果，每次重新运行只渲染当前页的卡片"""
+    scores_key = f"scores_set_{set_label}"
+    page_key = f"page_set_{set_label}"
+    if scores_key not in st.session_state:
+        st.session_state[scores_key] = {}
+    if page_key not in st.session_state:
+        st.session_state[page_key] = 0
+    scores = st.session_state[scores_key]
+    matches = results["matching_results"]
+
+    # 评分记录只在第一次显示时创建，之后只在分数变化时更新
+    for idx, match in enumerate(matches):
         match_id = f"{set_label}_{idx}"
-        
-        # 确保每个match_id的数据结构存在
-        if match_id not in st.session_state[f"scores_set_{set_label}"]:
-            st.session_state[f"scores_set_{set_label}"][match_id] = {
+        if match_id not in scores:
+            org = match["organization"]
+            scores[match_id] = {
                 "score": None,
                 "status": "Not Rated",
                 "rated": False,
+                "rated_at": None,
                 "org_name": org['name'],
                 "org_id": org.get('id', ''),
                 "org_data": org  # 存储完整的组织数据
             }
 
+    page_count = max(1, -(-len(matches) // CARDS_PER_PAGE))
+    page = min(st.session_state[page_key], page_count - 1)
+    rated_count = sum(1 for data in scores.values() if data.get("rated", False))
+
+    st.markdown(f'<div id="set_{set_label}_top"></div>', unsafe_allow_html=True)
+    st.caption(f"Page {page + 1} of {page_count} · {rated_count}/{len(matches)} rated")
+
+    first = page * CARDS_PER_PAGE
+    for idx in range(first, min(first + CARDS_PER_PAGE, len(matches))):
+        org = matches[idx]["organization"]
+        match_id = f"{set_label}_{idx}"
+        current_data = scores[match_id]
+
         with st.container():
-            st.markdown("""
-                <div style='background-color: #f8f9fa; padding: 20px; border: 1px solid #e9ecef; border-radius: 8px; margin: 15px 0;'>
-                """, unsafe_allow_html=True)
-            
-            # 组织名称和热门标签
-            popularity_badge = "🔥 Popular!" if org.get('popularity', 'No') == 'Yes' else ""
-            st.markdown(f"### {org['name']} {popularity_badge}")
-            
-            # 基本信息显示
-            if org.get('mission'):
-                st.markdown(f"**Mission:** *{org['mission']}*")
-            st.markdown(f"**Industry:** {org.get('industries', '')}")
-            st.markdown(f"**Specialities:** {org.get('specialities', '')}")
-            
-            # LinkedIn信息 - 修正字段名
-            linkedin_info = f"LinkedIn Followers: {org.get('Linkedin_followers', 'N/A')}"
-            st.markdown(f"**{linkedin_info}**")
-            
-            # 描述
-            st.markdown("**Description:**")
-            st.write(org.get('description', ''))
-            
+            st.markdown(render_card_html(org.get('id') or org['name'], org), unsafe_allow_html=True)
+
             # 评分部分
             col1, col2 = st.columns([3, 1])
             with col1:
-                st.markdown("""
-                    <div style='font-size: 0.9em; margin-bottom: 10px;'>
-                        <span style='color: #d32f2f; font-weight: bold;'>* Please rate this organization:</span>
-                        <br>
-                        <span style='color: #666;'>
-                            Not Rated | 0-4: Unmatch | 5: Neutral | 6-10: Match
-                        </span>
-                    </div>
-                """, unsafe_allow_html=True)
-                
-                # 评分选项
+                st.markdown(RATING_HINT_HTML, unsafe_allow_html=True)
+
+                # 翻页回来时单选框按已保存的分数恢复
                 score_selection = st.radio(
                     label=f"Rating for {org['name']}",
                     options=["Not Rated"] + list(range(0, 11)),
                     horizontal=True,
                     key=f"radio_{match_id}",
-                    index=0,
+                    index=0 if current_data["score"] is None else current_data["score"] + 1,
                     label_visibility="collapsed"
                 )
-                
-                # 更新评分状态
-                current_data = st.session_state[f"scores_set_{set_label}"][match_id]
-                if score_selection != "Not Rated":
-                    score = int(score_selection)
-                    status = "Match" if score > 5 else "Unmatch" if score < 5 else "Neutral"
-                    current_data.update({
-                        "score": score,
-                        "status": status,
-                        "rated": True,
-                        "rated_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    })
-                else:
-                    current_data.update({
-                        "score": None,
-                        "status": "Not Rated",
-                        "rated": False,
-                        "rated_at": None
-                    })
+
+                score = None if score_selection == "Not Rated" else int(score_selection)
+                if score != current_data["score"]:
+                    if score is not None:
+                        status = "Match" if score > 5 else "Unmatch" if score < 5 else "Neutral"
+                        current_data.update({
+                            "score": score,
+                            "status": status,
+                            "rated": True,
+                            "rated_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                        })
+                    else:
+                        current_data.update({
+                            "score": None,
+                            "status": "Not Rated",
+                            "rated": False,
+                            "rated_at": None
+                        })
 
             # 状态显示
             with col2:
-                status = current_data["status"]
-                score = current_data["score"]
-                
-                status_color = {
-                    "Match": "#28a745",
-                    "Unmatch": "#dc3545",
-                    "Neutral": "#ffc107",
-                    "Not Rated": "#6c757d"
-                }.get(status, "#6c757d")
-                
-                score_display = f"({score}/10)" if score is not None else ""
-                
-                st.markdown(f"""
-                    <div style='padding: 8px 15px; 
-                    background-color: {status_color}; 
-                    color: white; 
-                    border-radius: 5px; 
-                    text-align: center; 
-                    margin-top: 10px;'>
-                        {status} {score_display}
-                    </div>
-                    """, unsafe_allow_html=True)
-            
-            st.markdown("</div>", unsafe_allow_html=True)
+                st.markdown(status_badge_html(current_data["status"], current_data["score"]), unsafe_allow_html=True)
+
+    # 翻页
+    if page_count > 1:
+        col1, col2, col3 = st.columns([1, 2, 1])
+        with col1:
+            if st.button("← Previous", key=f"prev_page_{set_label}", disabled=page == 0, use_container_width=True):
+                st.session_state[page_key] = page - 1
+                st.rerun()
+        with col2:
+            st.markdown(f"<div style='text-align: center; padding-top: 8px;'>Page {page + 1} of {page_count}</div>",
+                        unsafe_allow_html=True)
+        with col3:
+            if st.button("Next →", key=f"next_page_{set_label}", disabled=page == page_count - 1,
+                         use_container_width=True):
+                st.session_state[page_key] = page + 1
+                st.rerun()
 
     # 在评分部分添加锁定状态提示
     if st.session_state.matching_locked:
@@ -435,6 +581,28 @@ def display_rating_summary():
         </div>
         """, unsafe_allow_html=True)
 
+# 等待评分写入数据库的最长时间（秒）
+SAVE_TIMEOUT = float(os.getenv("RATING_SAVE_TIMEOUT", "10"))
+
+@st.cache_resource
+def get_mongo_client():
+    """进程内所有会话共用一个MongoClient（自带连接池）"""
+    load_dotenv()
+    return MongoClient(os.getenv('MONGODB_URI'), maxPoolSize=int(os.getenv("MONGODB_MAX_POOL_SIZE", "20")))
+
+@st.cache_resource
+def get_rating_writer():
+    """进程内共用的评分批量写入队列"""
+    db = get_mongo_client()[os.getenv("MONGODB_DB_NAME", "Organization5")]
+    writer = RatingWriter(
+        db['User'],
+        max_batch=int(os.getenv("RATING_WRITE_BATCH", "200")),
+        flush_interval=float(os.getenv("RATING_FLUSH_INTERVAL", "0.2"))
+    )
+    # 进程退出前把队列里剩下的评分写完
+    atexit.register(writer.close)
+    return writer
+
 def initialize_algorithm_assignment():
     """初始化A/B测试的算法分配"""
     if "algorithm_assignment" not in st.session_state:
@@ -468,12 +636,6 @@ def save_to_mongodb(scores_a, scores_b, user_info):
             )
         }
         
-        load_dotenv()
-        MONGODB_URI = os.getenv('MONGODB_URI')
-        client = MongoClient(MONGODB_URI)
-        db = client['Organization5']
-        user_collection = db['User']
-        
         # 准备要保存的数据
         rating_data = {
             "timestamp": datetime.now(),
@@ -508,37 +670,29 @@ def save_to_mongodb(scores_a, scores_b, user_info):
         }
         
         with st.spinner('Saving results...'):
-            result = user_collection.insert_one(rating_data)
-            return True, result.inserted_id
+            # _id 在客户端生成，和其他会话的评分一起批量写入
+            inserted_id = get_rating_writer().insert(rating_data).result(timeout=SAVE_TIMEOUT)
+            return True, inserted_id
             
     except Exception as e:
         print(f"MongoDB save error: {str(e)}")
         return False, str(e)
-    finally:
-        if 'client' in locals():
-            client.close()
 
 def save_feedback_to_mongodb(feedback_data, original_data_id):
     """保存用户反馈到MongoDB"""
     try:
-        load_dotenv()
-        MONGODB_URI = os.getenv('MONGODB_URI')
-        client = MongoClient(MONGODB_URI)
-        db = client['Organization5']
-        user_collection = db['User']
-        
         # 更新原有文档，添加用户反馈
-        result = user_collection.update_one(
-            {"_id": original_data_id},
+        result = get_rating_writer().update(
+            original_data_id,
             {
                 "$set": {
                     "user_feedback": feedback_data,
                     "feedback_timestamp": datetime.now()
                 }
             }
-        )
+        ).result(timeout=SAVE_TIMEOUT)
         
-        return True, result.modified_count
+        return True, result
     except Exception as e:
         print(f"Error saving feedback: {str(e)}")  # 添加错误日志
         return False, str(e)
@@ -576,6 +730,8 @@ def initialize_session_state():
         "profile_data": {},
         "search_data": {},
         "results": {},
+        "pending_results": {},
+        "search_input": {},
         "current_set": None,
         "search_performed": False,
         "scores_set_A": {},
@@ -777,8 +933,11 @@ def main():
                 st.session_state.search_performed = False
                 st.session_state.current_set = None
                 st.session_state.results = {}
+                st.session_state.pending_results = {}
                 st.session_state.scores_set_A = {}
                 st.session_state.scores_set_B = {}
+                st.session_state.page_set_A = 0
+                st.session_state.page_set_B = 0
                 st.rerun()
 
     # Profile和Search表单
@@ -907,6 +1066,8 @@ def main():
                     st.session_state.results = {}
                     st.session_state.scores_set_A = {}
                     st.session_state.scores_set_B = {}
+                    st.session_state.page_set_A = 0
+                    st.session_state.page_set_B = 0
                     st.session_state.current_set = "A"
                     st.session_state.search_performed = True
                     
@@ -923,23 +1084,28 @@ def main():
                             "Organization looking 2": search_data["partnership_description"]
                         }
                         
-                        with st.spinner('Finding matches...'):
-                            # 调用API
-                            complex_results = call_matching_api(input_data, "complex")
-                            simple_results = call_matching_api(input_data, "simple")
-                            
-                            # 保存结果到session state
-                            st.session_state.results = {
-                                'A': complex_results,
-                                'B': simple_results
-                            }
+                        st.session_state.search_input = input_data
+                        st.session_state.pending_results = {}
+                        # 两组结果同时开始获取；Set A 一到就显示，
+                        # Set B 在后台继续获取，评完 Set A 之前通常已经完成
+                        start_fetch(input_data, "A")
+                        start_fetch(input_data, "B")
+                        if ensure_set_loaded("A", 'Finding matches...'):
                             st.session_state.current_set = "A"
                             st.session_state.search_performed = True
-                            
                             st.rerun()
+                        else:
+                            st.session_state.matching_locked = False
+                            st.session_state.pending_results = {}
                     except Exception as e:
                         st.error(f"Error during search: {str(e)}")
                         st.session_state.matching_locked = False
+                        # 没有拿到 Set A 时不能开始评分
+                        st.session_state.results = {}
+                        st.session_state.pending_results = {}
+
+    # 后台获取的 Set B 完成后放进 session state
+    collect_fetched_results()
 
     # 显示匹配结果（无论是否锁定都显示）
     if st.session_state.search_performed and st.session_state.results:
@@ -963,8 +1129,10 @@ def main():
                 col1, col2, col3 = st.columns([1, 2, 1])
                 with col2:
                     if st.button("Proceed to Set B →", type="primary", use_container_width=True):
-                        st.session_state.current_set = "B"
-                        st.rerun()
+                        # Set B 还没返回时才需要等待
+                        if ensure_set_loaded("B"):
+                            st.session_state.current_set = "B"
+                            st.rerun()
             else:
                 st.warning("⚠️ Please rate all organizations in Set A to proceed")
 
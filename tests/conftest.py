@@ -0,0 +1,97 @@
+"""测试公共设置
+
+默认使用 mongomock；设置 MONGODB_TEST_URI 时改为连接本地 mongod，
+每个测试使用单独的数据库，结束后删除。OpenAI 调用在各测试中替换为本地假实现。
+"""
+import hashlib
+import os
+import sys
+import tempfile
+import uuid
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 导入 api2 之前必须设置好的环境变量；MONGODB_URI 只用于 api2 导入时创建的连接，测试中会替换集合
+CACHE_DIR = tempfile.mkdtemp(prefix="causeconnect-test-")
+for key, value in {
+    "OPENAI_API_KEY": "test",
+    "MONGODB_URI": os.getenv("MONGODB_TEST_URI", "mongodb://localhost:1/?serverSelectionTimeoutMS=100"),
+    "MONGODB_DB_NAME": "causeconnect_test",
+    "MONGODB_COLLECTION_NONPROFIT": "Nonprofit",
+    "MONGODB_COLLECTION_FORPROFIT": "Forprofit",
+    "PROMPT_GEN_ORG_SYSTEM": "ideal {org_type_looking_for}",
+    "PROMPT_GEN_ORG_USER": "{org_type_looking_for}: {partnership_description}",
+    "PROMPT_FILTER_SYSTEM": "filter",
+    "PROMPT_FILTER_USER": "{organization_mission} {generated_organizations}",
+    "PROMPT_TAGS_SYSTEM": "tags {total_tags} {steps} {tags_per_step}",
+    "PROMPT_TAGS_USER": "{total_tags} {description}",
+    "MATCH_EVALUATION_SYSTEM_PROMPT": "evaluate",
+    "MATCH_EVALUATION_PROMPT": "{user_description}|{match_description}|{match_mission}",
+    "LLM_CACHE_ENABLED": "0",
+    "EMBEDDING_CACHE_ENABLED": "0",
+    "VERDICT_CACHE_ENABLED": "0",
+    "INDEX_SYNC_ENABLED": "0",
+    "SHARED_INDEX_PREFIX": "",
+    "EMBEDDING_SNAPSHOT_DIR": "",
+}.items():
+    os.environ.setdefault(key, value)
+os.environ.setdefault("LLM_CACHE_PATH", os.path.join(CACHE_DIR, "llm_cache.sqlite3"))
+
+DIM = 16
+
+
+def fake_vector(text):
+    """由文本哈希生成的确定性向量"""
+    seed = int(hashlib.md5(text.encode("utf-8")).hexdigest()[:8], 16)
+    return np.random.default_rng(seed).standard_normal(DIM).astype(np.float32)
+
+
+@pytest.fixture
+def mongo_db():
+    uri = os.getenv("MONGODB_TEST_URI")
+    name = f"causeconnect_test_{uuid.uuid4().hex[:8]}"
+    if uri:
+        from pymongo import MongoClient
+        client = MongoClient(uri)
+        yield client[name]
+        client.drop_database(name)
+        client.close()
+    else:
+        mongomock = pytest.importorskip("mongomock")
+        yield mongomock.MongoClient()[name]
+
+
+@pytest.fixture
+def organizations(mongo_db):
+    """60 个有嵌入向量和过滤字段的组织"""
+    collection = mongo_db["Nonprofit"]
+    collection.insert_many([{
+        "Name": f"Org {i}",
+        "Description": f"description {i}",
+        "Mission": f"mission {i}",
+        "Industries": "Education" if i % 2 else "Health",
+        "Specialities": "recycling, outreach",
+        "Tags": "green, kids, food",
+        "Staff_Count": i,
+        "Assets": float(i * 10),
+        "Linkedin_followers": i * 3,
+        "Popularity": "Yes" if i % 3 == 0 else "No",
+        "tag_embedding": fake_vector(f"tags {i}").tobytes(),
+        "description_embedding": fake_vector(f"description {i}").tobytes()
+    } for i in range(60)])
+    return collection
+
+
+@pytest.fixture(autouse=True)
+def reset_resident_state():
+    """常驻索引和卡片缓存是进程级的，每个测试重新开始"""
+    import embedding_index
+    import organization_cards
+    embedding_index._indexes.clear()
+    organization_cards._caches.clear()
+    yield
+    embedding_index._indexes.clear()
+    organization_cards._caches.clear()
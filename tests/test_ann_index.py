@@ -0,0 +1,106 @@
+import json
+import os
+import time
+
+import numpy as np
+
+from ann_index import IVFFlatIndex
+from embedding_index import CollectionIndex
+from embedding_snapshot import load_snapshot, snapshot_prefix, write_snapshot
+
+from conftest import fake_vector
+
+
+def random_unit_matrix(rows, dim=16, seed=0):
+    matrix = np.random.default_rng(seed).standard_normal((rows, dim)).astype(np.float32)
+    return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+
+def test_search_finds_exact_top_rows():
+    matrix = random_unit_matrix(2000)
+    valid = np.ones(len(matrix), dtype=bool)
+    valid[::7] = False
+    ivf = IVFFlatIndex.build(matrix, valid)
+    # 探测全部列表时与精确扫描一致
+    query = matrix[3]
+    rows, scores = ivf.search(matrix, valid, query, 10, len(ivf.centroids))
+    exact = np.argsort(-np.where(valid, matrix @ query, -np.inf))[:10]
+    assert list(rows) == list(exact)
+    assert np.all(np.diff(scores) <= 0)
+    assert not set(rows) & set(np.flatnonzero(~valid))
+    # 每个有效行只在一个列表里
+    assert sorted(ivf.order) == list(np.flatnonzero(valid))
+
+
+def test_save_and_load_round_trip(tmp_path):
+    matrix = random_unit_matrix(500)
+    ivf = IVFFlatIndex.build(matrix, np.ones(len(matrix), dtype=bool))
+    ivf.snapshot = "2026-01-01T00:00:00"
+    path = str(tmp_path / "field.ivf.npz")
+    ivf.save(path)
+    loaded = IVFFlatIndex.load(path)
+    assert loaded.snapshot == ivf.snapshot
+    assert loaded.rows == ivf.rows
+    assert np.array_equal(loaded.order, ivf.order)
+    assert np.array_equal(loaded.offsets, ivf.offsets)
+
+
+def test_snapshot_ignores_lists_built_for_an_older_snapshot(organizations, tmp_path):
+    snapshot_dir = str(tmp_path)
+    write_snapshot(organizations, snapshot_dir)
+    prefix = snapshot_prefix(snapshot_dir, organizations.name, "tag_embedding")
+    with open(prefix + ".json") as f:
+        header = json.load(f)
+    matrix = np.load(prefix + ".npy")[:header["rows"]]
+    valid = np.load(prefix + ".ids.npy")["valid"]
+    ivf = IVFFlatIndex.build(matrix, valid)
+    ivf.snapshot = header["created_at"]
+    ivf.save(prefix + ".ivf.npz")
+    assert "tag_embedding" in load_snapshot(organizations, snapshot_dir).ann
+
+    ivf.snapshot = "older"
+    ivf.save(prefix + ".ivf.npz")
+    assert "tag_embedding" not in load_snapshot(organizations, snapshot_dir).ann
+
+    # 重写快照时删除旧的 IVF 文件
+    write_snapshot(organizations, snapshot_dir)
+    assert not os.path.exists(prefix + ".ivf.npz")
+
+
+def test_changed_rows_are_always_scored():
+    matrix = random_unit_matrix(1000)
+    valid = np.ones(len(matrix), dtype=bool)
+    ivf = IVFFlatIndex.build(matrix, valid)
+    # 改写一行，让它和查询向量完全一致；它还留在原来的列表里
+    query = random_unit_matrix(1, seed=1)[0]
+    row = int(np.argmin(matrix @ query))
+    matrix[row] = query
+    assert row not in ivf.search(matrix, valid, query, 10, 1)[0]
+    ivf.mark_changed([row])
+    rows, scores = ivf.search(matrix, valid, query, 10, 1)
+    assert rows[0] == row and np.isclose(scores[0], 1.0)
+    assert len(set(rows)) == len(rows)
+
+
+def test_collection_index_serves_exact_search_until_lists_are_built(organizations):
+    index = CollectionIndex.from_collection(organizations)
+    query = fake_vector("query")
+    exact = index.search("tag_embedding", query, 5)
+    # 第一次 ANN 请求不等待 k-means，返回精确扫描的结果
+    assert index.search("tag_embedding", query, 5, mode="ann") == exact
+    wait_for_lists(index, "tag_embedding")
+
+    # 复用墓碑行的新组织不在任何列表里，也要能被 ANN 找到
+    index.remove(exact[-1][0])
+    inserted = organizations.insert_one({"Name": "new", "tag_embedding": query.tobytes()}).inserted_id
+    index.upsert_document(organizations.find_one({"_id": inserted}))
+    assert index._row_of[inserted] < index.ann["tag_embedding"].rows
+    assert index.search("tag_embedding", query, 1, mode="ann", n_probe=1)[0][0] == inserted
+
+
+def wait_for_lists(index, field):
+    for _ in range(200):
+        if field in index.ann:
+            return
+        time.sleep(0.01)
+    raise AssertionError("IVF 索引没有构建完成")
@@ -0,0 +1,102 @@
+import openai
+import pytest
+from fastapi.testclient import TestClient
+
+import api2
+
+from conftest import fake_vector
+
+REQUEST = {
+    "Name": "Test Org",
+    "Type": "For Profit",
+    "Description": "we build learning tools",
+    "Mission": "help kids learn",
+    "Industries": "Education",
+    "Specialities": "software",
+    "Organization looking 1": "Non Profit",
+    "Organization looking 2": "a partner running after-school programs"
+}
+
+
+class Message(dict):
+    __getattr__ = dict.__getitem__
+
+
+@pytest.fixture
+def stub_openai(monkeypatch):
+    calls = {"chat": 0, "embedding": 0}
+
+    def chat_completion(model, messages, **params):
+        calls["chat"] += 1
+        if messages[0]["content"] == "evaluate":
+            # 描述编号为偶数的组织评估为匹配
+            number = int(messages[1]["content"].split("|")[1].split()[-1])
+            content = "true" if number % 2 == 0 else "false"
+        else:
+            content = "tag a, tag b, tag c"
+        return Message(choices=[Message(message={"content": content})])
+
+    def embedding(model, input):
+        calls["embedding"] += 1
+        texts = input if isinstance(input, list) else [input]
+        return {"data": [{"index": i, "embedding": fake_vector(text).tolist()} for i, text in enumerate(texts)]}
+
+    monkeypatch.setattr(openai.ChatCompletion, "create", chat_completion)
+    monkeypatch.setattr(openai.Embedding, "create", embedding)
+    return calls
+
+
+@pytest.fixture
+def client(organizations, monkeypatch):
+    monkeypatch.setattr(api2, "db", organizations.database)
+    monkeypatch.setattr(api2, "nonprofit_collection", organizations)
+    monkeypatch.setattr(api2, "forprofit_collection", organizations.database["Forprofit"])
+    with TestClient(api2.app) as client:
+        yield client
+
+
+def test_complete_matching_process(client, stub_openai):
+    response = client.post("/test/complete-matching-process", json=REQUEST)
+    assert response.status_code == 200, response.text
+    body = response.json()
+
+    assert body["status"] == "success"
+    steps = body["process_steps"]
+    assert steps["step3_generated_tags"]["tags"] == ["tag a", "tag b", "tag c"]
+    assert steps["step4_embedding"]["dimension"] == 16
+    assert steps["step5_matches"]["total_matches_found"] == 60
+
+    summary = steps["step5_matches"]["evaluation_summary"]
+    assert summary["total_evaluated"] == 30
+    assert summary["accepted"] + summary["rejected"] == 30
+    assert summary["failed"] == 0
+    assert summary["accepted"] + summary["supplementary"] == 20
+
+    results = body["matching_results"]
+    assert len(results) == 20
+    statuses = [result["evaluation_status"] for result in results]
+    assert statuses == ["accepted"] * summary["accepted"] + ["supplementary"] * summary["supplementary"]
+    for result in results[:summary["accepted"]]:
+        assert int(result["organization"]["description"].split()[-1]) % 2 == 0
+    # 30 次评估加上生成描述、过滤和标签的 3 次调用
+    assert stub_openai["chat"] == 33
+
+
+def test_complete_matching_process_rejects_invalid_request(client, stub_openai):
+    response = client.post("/test/complete-matching-process", json={**REQUEST, "field_weights": {"unknown": 1}})
+    assert response.status_code == 400
+    assert stub_openai["chat"] == 0
+
+
+@pytest.mark.parametrize("options", [
+    {"scoring": "weird"},
+    {"filters": {"Staff_Count": {"$gte": "abc"}}},
+    {"filters": {"Founded": 1990}},
+    {"lexical": "bm25"},
+    {"search_mode": "hnsw"},
+    {"evaluation_mode": "parallel"},
+])
+def test_invalid_options_are_rejected_before_any_openai_call(client, stub_openai, options):
+    response = client.post("/test/complete-matching-process", json={**REQUEST, **options})
+    assert response.status_code == 400
+    assert stub_openai["chat"] == 0 and stub_openai["embedding"] == 0
@@ -0,0 +1,81 @@
+import time
+
+import cache_store
+from cache_store import PersistentLRUCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self):
+        return self.now
+
+
+def make_cache(tmp_path, **kwargs):
+    return PersistentLRUCache("test", str(tmp_path / "cache.sqlite3"), **kwargs)
+
+
+def test_memory_keeps_most_recently_used_and_falls_back_to_disk(tmp_path):
+    cache = make_cache(tmp_path, max_memory_items=2)
+    cache.set("a", b"1")
+    cache.set("b", b"2")
+    assert cache.get("a") == b"1"
+    cache.set("c", b"3")
+
+    # b 最久未使用，被挤出内存，但磁盘上还有
+    assert list(cache._memory) == ["a", "c"]
+    assert cache.get("b") == b"2"
+    assert cache.get("missing") is None
+    info = cache.info()
+    assert (info["memory_hits"], info["disk_hits"], info["misses"]) == (1, 1, 1)
+    assert info["memory_items"] == 2 and info["disk_items"] == 3
+
+
+def test_entries_survive_a_new_instance(tmp_path):
+    make_cache(tmp_path).set("a", b"1")
+    cache = make_cache(tmp_path)
+    assert cache.get("a") == b"1"
+    assert cache.stats["disk_hits"] == 1
+
+
+def test_expired_entries_are_misses_in_memory_and_on_disk(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_store.time, "time", clock)
+    cache = make_cache(tmp_path, ttl=60)
+    cache.set("a", b"1")
+    clock.now += 30
+    assert cache.get("a") == b"1"
+
+    clock.now += 31
+    assert cache.get("a") is None
+    assert "a" not in cache._memory
+    assert make_cache(tmp_path, ttl=60).get("a") is None
+    assert cache.stats["misses"] == 1
+
+
+def test_disk_trim_drops_expired_then_least_recently_used(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_store.time, "time", clock)
+    cache = make_cache(tmp_path, max_memory_items=1, max_disk_items=50, ttl=1000)
+    cache.set("old", b"x")
+    clock.now += 2000
+    for i in range(90):
+        clock.now += 1
+        cache.set(f"k{i}", b"x")
+    # 读一次 k0，让它比 k1..k89 更晚被访问
+    clock.now += 1
+    assert cache.get("k0") == b"x"
+    for i in range(90, 99):
+        clock.now += 1
+        cache.set(f"k{i}", b"x")
+
+    # 第 100 次写入触发清理：先删过期的 old，再删最久未访问的 k1..k49（k0 被读过，保留）
+    info = cache.info()
+    assert info["disk_items"] == 50
+    assert info["evictions"] == 50
+    assert cache.get("old") is None
+    assert cache.get("k0") == b"x"
+    assert cache.get("k1") is None
+    assert cache.get("k49") is None
+    assert cache.get("k50") == b"x"
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from embedding_index import CollectionIndex
+
+from conftest import fake_vector
+
+WEIGHTS = {"tag_embedding": 0.7, "description_embedding": 0.3}
+
+
+def hybrid(index, k=10):
+    queries = {"tag_embedding": fake_vector("tags q"), "description_embedding": fake_vector("description q")}
+    return index.search_hybrid(queries, WEIGHTS, k)
+
+
+def test_field_matrices_are_views_of_the_stacked_matrix(organizations):
+    index = CollectionIndex.from_collection(organizations)
+    for field, matrix in index.matrices.items():
+        assert np.shares_memory(matrix, index._stacked)
+        start, end = index._stacked_layout[field]
+        assert np.array_equal(index._stacked[:, start:end], matrix)
+
+    # 扩容和增量更新之后仍然只有一份
+    for i in range(len(index.ids) - index.size + 1):
+        organizations.insert_one({"Name": f"new {i}", "tag_embedding": fake_vector(f"new {i}").tobytes()})
+    for org in organizations.find({"Name": {"$regex": "^new"}}):
+        index.upsert_document(org)
+    assert index.size > 60
+    for matrix in index.matrices.values():
+        assert np.shares_memory(matrix, index._stacked)
+        assert len(matrix) == len(index.ids)
+
+
+def test_hybrid_scores_match_per_field_scoring(organizations):
+    index = CollectionIndex.from_collection(organizations)
+    stacked = hybrid(index)
+
+    # 快照映射的索引没有拼接矩阵，逐字段打分
+    separate = CollectionIndex(index.name, index.ids, {field: np.array(matrix) for field, matrix in index.matrices.items()},
+                               index.valid)
+    assert separate._stacked is None
+    per_field = hybrid(separate)
+    assert [org_id for org_id, _, _ in per_field] == [org_id for org_id, _, _ in stacked]
+    assert [score for _, score, _ in per_field] == pytest.approx([score for _, score, _ in stacked], abs=1e-6)
+    assert separate._stacked is None
+
+    org_id, score, sub_scores = stacked[0]
+    assert score == pytest.approx(sum(WEIGHTS[field] * sub_scores[field] for field in WEIGHTS), abs=1e-6)
+
+
+def test_missing_field_scores_zero_after_upsert(organizations):
+    index = CollectionIndex.from_collection(organizations)
+    org_id = hybrid(index, 1)[0][0]
+    organizations.update_one({"_id": org_id}, {"$unset": {"tag_embedding": ""}})
+    index.upsert_document(organizations.find_one({"_id": org_id}))
+    row = index._row_of[org_id]
+    assert not index.valid["tag_embedding"][row]
+    assert not index.matrices["tag_embedding"][row].any()
+    result = {org: sub_scores for org, _, sub_scores in hybrid(index, 60)}
+    assert result[org_id]["tag_embedding"] is None
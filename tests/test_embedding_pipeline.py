@@ -0,0 +1,50 @@
+import numpy as np
+
+from embedding_index import normalized_field
+from embedding_pipeline import Checkpoint, EmbeddingPipeline, FakeEmbeddingProvider, pending_query
+
+MODEL = "text-embedding-test"
+
+
+class FlakyEmbeddingProvider(FakeEmbeddingProvider):
+    """第 fail_on 次请求失败一次，之后恢复正常"""
+
+    def __init__(self, model, fail_on, dim=8):
+        super().__init__(model, dim=dim)
+        self.fail_on = fail_on
+        self.calls = 0
+
+    def embed(self, texts):
+        self.calls += 1
+        if self.calls == self.fail_on:
+            raise RuntimeError("simulated embedding failure")
+        return super().embed(texts)
+
+
+def test_resume_after_failed_batch(mongo_db, tmp_path):
+    collection = mongo_db["Nonprofit"]
+    collection.insert_many([{"Name": f"Org {i}", "Tags": f"tag {i}"} for i in range(50)])
+    checkpoint_path = str(tmp_path / "checkpoint.json")
+
+    # 并发为 1 时批次按顺序完成：前两批推进检查点，第三批失败，之后的批次仍然写入
+    provider = FlakyEmbeddingProvider(MODEL, fail_on=3)
+    pipeline = EmbeddingPipeline(provider, MODEL, Checkpoint(checkpoint_path), batch_size=10, concurrency=1)
+    assert pipeline.run(collection, "tag_embedding") is False
+    assert pipeline.stats["failed_batches"] == 1
+
+    checkpoint = Checkpoint(checkpoint_path)
+    first_ids = [org["_id"] for org in collection.find({}, {"_id": 1}).sort("_id", 1)]
+    assert checkpoint.get(collection.name, "tag_embedding") == first_ids[19]
+    assert collection.count_documents(pending_query("tag_embedding", MODEL)) == 10
+
+    # 重新运行从检查点之后继续，只补上失败的批次
+    pipeline = EmbeddingPipeline(FakeEmbeddingProvider(MODEL, dim=8), MODEL, checkpoint, batch_size=10, concurrency=2)
+    assert pipeline.run(collection, "tag_embedding") is True
+    assert pipeline.stats["documents"] == 10
+    assert Checkpoint(checkpoint_path).get(collection.name, "tag_embedding") is None
+    assert collection.count_documents(pending_query("tag_embedding", MODEL)) == 0
+
+    org = collection.find_one({"_id": first_ids[25]})
+    unit = np.frombuffer(org[normalized_field("tag_embedding")], dtype=np.float32)
+    assert np.isclose(np.linalg.norm(unit), 1.0, atol=1e-5)
+    assert org["embedding_meta"]["tag_embedding"]["model"] == MODEL
@@ -0,0 +1,60 @@
+from datetime import datetime
+
+import numpy as np
+from bson.timestamp import Timestamp
+
+import embedding_snapshot
+from embedding_index import get_collection_index
+from embedding_snapshot import load_snapshot, write_snapshot
+
+from conftest import fake_vector
+
+
+def test_sync_starts_from_snapshot_time(organizations, tmp_path, monkeypatch):
+    monkeypatch.setattr(embedding_snapshot, "cluster_operation_time", lambda collection: Timestamp(100, 1))
+    before = datetime.utcnow()
+    write_snapshot(organizations, str(tmp_path))
+    after = datetime.utcnow()
+
+    monkeypatch.setenv("EMBEDDING_SNAPSHOT_DIR", str(tmp_path))
+    index = get_collection_index(organizations)
+    assert index.load_operation_time == Timestamp(100, 1)
+    assert before <= index.loaded_at <= after
+    assert len(index) == 60
+
+
+def test_snapshot_older_than_oplog_window_is_stale(organizations, tmp_path, monkeypatch):
+    monkeypatch.setattr(embedding_snapshot, "cluster_operation_time", lambda collection: Timestamp(100, 1))
+    write_snapshot(organizations, str(tmp_path))
+
+    monkeypatch.setattr(embedding_snapshot, "oplog_start_time", lambda collection: Timestamp(50, 1))
+    assert load_snapshot(organizations, str(tmp_path)) is not None
+    monkeypatch.setattr(embedding_snapshot, "oplog_start_time", lambda collection: Timestamp(200, 1))
+    assert load_snapshot(organizations, str(tmp_path)) is None
+    # 读不到 oplog（单机 mongod）时只按指纹判断
+    monkeypatch.setattr(embedding_snapshot, "oplog_start_time", lambda collection: None)
+    assert load_snapshot(organizations, str(tmp_path)) is not None
+
+
+def test_fingerprint_change_makes_snapshot_stale(organizations, tmp_path):
+    write_snapshot(organizations, str(tmp_path))
+    assert load_snapshot(organizations, str(tmp_path)).loaded_at is not None
+    organizations.insert_one({"Name": "new", "tag_embedding": organizations.find_one()["tag_embedding"]})
+    assert load_snapshot(organizations, str(tmp_path)) is None
+
+
+def test_synced_inserts_use_spare_rows_without_copying(organizations, tmp_path):
+    write_snapshot(organizations, str(tmp_path))
+    index = load_snapshot(organizations, str(tmp_path))
+    assert index.size == 60 and len(index.ids) > 60
+    matrix = index.matrices["tag_embedding"]
+    assert isinstance(matrix, np.memmap)
+
+    vector = fake_vector("inserted")
+    inserted = organizations.insert_one({"Name": "new", "tag_embedding": vector.tobytes()}).inserted_id
+    index.upsert_document(organizations.find_one({"_id": inserted}))
+    # 写进了预留的空行，矩阵仍然是原来的映射
+    assert index.matrices["tag_embedding"] is matrix
+    assert index._row_of[inserted] == 60 and index.size == 61
+    assert index.search("tag_embedding", vector, 1)[0][0] == inserted
+    assert index.count("tag_embedding") == organizations.count_documents({"tag_embedding": {"$exists": True}})
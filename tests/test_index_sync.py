@@ -0,0 +1,53 @@
+from datetime import datetime
+
+from embedding_index import get_collection_index
+from index_sync import IndexSynchronizer
+from organization_cards import get_card_cache
+
+from conftest import fake_vector
+
+
+def test_poll_once_applies_upserts_and_deletes(organizations):
+    index = get_collection_index(organizations)
+    synchronizer = IndexSynchronizer(organizations)
+    synchronizer.poll_once()
+    assert len(index) == 60
+
+    cards = get_card_cache(organizations.name)
+    removed, changed = [org["_id"] for org in organizations.find({}, {"_id": 1}).sort("_id", 1).limit(2)]
+    cards.load(organizations, [removed, changed])
+
+    query = fake_vector("query")
+    organizations.update_one({"_id": changed}, {"$set": {
+        "tag_embedding": query.tobytes(), "updated_at": datetime.utcnow()}})
+    inserted = organizations.insert_one({
+        "Name": "New Org",
+        "Tags": "green",
+        "tag_embedding": (-query).tobytes(),
+        "updated_at": datetime.utcnow()
+    }).inserted_id
+    organizations.delete_one({"_id": removed})
+
+    synchronizer.poll_once()
+
+    assert removed not in index
+    assert inserted in index
+    assert len(index) == 60
+    assert index.search("tag_embedding", query, 1)[0][0] == changed
+    assert index.search("tag_embedding", -query, 1)[0][0] == inserted
+    assert cards.get_many([removed, changed]) == {}
+
+
+def test_first_poll_rereads_documents_updated_during_load(organizations):
+    index = get_collection_index(organizations)
+    org_id = organizations.find_one({}, {"_id": 1})["_id"]
+    query = fake_vector("query")
+    # 加载完成之后、同步开始之前的写入
+    organizations.update_one({"_id": org_id}, {"$set": {
+        "tag_embedding": query.tobytes(), "updated_at": datetime.utcnow()}})
+
+    synchronizer = IndexSynchronizer(organizations)
+    synchronizer._synced_at = index.loaded_at
+    synchronizer.poll_once()
+
+    assert index.search("tag_embedding", query, 1)[0][0] == org_id
@@ -0,0 +1,144 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from pymongo.errors import PyMongoError
+
+from job_queue import FAILED, QUEUED, RUNNING, SUCCEEDED, InMemoryJobStore, JobManager, MongoJobStore, QueueFullError
+
+
+def wait_for(manager, job_id, status, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = manager.get(job_id)
+        if job is not None and job["status"] == status:
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"任务 {job_id} 没有进入 {status}: {manager.get(job_id)}")
+
+
+def wait_idle(manager, timeout=5):
+    deadline = time.monotonic() + timeout
+    while manager.stats()["running"] or manager.stats()["queue_depth"]:
+        assert time.monotonic() < deadline, manager.stats()
+        time.sleep(0.01)
+
+
+class FlakyStore(InMemoryJobStore):
+    """把 RUNNING 状态写入变成数据库错误"""
+
+    def update(self, job_id, fields):
+        if fields.get("status") == RUNNING:
+            raise PyMongoError("connection reset")
+        super().update(job_id, fields)
+
+
+def test_job_goes_from_queued_to_running_to_succeeded():
+    release = threading.Event()
+    seen = []
+
+    def runner(algorithm, request, on_event):
+        seen.append((algorithm, request))
+        on_event({"event": "step", "step": "generate"})
+        on_event({"event": "evaluation"})
+        release.wait(5)
+        return {"matches": [1, 2]}
+
+    manager = JobManager(runner, InMemoryJobStore(), max_workers=1)
+    try:
+        job_id = manager.submit("v2", {"q": 1})
+        running = wait_for(manager, job_id, RUNNING)
+        assert running["started_at"] is not None
+        assert manager.stats()["running"] == 1
+
+        release.set()
+        job = wait_for(manager, job_id, SUCCEEDED)
+        wait_idle(manager)
+    finally:
+        manager.shutdown()
+    assert seen == [("v2", {"q": 1})]
+    assert job["result"] == {"matches": [1, 2]}
+    assert job["progress"] == {"current_step": "generate", "completed_steps": ["generate"], "evaluations_done": 1}
+    assert job["finished_at"] >= job["started_at"]
+    assert manager.stats()["totals"][SUCCEEDED] == 1
+
+
+def test_runner_error_marks_job_failed():
+    def runner(algorithm, request, on_event):
+        raise RuntimeError("boom")
+
+    manager = JobManager(runner, InMemoryJobStore(), max_workers=1)
+    try:
+        job = wait_for(manager, manager.submit("v2", {}), FAILED)
+        wait_idle(manager)
+    finally:
+        manager.shutdown()
+    assert job["error"] == "boom"
+    assert job["result"] is None
+    assert manager.stats()["totals"][FAILED] == 1
+
+
+def test_store_error_when_starting_fails_the_job_and_frees_the_slot():
+    calls = []
+    manager = JobManager(lambda *args: calls.append(args), FlakyStore(), max_workers=1, max_queue=1)
+    try:
+        job = wait_for(manager, manager.submit("v2", {}), FAILED)
+        wait_idle(manager)
+        # 运行名额已经释放，后续任务还能提交
+        manager.submit("v2", {})
+        wait_idle(manager)
+    finally:
+        manager.shutdown()
+    assert calls == []
+    assert job["error"] == "connection reset"
+    stats = manager.stats()
+    assert stats["running"] == 0 and stats["queue_depth"] == 0
+    assert stats["totals"][FAILED] == 2
+
+
+def test_submit_rejects_when_queue_is_full():
+    release = threading.Event()
+    manager = JobManager(lambda *args: release.wait(5), InMemoryJobStore(), max_workers=1, max_queue=1)
+    try:
+        running = manager.submit("v2", {})
+        wait_for(manager, running, RUNNING)
+        queued = manager.submit("v2", {})
+        assert manager.get(queued)["status"] == QUEUED
+        with pytest.raises(QueueFullError):
+            manager.submit("v2", {})
+        assert manager.stats()["totals"]["rejected"] == 1
+
+        release.set()
+        wait_for(manager, queued, SUCCEEDED)
+        wait_idle(manager)
+    finally:
+        release.set()
+        manager.shutdown()
+
+
+def test_finished_jobs_expire_after_result_ttl():
+    store = InMemoryJobStore()
+    manager = JobManager(lambda *args: "ok", store, max_workers=1, result_ttl=60)
+    try:
+        job_id = manager.submit("v2", {})
+        job = wait_for(manager, job_id, SUCCEEDED)
+        wait_idle(manager)
+    finally:
+        manager.shutdown()
+    assert job["expires_at"] - job["finished_at"] == timedelta(seconds=60)
+
+    store.update(job_id, {"expires_at": datetime.utcnow() - timedelta(seconds=1)})
+    assert manager.get(job_id) is None
+    store.purge_expired()
+    assert job_id not in store._jobs
+
+
+def test_mongo_store_hides_expired_jobs(mongo_db):
+    store = MongoJobStore(mongo_db["jobs"])
+    now = datetime.utcnow()
+    store.create({"_id": "live", "status": QUEUED, "expires_at": now + timedelta(minutes=1)})
+    store.create({"_id": "old", "status": QUEUED, "expires_at": now - timedelta(minutes=1)})
+    store.update("live", {"status": RUNNING})
+    assert store.get("live")["status"] == RUNNING
+    assert store.get("old") is None
@@ -0,0 +1,60 @@
+import numpy as np
+
+from lexical_index import LexicalIndex, reciprocal_rank_fusion, tokenize
+
+ORGANIZATIONS = [
+    {"Tags": "recycling, green energy", "Specialities": "community outreach"},
+    {"Tags": ["youth", "education"], "Specialities": "after-school tutoring"},
+    {"Tags": "green, green, green", "Specialities": "parks"},
+    {"Tags": "food bank", "Specialities": None},
+]
+
+
+def build_index():
+    index = LexicalIndex(len(ORGANIZATIONS))
+    for row, org in enumerate(ORGANIZATIONS):
+        index.forward[row] = index._encode(tokenize([org.get("Tags"), org.get("Specialities")]))
+    index._compile()
+    return index
+
+
+def test_tokenize_drops_stop_words_and_lowercases():
+    assert tokenize("The Youth and Education") == ["youth", "education"]
+    assert tokenize(["Food Bank", "after-school"]) == ["food", "bank", "after", "school"]
+    assert tokenize(None) == []
+
+
+def test_bm25_ranks_by_term_frequency_and_respects_mask():
+    index = build_index()
+    mask = np.ones(len(ORGANIZATIONS), dtype=bool)
+    rows, scores = index.search(["green"], 10, mask)
+    assert list(rows) == [2, 0]
+    assert scores[0] > scores[1] > 0
+
+    mask[2] = False
+    rows, _ = index.search(["green"], 10, mask)
+    assert list(rows) == [0]
+    assert len(index.search(["unknown"], 10, mask)[0]) == 0
+
+
+def test_set_row_is_searchable_before_and_after_recompile():
+    index = build_index()
+    mask = np.ones(5, dtype=bool)
+    index.set_row(3, {"Tags": "robotics", "Specialities": "education"})
+    index.set_row(4, {"Tags": "robotics"})
+    rows, _ = index.search(["robotics"], 10, mask)
+    assert sorted(rows) == [3, 4]
+    # 旧内容不再命中
+    assert list(index.search(["food"], 10, mask)[0]) == []
+
+    index._compile()
+    assert sorted(index.search(["robotics"], 10, mask)[0]) == [3, 4]
+    assert list(index.search(["education"], 10, mask)[0][:2]) in ([1, 3], [3, 1])
+
+
+def test_reciprocal_rank_fusion():
+    fused = reciprocal_rank_fusion([["a", "b", "c"], ["c", "a"]], k=60)
+    assert [org_id for org_id, _, _ in fused] == ["a", "c", "b"]
+    assert fused[0][1] == 1 / 61 + 1 / 62
+    assert fused[1][2] == [3, 1]
+    assert fused[2][2] == [2, None]
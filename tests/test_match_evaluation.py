@@ -0,0 +1,33 @@
+import json
+
+from match_evaluation import parse_batch_verdicts
+
+
+def test_parses_verdicts_object():
+    content = json.dumps({"verdicts": [{"id": "c1", "is_match": True}, {"id": "c3", "is_match": False}]})
+    assert parse_batch_verdicts(content, 3) == {0: True, 2: False}
+
+
+def test_parses_bare_list_in_code_fence():
+    content = '```json\n[{"id": "c2", "is_match": true}]\n```'
+    assert parse_batch_verdicts(content, 2) == {1: True}
+
+
+def test_drops_invalid_entries():
+    content = json.dumps({"verdicts": [
+        {"id": "c1", "is_match": "yes"},
+        {"id": "x2", "is_match": True},
+        {"id": "c4", "is_match": True},
+        {"id": "c0", "is_match": True},
+        "c2",
+        {"id": "c2", "is_match": False},
+        {"id": "c2", "is_match": True}
+    ]})
+    # 非布尔值、编号格式错误或越界的条目丢弃，重复的编号只取第一条
+    assert parse_batch_verdicts(content, 3) == {1: False}
+
+
+def test_unparseable_content_returns_no_verdicts():
+    assert parse_batch_verdicts("not json", 3) == {}
+    assert parse_batch_verdicts(json.dumps({"result": []}), 3) == {}
+    assert parse_batch_verdicts("```\n```", 3) == {}
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from metadata_index import MetadataColumns, validate_filter
+
+ORGANIZATIONS = [
+    {"Staff_Count": 5, "Assets": 100.0, "Popularity": "Yes", "Industries": "Education, Health"},
+    {"Staff_Count": 50, "Assets": None, "Popularity": "no", "Industries": ["Tech"]},
+    {"Staff_Count": "200", "Popularity": " YES ", "Industries": "education"},
+    {"Assets": 5000.0, "Industries": "Health, Tech"},
+]
+
+
+@pytest.fixture
+def columns():
+    columns = MetadataColumns(len(ORGANIZATIONS))
+    for row, org in enumerate(ORGANIZATIONS):
+        columns.set_row(row, org)
+    return columns
+
+
+def rows(columns, expression):
+    return list(np.flatnonzero(columns.mask(expression, len(ORGANIZATIONS))))
+
+
+def test_numeric_conditions(columns):
+    assert rows(columns, {"Staff_Count": {"$gte": 10, "$lte": 500}}) == [1, 2]
+    assert rows(columns, {"Staff_Count": 5}) == [0]
+    assert rows(columns, {"Staff_Count": {"$in": [5, 200]}}) == [0, 2]
+    assert rows(columns, {"Assets": {"$exists": False}}) == [1, 2]
+
+
+def test_categorical_conditions_ignore_case(columns):
+    assert rows(columns, {"Popularity": "yes"}) == [0, 2]
+    assert rows(columns, {"Popularity": {"$ne": "Yes"}}) == [1, 3]
+    assert rows(columns, {"Popularity": {"$in": ["unknown"]}}) == []
+
+
+def test_multi_value_conditions(columns):
+    assert rows(columns, {"Industries": "Education"}) == [0, 2]
+    assert rows(columns, {"Industries": {"$all": ["health", "tech"]}}) == [3]
+    assert rows(columns, {"Industries": {"$nin": ["Tech"]}}) == [0, 2]
+
+
+def test_and_or(columns):
+    expression = {"$or": [{"Popularity": "Yes"}, {"Assets": {"$gt": 1000}}], "Industries": "Health"}
+    assert rows(columns, expression) == [0, 3]
+    assert rows(columns, {"$and": [{"Industries": "Tech"}, {"Staff_Count": {"$exists": True}}]}) == [1]
+
+
+def test_set_row_replaces_previous_values(columns):
+    columns.set_row(0, {"Staff_Count": 1000, "Industries": "Tech"})
+    assert rows(columns, {"Industries": "Education"}) == [2]
+    assert rows(columns, {"Industries": "Tech"}) == [0, 1, 3]
+    assert rows(columns, {"Popularity": "Yes"}) == [2]
+
+
+@pytest.mark.parametrize("expression", [
+    {"Staff_Count": {"$gte": "abc"}},
+    {"Staff_Count": {"$in": 5}},
+    {"Founded": 1990},
+    {"Popularity": {"$regex": "y"}},
+    {"$or": {"Popularity": "Yes"}},
+    ["Popularity"],
+])
+def test_validate_filter_rejects_invalid_expressions(expression):
+    with pytest.raises(ValueError):
+        validate_filter(expression)
+
+
+def test_validate_filter_accepts_valid_expression():
+    validate_filter({"Industries": {"$in": ["Education"]}, "Staff_Count": {"$gte": 10}, "Popularity": "Yes"})
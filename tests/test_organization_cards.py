@@ -0,0 +1,53 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from organization_cards import RequestDocuments
+
+
+class SlowCache:
+    """记录每次读取的组织，读取时停顿一下让两个线程重叠"""
+
+    def __init__(self, missing=()):
+        self.fetched = []
+        self.missing = set(missing)
+        self.lock = threading.Lock()
+
+    def fetch(self, collection, org_ids):
+        with self.lock:
+            self.fetched.extend(org_ids)
+        time.sleep(0.05)
+        return {org_id: ({"_id": org_id}, {"Name": org_id}) for org_id in org_ids if org_id not in self.missing}
+
+
+def test_concurrent_fetches_read_each_organization_once():
+    cache = SlowCache(missing={"gone"})
+    documents = RequestDocuments()
+    with ThreadPoolExecutor(2) as executor:
+        left = executor.submit(documents.fetch, None, ["a", "b", "c", "gone"], cache)
+        right = executor.submit(documents.fetch, None, ["c", "b", "d", "gone"], cache)
+        left, right = left.result(), right.result()
+
+    assert sorted(cache.fetched) == ["a", "b", "c", "d", "gone"]
+    assert sorted(left) == ["a", "b", "c"]
+    assert sorted(right) == ["b", "c", "d"]
+    assert left["b"] is right["b"]
+    assert documents.fetch(None, ["a", "d"], cache).keys() == {"a", "d"}
+    assert len(cache.fetched) == 5
+
+
+def test_fetch_error_reaches_threads_waiting_for_the_same_organization():
+    class FailingCache(SlowCache):
+        def fetch(self, collection, org_ids):
+            super().fetch(collection, org_ids)
+            raise RuntimeError("db down")
+
+    cache = FailingCache()
+    documents = RequestDocuments()
+    with pytest.raises(RuntimeError):
+        documents.fetch(None, ["a"], cache)
+    with pytest.raises(RuntimeError):
+        documents.fetch(None, ["a"], cache)
+    assert cache.fetched == ["a"]
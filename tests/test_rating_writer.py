@@ -0,0 +1,79 @@
+from concurrent.futures import Future
+
+import pytest
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import PyMongoError
+
+from rating_writer import RatingWriter
+
+
+class RejectingCollection:
+    """转发到真实集合，但更新 bad 文档时报错"""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.name = collection.name
+        self.calls = []
+
+    def bulk_write(self, operations, ordered=True):
+        self.calls.append(len(operations))
+        for operation in operations:
+            if isinstance(operation, UpdateOne) and operation._filter == {"_id": "bad"}:
+                raise PyMongoError("write rejected")
+        return self.collection.bulk_write(operations, ordered=ordered)
+
+
+@pytest.fixture
+def writer(mongo_db):
+    collection = RejectingCollection(mongo_db["ratings"])
+    writer = RatingWriter(collection)
+    yield writer
+    writer.close()
+
+
+def batch_of(*operations):
+    return [(operation, result, Future()) for operation, result in operations]
+
+
+def test_retry_treats_already_written_inserts_as_success(writer):
+    ratings = writer.collection.collection
+    ratings.insert_one({"_id": "a", "rating": 1})
+    batch = batch_of(
+        (InsertOne({"_id": "a", "rating": 1}), "a"),
+        (UpdateOne({"_id": "a"}, {"$set": {"feedback": "good"}}), True),
+        (InsertOne({"_id": "b", "rating": 5}), "b"),
+    )
+    writer._write_one_by_one(batch)
+
+    assert [future.result(0) for _, _, future in batch] == ["a", True, "b"]
+    assert ratings.find_one({"_id": "a"}) == {"_id": "a", "rating": 1, "feedback": "good"}
+    assert ratings.find_one({"_id": "b"}) == {"_id": "b", "rating": 5}
+    assert writer.info()["failed"] == 0
+
+
+def test_retry_fails_only_the_rejected_operation(writer):
+    ratings = writer.collection.collection
+    batch = batch_of(
+        (InsertOne({"_id": "bad"}), "bad"),
+        (UpdateOne({"_id": "bad"}, {"$set": {"feedback": "x"}}), True),
+        (InsertOne({"_id": "c"}), "c"),
+    )
+    writer._write(batch)
+
+    # 整批写入失败一次，然后逐条重试
+    assert writer.collection.calls == [3, 1, 1, 1]
+    assert batch[0][2].result(0) == "bad"
+    with pytest.raises(PyMongoError):
+        batch[1][2].result(0)
+    assert batch[2][2].result(0) == "c"
+    assert ratings.count_documents({}) == 2
+    assert writer.info()["failed"] == 1
+    assert writer.info()["batches"] == 1 and writer.info()["operations"] == 3
+
+
+def test_queued_writes_are_flushed_in_order(writer):
+    ratings = writer.collection.collection
+    inserted = writer.insert({"rating": 4})
+    document_id = inserted.result(5)
+    assert writer.update(document_id, {"$set": {"feedback": "ok"}}).result(5) is True
+    assert ratings.find_one({"_id": document_id})["feedback"] == "ok"
@@ -0,0 +1,98 @@
+import os
+import uuid
+from multiprocessing import shared_memory
+
+import numpy as np
+import pytest
+
+from embedding_index import CollectionIndex
+from organization_cards import get_card_cache
+from shared_index import SharedIndexPublisher, attach_index, refresh_index, segment_name
+
+from conftest import fake_vector
+
+
+@pytest.fixture
+def prefix():
+    return f"cctest{os.getpid()}{uuid.uuid4().hex[:6]}"
+
+
+@pytest.fixture
+def published(organizations, prefix):
+    index = CollectionIndex.from_collection(organizations)
+    publisher = SharedIndexPublisher(organizations, prefix)
+    assert publisher.publish(index) is True
+    yield index, publisher
+    publisher.close()
+    manifest = shared_memory.SharedMemory(name=segment_name(prefix, organizations.name))
+    manifest.close()
+    manifest.unlink()
+
+
+def test_attach_matches_private_index(organizations, prefix, published):
+    index, publisher = published
+    # 没有变更时不重新发布
+    assert publisher.publish(index) is False
+
+    shared = attach_index(organizations.name, prefix, check_interval=0)
+    assert shared is not None
+    assert len(shared) == len(index)
+    assert set(shared.document_ids()) == set(index.document_ids())
+    for org_id in index.document_ids():
+        assert shared._row_of[org_id] == index._row_of[org_id]
+        assert shared.ids[index._row_of[org_id]] == org_id
+
+    query = fake_vector("query")
+    for field in ("tag_embedding", "description_embedding"):
+        expected = index.search(field, query, 10)
+        results = shared.search(field, query, 10)
+        assert [org_id for org_id, _ in results] == [org_id for org_id, _ in expected]
+        assert [score for _, score in results] == pytest.approx([score for _, score in expected])
+        assert not shared.matrices[field].flags.writeable
+
+
+def test_refresh_swaps_generation_and_invalidates_changed_cards(organizations, prefix, published):
+    index, publisher = published
+    shared = attach_index(organizations.name, prefix, check_interval=0)
+    ids = shared.document_ids()
+    kept, changed = ids[0], ids[1]
+    cards = get_card_cache(organizations.name)
+    cards.load(organizations, [kept, changed])
+    # 旧代数上建好的 BM25 索引
+    shared.lexical_index(organizations)
+
+    assert refresh_index(shared, organizations) is None
+
+    query = fake_vector("query")
+    organizations.update_one({"_id": changed}, {"$set": {"tag_embedding": query.tobytes(), "Tags": "zebra"}})
+    index.upsert_document(organizations.find_one({"_id": changed}))
+    assert publisher.publish(index) is True
+
+    refreshed = refresh_index(shared, organizations)
+    assert refreshed is not None
+    assert refreshed.shared.generation == shared.shared.generation + 1
+    assert refreshed.search("tag_embedding", query, 1)[0][0] == changed
+    assert set(cards.get_many([kept, changed])) == {kept}
+    assert refreshed.lexical is shared.lexical
+    assert [org_id for org_id, _ in refreshed.search_lexical(organizations, ["zebra"], 5)] == [changed]
+    # 旧代数在进行中的请求结束前仍然可用
+    assert not np.allclose(shared.matrices["tag_embedding"][shared._row_of[changed]], query / np.linalg.norm(query))
+
+
+def test_private_index_switches_to_shared(organizations, prefix):
+    private = CollectionIndex.from_collection(organizations)
+    # 发布进程还没有运行
+    assert attach_index(organizations.name, prefix) is None
+    assert refresh_index(private, organizations, prefix) is None
+
+    publisher = SharedIndexPublisher(organizations, prefix)
+    try:
+        publisher.publish(private)
+        refreshed = refresh_index(private, organizations, prefix)
+        assert refreshed is not None and refreshed.shared is not None
+        assert set(refreshed.document_ids()) == set(private.document_ids())
+    finally:
+        publisher.close()
+        manifest = shared_memory.SharedMemory(name=segment_name(prefix, organizations.name))
+        manifest.close()
+        manifest.unlink()
@@ -0,0 +1,72 @@
+"""(用户组织, 候选组织, 评估提示词版本) 的评估结果缓存
+
+键由三部分组成：
+- 评估提示词里用到的用户字段的哈希（改名字或合作描述不会让缓存失效）
+- 候选组织的 _id 和文档版本（评估提示词里用到的候选字段的哈希）
+- 评估提示词模板和模型的哈希
+"""
+import hashlib
+import json
+import os
+import threading
+
+from cache_store import PersistentLRUCache
+
+VERDICT_CACHE_ENABLED = os.getenv("VERDICT_CACHE_ENABLED", "1") != "0"
+
+# 评估提示词用到的字段，其余字段的修改不影响评估结果
+USER_FIELDS = ("Description", "Mission", "Industries", "Specialities", "Organization looking 1")
+ORGANIZATION_FIELDS = ("Description", "Mission", "Industries", "Specialities",
+                       "Partnership", "Event", "Contribution", "Assets")
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def _hash(payload):
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+                          .encode("utf-8")).hexdigest()
+
+
+def _normalize(value):
+    return " ".join(value.split()) if isinstance(value, str) else value
+
+
+def get_verdict_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            ttl = os.getenv("VERDICT_CACHE_TTL")
+            _cache = PersistentLRUCache(
+                "verdict",
+                os.getenv("VERDICT_CACHE_PATH", os.path.join("cache", "verdict_cache.sqlite3")),
+                max_memory_items=int(os.getenv("VERDICT_CACHE_MEMORY_ITEMS", "10000")),
+                max_disk_items=int(os.getenv("VERDICT_CACHE_MAX_ITEMS", "500000")),
+                ttl=float(ttl) if ttl else None
+            )
+    return _cache
+
+
+def organization_version(organization):
+    """候选组织文档中影响评估结果的部分的哈希"""
+    return _hash({field: _normalize(organization.get(field, "")) for field in ORGANIZATION_FIELDS})
+
+
+def verdict_key(request, organization, prompt_hash):
+    user_hash = _hash({field: _normalize(request.get(field, "")) for field in USER_FIELDS})
+    return ":".join([user_hash, str(organization["_id"]), organization_version(organization), prompt_hash])
+
+
+def get_verdict(request, organization, prompt_hash):
+    """返回缓存的 is_match，没有时返回 None"""
+    if not VERDICT_CACHE_ENABLED:
+        return None
+    value = get_verdict_cache().get(verdict_key(request, organization, prompt_hash))
+    if value is None:
+        return None
+    return value == b"1"
+
+
+def set_verdict(request, organization, prompt_hash, is_match):
+    if VERDICT_CACHE_ENABLED:
+        get_verdict_cache().set(verdict_key(request, organization, prompt_hash), b"1" if is_match else b"0")